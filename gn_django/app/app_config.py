@@ -8,6 +8,16 @@ class GNAppConfig(AppConfig):
     This currently offers a views dictionary for use with 
     ``gn_django.app.view_registry`` to allow django apps to register overridable
     view classes.
+
+    Setting ``warm_up_templates`` to ``True`` warms up the templates given by
+    the ``TEMPLATE_WARM_UP`` setting when the app is ready - see
+    ``gn_django.template.warmup``.
     """
     
     views = {}
+    warm_up_templates = False
+
+    def ready(self):
+        if self.warm_up_templates:
+            from gn_django.template.warmup import warm_up_templates_from_settings
+            warm_up_templates_from_settings()
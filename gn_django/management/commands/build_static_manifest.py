@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from gn_django.template.static_manifest import build_manifest
+
+class Command(BaseCommand):
+    help = 'Hash the contents of the static files, and write the hashes to the STATICLINK_MANIFEST manifest'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--root', dest='root', default=None,
+            help='The static files directory to hash. Defaults to STATIC_ROOT.',
+        )
+        parser.add_argument(
+            '--manifest', dest='manifest', default=None,
+            help='The path to write the manifest to. Defaults to STATICLINK_MANIFEST.',
+        )
+        parser.add_argument(
+            '--extension', dest='extensions', action='append', default=None,
+            help='A file extension to hash, e.g. "css". Can be given more than once. Defaults to every file.',
+        )
+        parser.add_argument(
+            '--hashed-filenames', dest='hashed_filenames', action='store_true',
+            default=getattr(settings, 'STATICLINK_MANIFEST_HASHED_FILENAMES', False),
+            help='Also write a copy of each file with its hash in its name. Defaults to STATICLINK_MANIFEST_HASHED_FILENAMES.',
+        )
+
+    def handle(self, *args, **options):
+        root = options['root'] or getattr(settings, 'STATIC_ROOT', None)
+        manifest = options['manifest'] or getattr(settings, 'STATICLINK_MANIFEST', None)
+        if not root:
+            raise CommandError("Set STATIC_ROOT or pass --root")
+        if not manifest:
+            raise CommandError("Set STATICLINK_MANIFEST or pass --manifest")
+
+        files = build_manifest(root, manifest, options['extensions'], options['hashed_filenames'])
+        self.stdout.write("Wrote the hashes of %d static files to %s" % (len(files), manifest))
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+import os
+
+from gn_django.template.bundles import write_template_bundle, write_template_zip
+
+class Command(BaseCommand):
+    help = 'Pack every template in a template directory in to a single archive, for use as a template hierarchy level'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='The template directory to pack.')
+        parser.add_argument('path', help='The path to write the archive to.')
+        parser.add_argument(
+            '--zip', dest='zip', action='store_true', default=False,
+            help='Write a zip file, rather than a template bundle.',
+        )
+        parser.add_argument(
+            '--compress', dest='compress', action='store_true', default=False,
+            help='Deflate the templates in a zip file.',
+        )
+        parser.add_argument(
+            '--follow-links', dest='followlinks', action='store_true', default=False,
+            help='Follow symbolic links to directories.',
+        )
+
+    def handle(self, *args, **options):
+        directory = options['directory']
+        if not os.path.isdir(directory):
+            raise CommandError("%s is not a directory" % directory)
+        if options['compress'] and not options['zip']:
+            raise CommandError("--compress can only be used with --zip")
+
+        if options['zip']:
+            names = write_template_zip(directory, options['path'], options['followlinks'], options['compress'])
+        else:
+            names = write_template_bundle(directory, options['path'], options['followlinks'])
+        self.stdout.write("Wrote %d templates to %s" % (len(names), options['path']))
@@ -0,0 +1,139 @@
+import marshal
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+from django.core.management.base import BaseCommand, CommandError
+from django.template import engines
+from django_jinja.backend import Jinja2
+from jinja2 import TemplateSyntaxError
+from jinja2.loaders import ModuleLoader
+
+from gn_django.template.loaders import get_hierarchy_loaders
+
+# The environment and hierarchy loaders to compile templates with.  These are
+# set before the process pool is forked so that the workers inherit them.
+_environment = None
+_hierarchies = None
+
+def compile_template(hierarchy_name, name, raw):
+    """
+    Compile a template from a hierarchy.
+
+    Args:
+      * `hierarchy_name` - the name of the hierarchy to load the template from
+      * `name` - the template name
+      * `raw` - boolean - compile to python source rather than a code object
+
+    Returns a tuple of the template's filename, source, compiled code (python
+    source, or marshalled code object), compile time in seconds and error
+    message if the template could not be compiled.
+    """
+    source, filename, _ = _hierarchies[hierarchy_name].get_source(_environment, name)
+    start = time.perf_counter()
+    try:
+        code = _environment.compile(source, name, filename, raw=raw, defer_init=raw)
+    except TemplateSyntaxError as e:
+        return filename, source, None, time.perf_counter() - start, str(e)
+    elapsed = time.perf_counter() - start
+    if not raw:
+        code = marshal.dumps(code)
+    return filename, source, code, elapsed, None
+
+class Command(BaseCommand):
+    help = 'Compile every template in every template hierarchy, in to the bytecode cache or a directory of template modules'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--engine', dest='engine', default=None,
+            help='The name of the jinja template engine to compile templates for. Defaults to the only jinja engine.',
+        )
+        parser.add_argument(
+            '--processes', dest='processes', type=int, default=None,
+            help='The number of processes to compile templates with. Defaults to the number of CPUs.',
+        )
+        parser.add_argument(
+            '--target', dest='target', default=None,
+            help='Write templates as python modules to this directory - with a package per hierarchy - '
+                 'for use with a jinja ModuleLoader, instead of writing them to the bytecode cache.',
+        )
+
+    def handle(self, *args, **options):
+        global _environment, _hierarchies
+
+        if options['engine']:
+            environment = engines[options['engine']].env
+        else:
+            environment = Jinja2.get_default().env
+        target = options['target']
+        if target is None and environment.bytecode_cache is None:
+            raise CommandError("The template engine has no bytecode cache; configure the `bytecode_cache` option or use --target")
+
+        hierarchies = get_hierarchy_loaders(environment.loader)
+        if not hierarchies:
+            raise CommandError("The template engine does not use a HierarchyLoader or MultiHierarchyLoader")
+
+        # Templates which resolve to the same file from many hierarchies only
+        # need compiling once
+        tasks = {}
+        for hierarchy_name, hierarchy in hierarchies.items():
+            for name, (loader_name, template_name) in sorted(hierarchy.resolve_templates().items()):
+                loader = hierarchy.hierarchy[loader_name]
+                key = (name, tuple(getattr(loader, 'searchpath', [id(loader)])), template_name)
+                tasks.setdefault(key, []).append(hierarchy_name)
+
+        _environment = environment
+        _hierarchies = hierarchies
+        raw = target is not None
+        processes = options['processes'] or os.cpu_count()
+        start = time.perf_counter()
+        if processes > 1:
+            with ProcessPoolExecutor(max_workers=processes, mp_context=get_context('fork')) as executor:
+                futures = [
+                    (key, executor.submit(compile_template, hierarchy_names[0], key[0], raw))
+                    for key, hierarchy_names in tasks.items()
+                ]
+                results = [(key, future.result()) for key, future in futures]
+        else:
+            results = [
+                (key, compile_template(hierarchy_names[0], key[0], raw))
+                for key, hierarchy_names in tasks.items()
+            ]
+        elapsed = time.perf_counter() - start
+
+        timings = []
+        errors = []
+        for key, (filename, source, code, compile_time, error) in results:
+            name = key[0]
+            hierarchy_names = tasks[key]
+            if error:
+                errors.append("%s: %s" % (name, error))
+                continue
+            if target is None:
+                bucket = environment.bytecode_cache.get_bucket(environment, name, filename, source)
+                bucket.code = marshal.loads(code)
+                environment.bytecode_cache.set_bucket(bucket)
+            else:
+                for hierarchy_name in hierarchy_names:
+                    self.write_module(target, hierarchy_name, name, code)
+            timings.append((compile_time, name, hierarchy_names))
+
+        for compile_time, name, hierarchy_names in sorted(timings, key=lambda timing: timing[0], reverse=True):
+            hierarchy_label = ", ".join(str(hierarchy_name) for hierarchy_name in hierarchy_names)
+            self.stdout.write("%8.2fms  %s (%s)" % (compile_time * 1000, name, hierarchy_label))
+        self.stdout.write("Compiled %d templates in %.2fs" % (len(timings), elapsed))
+
+        if errors:
+            raise CommandError("Failed to compile %d templates:\n%s" % (len(errors), "\n".join(errors)))
+
+    def write_module(self, target, hierarchy_name, name, code):
+        """
+        Write a compiled template in to the hierarchy's package in the target
+        directory, with the module name expected by jinja's ``ModuleLoader``.
+        """
+        package_dir = os.path.join(target, hierarchy_name or 'default')
+        os.makedirs(package_dir, exist_ok=True)
+        module_path = os.path.join(package_dir, ModuleLoader.get_module_filename(name))
+        with open(module_path, 'w') as f:
+            f.write(code)
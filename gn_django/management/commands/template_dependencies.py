@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.template import engines
+from django_jinja.backend import Jinja2
+
+from gn_django.template.dependencies import TemplateDependencyGraph
+from gn_django.template.loaders import get_hierarchy_loaders
+
+class Command(BaseCommand):
+    help = 'Report the templates which are included by the most other templates, across every template hierarchy'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--engine', dest='engine', default=None,
+            help='The name of the jinja template engine to report on. Defaults to the only jinja engine.',
+        )
+        parser.add_argument(
+            '--limit', dest='limit', type=int, default=20,
+            help='The number of templates to report. Defaults to 20.',
+        )
+
+    def handle(self, *args, **options):
+        if options['engine']:
+            environment = engines[options['engine']].env
+        else:
+            environment = Jinja2.get_default().env
+        # This builds every hierarchy, including any which are built lazily
+        if not get_hierarchy_loaders(environment.loader):
+            raise CommandError("The template engine does not use a HierarchyLoader or MultiHierarchyLoader")
+
+        graph = getattr(environment, 'dependency_graph', None) or TemplateDependencyGraph(environment)
+        graph.build()
+        for filename, count in graph.get_most_included(options['limit']):
+            self.stdout.write("%6d  %s" % (count, filename))
@@ -1,3 +1,8 @@
+import asyncio
+from contextlib import contextmanager
+import os
+import threading
+import time
 import weakref
 
 from django.contrib.staticfiles.storage import staticfiles_storage
@@ -6,14 +11,61 @@ from django.conf import settings
 from django.utils.text import slugify
 from django.utils import six
 from django.utils.module_loading import import_string
+from django.middleware import csrf
+from django.template import TemplateDoesNotExist, TemplateSyntaxError
+from django.template.context import BaseContext
+from django.utils.encoding import smart_text
+from django.utils.functional import SimpleLazyObject
+from django.utils.safestring import mark_safe
 
 import jinja2
-from django_jinja.backend import Jinja2 as DjangoJinja2
-from django_jinja import builtins as dj_jinja_builtins
+from django_jinja.backend import Jinja2 as DjangoJinja2, Template as DjangoJinjaTemplate, get_exception_info
+from django_jinja import base as dj_jinja_base, builtins as dj_jinja_builtins
 from django_jinja.contrib._humanize.templatetags._humanize import ordinal, intcomma, intword, apnumber, naturalday, naturaltime
 
-from .extensions import SpacelessExtension, IncludeWithExtension, StaticLinkExtension, IncludeRawExtension
+from .extensions import SpacelessExtension, IncludeWithExtension, StaticLinkExtension, IncludeRawExtension, FragmentCacheExtension
+from .extensions import HTMLMinifyExtension, get_raw_file_cache
 from .globals import randint
+from gn_django.site import get_current_site, set_current_site, clear_current_site
+from .dependencies import TemplateDependencyGraph
+from .loaders import get_hierarchy_loaders, HierarchyLoader, LazyHierarchies, MultiHierarchyLoader
+from .template_cache import PartitionedTemplateCache
+
+class InstrumentedTemplate(jinja2.Template):
+    """
+    Jinja template class which records the time taken to render the template
+    with the environment's instrumentation sink.
+    """
+
+    def render(self, *args, **kwargs):
+        if self.environment.is_async:
+            # Rendering goes via `render_async()`, which records the render
+            return super(InstrumentedTemplate, self).render(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return super(InstrumentedTemplate, self).render(*args, **kwargs)
+        finally:
+            self.environment.record_template_event('render', self.name, self.filename, start)
+
+    async def render_async(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super(InstrumentedTemplate, self).render_async(*args, **kwargs)
+        finally:
+            self.environment.record_template_event('render', self.name, self.filename, start)
+
+    def generate(self, *args, **kwargs):
+        if self.environment.is_async:
+            return super(InstrumentedTemplate, self).generate(*args, **kwargs)
+        return self.generate_instrumented(*args, **kwargs)
+
+    def generate_instrumented(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            for chunk in super(InstrumentedTemplate, self).generate(*args, **kwargs):
+                yield chunk
+        finally:
+            self.environment.record_template_event('render', self.name, self.filename, start)
 
 class Environment(jinja2.Environment):
     """
@@ -27,15 +79,75 @@ class Environment(jinja2.Environment):
       * `template_cache_key_cb` - a callback function for generating a template
         cache key.  When this is present, this is used instead of the default
         cache key behaviour.
+      * `share_compiled_templates` - boolean - when ``True``, templates which
+        resolve to the same file on disk (by absolute path and modification
+        time) share one compiled ``Template`` object, even when they are cached
+        under different keys - e.g. a ``core`` template loaded for many sites
+        with ``get_template_cache_key_with_site``.  Defaults to ``False``.
+      * `template_watcher` - a template watcher (see ``gn_django.template.watchers``)
+        or a dot-notation python path of a callable which returns one.  When
+        this is present, cached templates are evicted by the watcher when their
+        files change, instead of being checked with ``auto_reload``
+        every time they are fetched from the cache.
+      * `instrumentation` - an instrumentation sink (see
+        ``gn_django.template.instrumentation``) or a dot-notation python path
+        of a callable which returns one.  When this is present, the time taken
+        to fetch templates from the cache, load, compile and render them is
+        recorded with the sink.
+      * `dependency_graph` - boolean - when ``True``, a ``TemplateDependencyGraph``
+        of the templates in each hierarchy is kept, so that invalidating a
+        template also evicts every cached template which extends, includes or
+        imports it.  Defaults to ``False``.
+      * `template_cache` - the template cache to use instead of jinja's LRU
+        cache: a cache object, a dot-notation python path of a callable which
+        returns one, or a dictionary of kwargs for a ``PartitionedTemplateCache``
+        (see ``gn_django.template.template_cache``), which gives each site its
+        own quota.
 
     *NOTE*: This class has some duplication from jinja2.Environment which is
     currently unavoidable as there's no overridable hook just for generating
     template cache keys: https://github.com/pallets/jinja/blob/bbe0a4174c2846487bef4328b309fddd8638da39/jinja2/environment.py#L798
     """
 
+    # Overlay options which don't change how templates are compiled, so
+    # overlays created with only these share compiled template code
+    overlay_shared_code_options = frozenset(('loader', 'cache_size', 'auto_reload', 'bytecode_cache'))
+
     def __init__(self, **kwargs):
         self.template_cache_key_cb = kwargs.pop('template_cache_key_cb', None)
+        share_compiled_templates = kwargs.pop('share_compiled_templates', False)
+        template_watcher = kwargs.pop('template_watcher', None)
+        instrumentation = kwargs.pop('instrumentation', None)
+        dependency_graph = kwargs.pop('dependency_graph', False)
+        template_cache = kwargs.pop('template_cache', None)
         super(Environment, self).__init__(**kwargs)
+        if isinstance(template_cache, six.string_types):
+            template_cache = import_string(template_cache)()
+        elif isinstance(template_cache, dict):
+            template_cache = PartitionedTemplateCache(**template_cache)
+        if template_cache is not None:
+            self.cache = template_cache
+        self.dependency_graph = TemplateDependencyGraph(self) if dependency_graph else None
+        if isinstance(template_watcher, six.string_types):
+            template_watcher = import_string(template_watcher)()
+        self.template_watcher = template_watcher
+        if isinstance(instrumentation, six.string_types):
+            instrumentation = import_string(instrumentation)()
+        self.instrumentation = instrumentation
+        if instrumentation is not None:
+            self.template_class = InstrumentedTemplate
+        # The hierarchy this environment loads templates for, if it only
+        # loads templates for one of a multi hierarchy loader's hierarchies
+        self.hierarchy_name = None
+        # Compiled templates keyed by resolved file path and mtime; entries go
+        # away once no template cache entry refers to them any more
+        self.shared_templates = None
+        # Compiled template code keyed by resolved file path, of (mtime, code).
+        # This is shared with overlays, which build their own templates from it
+        self.shared_code = None
+        if share_compiled_templates:
+            self.shared_templates = weakref.WeakValueDictionary()
+            self.shared_code = {}
 
     def get_template_cache_key(self, template_name):
         """
@@ -58,16 +170,449 @@ class Environment(jinja2.Environment):
         # TODO: Maybe see if we can merge a PR in to the jinja project which
         # provides `get_template_cache_key` for override
         cache_key = self.get_template_cache_key(name)
+        if self.template_watcher is not None:
+            self.template_watcher.watch(self)
+        instrumentation = self.instrumentation
         if self.cache is not None:
+            if instrumentation is not None:
+                start = time.perf_counter()
             template = self.cache.get(cache_key)
             if template is not None and (not self.auto_reload or
+                                         self.template_watcher is not None or
                                          template.is_up_to_date):
+                if instrumentation is not None:
+                    self.record_template_event('cache_hit', name, template.filename, start)
                 return template
-        template = self.loader.load(self, name, globals)
+        if instrumentation is not None:
+            template = self.load_instrumented_template(name, globals)
+        elif self.shared_templates is not None:
+            template = self.load_shared_template(name, globals)
+        else:
+            template = self.loader.load(self, name, globals)
         if self.cache is not None:
             self.cache[cache_key] = template
         return template
 
+    @jinja2.utils.internalcode
+    def compile(self, source, name=None, filename=None, raw=False, defer_init=False):
+        try:
+            return super(Environment, self).compile(source, name, filename, raw, defer_init)
+        except Exception:
+            # Let other processes compile the template, rather than waiting on
+            # a compile lock taken for it by the bytecode cache
+            release_compile_locks = getattr(self.bytecode_cache, 'release_compile_locks', None)
+            if release_compile_locks is not None:
+                release_compile_locks()
+            raise
+
+    def overlay(self, **kwargs):
+        rv = super(Environment, self).overlay(**kwargs)
+        # Jinja would replace a partitioned cache with an LRU cache
+        if isinstance(self.cache, PartitionedTemplateCache) and 'cache_size' not in kwargs:
+            rv.cache = self.cache.copy()
+        # Shared templates are bound to the environment that compiled them, so
+        # the overlay needs its own - but it can share their compiled code,
+        # unless it compiles templates differently
+        if self.shared_templates is not None:
+            rv.shared_templates = weakref.WeakValueDictionary()
+            if set(kwargs) - self.overlay_shared_code_options:
+                rv.shared_code = {}
+        return rv
+
+    def evict_templates(self, predicate):
+        """
+        Remove templates from the template cache.
+
+        Args:
+          * `predicate` - callable which is given each cached template, and
+            returns ``True`` if the template should be removed from the cache
+        """
+        if self.cache is None:
+            return
+        for cache_key, template in self.cache.items():
+            if predicate(template):
+                try:
+                    del self.cache[cache_key]
+                except KeyError:
+                    pass
+
+    def invalidate_templates(self, filenames):
+        """
+        Remove templates from the template cache which are affected by changes
+        to the given template files.  Templates are removed if they were loaded
+        from one of the files, or share a name with one of the files - as a
+        file that has been added may now take precedence in a hierarchy.  With
+        a dependency graph, templates which depend on the changed templates are
+        removed too.  Static files cached for ``include_raw`` are evicted as
+        well.
+
+        Args:
+          * `filenames` - iterable of template filenames which have changed
+        """
+        filenames = set(filenames)
+        # Hierarchies which haven't been built yet have nothing to invalidate
+        hierarchies = get_hierarchy_loaders(self.loader, built_only=True)
+        names = set()
+        for hierarchy in hierarchies.values():
+            for loader in hierarchy.hierarchy.values():
+                for searchpath in getattr(loader, 'searchpath', []):
+                    searchpath = os.path.join(searchpath, '')
+                    for filename in filenames:
+                        if filename.startswith(searchpath):
+                            names.add(filename[len(searchpath):].replace(os.path.sep, '/'))
+
+        for hierarchy in hierarchies.values():
+            hierarchy.invalidate_index()
+            for name in names:
+                hierarchy.invalidate_negative_cache(name)
+
+        dependents = set()
+        if self.dependency_graph is not None:
+            graph = self.dependency_graph
+            for key in graph.get_affected_templates(filenames):
+                dependents.add((key[1], graph.filenames[key]))
+            graph.invalidate()
+
+        # Shared templates keep the name they were first compiled with, so
+        # their dependents are matched by filename alone
+        dependent_filenames = set(filename for _, filename in dependents)
+        delimiter = getattr(self.loader, 'delimiter', ':')
+        def is_affected(template):
+            if template.filename in filenames or (template.name, template.filename) in dependents:
+                return True
+            if self.shared_templates is not None and template.filename in dependent_filenames:
+                return True
+            return template.name is not None and template.name.rsplit(delimiter, 1)[-1] in names
+        self.evict_templates(is_affected)
+
+        # Watched directories may include static files used by ``include_raw``
+        if IncludeRawExtension.identifier in self.extensions:
+            get_raw_file_cache().invalidate(filenames)
+
+    def load_shared_template(self, name, globals):
+        """
+        Load a template, reusing an already compiled ``Template`` object if
+        the template name resolves to a file which has already been compiled.
+
+        Args:
+          * `name` - the template name to load
+          * `globals` - the globals for the template if it has to be compiled
+        """
+        source, filename, uptodate = self.loader.get_source(self, name)
+        return self.get_shared_template(name, source, filename, uptodate, globals)
+
+    def get_shared_template(self, name, source, filename, uptodate, globals):
+        """
+        Get the shared ``Template`` object for template source which has
+        already been loaded, compiling it if it hasn't been compiled yet by
+        this environment or any environment it shares compiled code with.
+
+        Args:
+          * `name` - the template name
+          * `source` - the template source
+          * `filename` - the template filename, or ``None``
+          * `uptodate` - the loader's up to date callable for the template
+          * `globals` - the globals for the template if it has to be compiled
+        """
+        if filename is None:
+            return self.compile_template(name, source, filename, uptodate, globals)
+        try:
+            mtime = os.path.getmtime(filename)
+        except OSError:
+            mtime = None
+        path = os.path.realpath(filename)
+        shared_key = (path, mtime)
+        template = self.shared_templates.get(shared_key)
+        if template is None:
+            shared_code = self.shared_code.get(path)
+            if shared_code is not None and shared_code[0] == mtime:
+                code = shared_code[1]
+            else:
+                code = self.get_template_code(name, source, filename)
+                self.shared_code[path] = (mtime, code)
+            template = self.template_class.from_code(self, code, globals or {}, uptodate)
+            self.shared_templates[shared_key] = template
+        return template
+
+    def compile_template(self, name, source, filename, uptodate, globals):
+        """
+        Compile template source into a ``Template`` object, going via the
+        bytecode cache if there is one.  This mirrors ``jinja2.BaseLoader.load``
+        for template source which has already been loaded.
+
+        Args:
+          * `name` - the template name
+          * `source` - the template source
+          * `filename` - the template filename, or ``None``
+          * `uptodate` - the loader's up to date callable for the template
+          * `globals` - the globals for the template
+        """
+        if globals is None:
+            globals = {}
+        code = self.get_template_code(name, source, filename)
+        return self.template_class.from_code(self, code, globals, uptodate)
+
+    def get_template_code(self, name, source, filename):
+        """
+        Compile template source into a code object, going via the bytecode
+        cache if there is one.
+
+        Args:
+          * `name` - the template name
+          * `source` - the template source
+          * `filename` - the template filename, or ``None``
+        """
+        code = None
+        bcc = self.bytecode_cache
+        if bcc is not None:
+            bucket = bcc.get_bucket(self, name, filename, source)
+            code = bucket.code
+        if code is None:
+            code = self.compile(source, name, filename)
+            if bcc is not None:
+                bucket.code = code
+                bcc.set_bucket(bucket)
+        return code
+
+    def load_instrumented_template(self, name, globals):
+        """
+        Load and compile a template, recording the time taken for each with
+        the instrumentation sink.
+
+        Args:
+          * `name` - the template name to load
+          * `globals` - the globals for the template
+        """
+        if not self.loader.has_source_access:
+            start = time.perf_counter()
+            template = self.loader.load(self, name, globals)
+            self.record_template_event('load', name, template.filename, start)
+            return template
+        start = time.perf_counter()
+        source, filename, uptodate = self.loader.get_source(self, name)
+        self.record_template_event('load', name, filename, start)
+        start = time.perf_counter()
+        if self.shared_templates is not None:
+            template = self.get_shared_template(name, source, filename, uptodate, globals)
+        else:
+            template = self.compile_template(name, source, filename, uptodate, globals)
+        self.record_template_event('compile', name, filename, start)
+        return template
+
+    def record_template_event(self, event, name, filename, start):
+        """
+        Record the time taken for a template event with the instrumentation sink.
+
+        Args:
+          * `event` - the event name - ``cache_hit``, ``load``, ``compile`` or ``render``
+          * `name` - the template name
+          * `filename` - the template filename, or ``None``
+          * `start` - the ``time.perf_counter()`` value when the event started
+        """
+        duration = time.perf_counter() - start
+        self.instrumentation.record(event, name, duration, self.get_instrumentation_tags(filename))
+
+    def get_instrumentation_tags(self, filename):
+        """
+        Get the tags to record a template event with - the ``site`` (the active
+        hierarchy) and the hierarchy ``level`` the template was loaded from.
+
+        Args:
+          * `filename` - the template filename, or ``None``
+        """
+        tags = {}
+        site = self.hierarchy_name
+        hierarchy = None
+        if isinstance(self.loader, MultiHierarchyLoader):
+            site = self.loader.get_active_hierarchy()
+            hierarchy = self.loader.hierarchies.get(site)
+        elif isinstance(self.loader, HierarchyLoader):
+            hierarchy = self.loader
+        if site is not None:
+            tags['site'] = site
+        if hierarchy is not None:
+            level = hierarchy.get_level(filename)
+            if level is not None:
+                tags['level'] = level
+        return tags
+
+class Template(DjangoJinjaTemplate):
+    """
+    Django template wrapper for jinja templates, which can also be rendered
+    asynchronously when the jinja environment has ``enable_async`` set - e.g.
+
+    ```
+        html = await engines['jinja2'].get_template('article.j2').render_async(context, request)
+    ```
+
+    *NOTE*: Building the template context duplicates django-jinja's
+    ``Template.render()``, which offers no hook for it.
+    """
+
+    def get_context(self, context=None, request=None):
+        """
+        Build the jinja context for rendering the template - adding the
+        request, CSRF token and the output of context processors if there is a
+        request.
+
+        Args:
+          * `context` - mapping - the template context
+          * `request` - HttpRequest - the current request, if available
+        """
+        if context is None:
+            context = {}
+
+        context = dj_jinja_base.dict_from_context(context)
+
+        if request is not None:
+            def _get_val():
+                token = csrf.get_token(request)
+                if token is None:
+                    return 'NOTPROVIDED'
+                return smart_text(token)
+
+            context["request"] = request
+            context["csrf_token"] = SimpleLazyObject(_get_val)
+
+            # Support for django context processors
+            for processor in self.backend.context_processors:
+                context.update(processor(request))
+
+        if self.backend._tmpl_debug:
+            from django.test import signals
+
+            # Emulate django's layered context for apps like
+            # django-debug-toolbar which depend on it
+            if not isinstance(context, BaseContext):
+                class CompatibilityContext(dict):
+                    @property
+                    def dicts(self):
+                        return [self]
+
+                context = CompatibilityContext(context)
+
+            signals.template_rendered.send(sender=self, template=self, context=context)
+
+        return context
+
+    def render(self, context=None, request=None):
+        context = self.get_context(context, request)
+        if self.template.environment.is_async:
+            # Outside of an event loop, render on a new one
+            loop = asyncio.new_event_loop()
+            try:
+                return mark_safe(loop.run_until_complete(self.template.render_async(context)))
+            finally:
+                loop.run_until_complete(loop.shutdown_asyncgens())
+                loop.close()
+        return mark_safe(self.template.render(context))
+
+    async def render_async(self, context=None, request=None):
+        """
+        Render the template asynchronously.  The jinja environment must have
+        ``enable_async`` set.
+
+        Args:
+          * `context` - mapping - the template context
+          * `request` - HttpRequest - the current request, if available
+        """
+        return mark_safe(await self.template.render_async(self.get_context(context, request)))
+
+    def stream(self, context=None, request=None, buffer_size=None):
+        """
+        Render the template in chunks, as an iterator of strings - e.g. for a
+        ``StreamingHttpResponse``.  Rendered output is buffered until there is
+        at least ``buffer_size`` characters of it.
+
+        Args:
+          * `context` - mapping - the template context
+          * `request` - HttpRequest - the current request, if available
+          * `buffer_size` - int - the number of characters to buffer before
+            yielding a chunk.  Defaults to the backend's ``stream_buffer_size``.
+        """
+        if buffer_size is None:
+            buffer_size = self.backend.stream_buffer_size
+        loader = self.template.environment.loader
+        hierarchy_name = None
+        if isinstance(loader, MultiHierarchyLoader):
+            hierarchy_name = loader.get_active_hierarchy()
+        chunks = self.template.generate(self.get_context(context, request))
+        return buffer_chunks(generate_for_site(chunks, get_current_site(), loader, hierarchy_name), buffer_size)
+
+def buffer_chunks(chunks, buffer_size):
+    """
+    Join rendered template chunks in to larger chunks of at least
+    ``buffer_size`` characters (apart from the last one).
+
+    Args:
+      * `chunks` - iterable of strings
+      * `buffer_size` - int - the number of characters to buffer before
+        yielding a chunk.  With ``0``, chunks are yielded as they are rendered.
+    """
+    buffer = []
+    buffered = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        buffered += len(chunk)
+        if buffered >= buffer_size:
+            yield ''.join(buffer)
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield ''.join(buffer)
+
+@contextmanager
+def site_activated(site, loader, hierarchy_name):
+    """
+    Context manager which makes a site (and hierarchy of a multi hierarchy
+    loader) current while a template is streamed, and restores the previous
+    site afterwards.
+    """
+    previous_site = get_current_site()
+    if site is not None:
+        set_current_site(site)
+    try:
+        if hierarchy_name is not None:
+            with loader.activate(hierarchy_name):
+                yield
+        else:
+            yield
+    finally:
+        if previous_site is None:
+            clear_current_site()
+        else:
+            set_current_site(previous_site)
+
+def generate_for_site(chunks, site, loader, hierarchy_name):
+    """
+    Generate rendered template chunks with the site and hierarchy that were
+    active when streaming started.  Streamed responses are rendered after the
+    view has returned - and after the site middleware has cleared the current
+    site - so templates included while streaming would otherwise load from the
+    wrong hierarchy.
+    """
+    chunks = iter(chunks)
+    while True:
+        with site_activated(site, loader, hierarchy_name):
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+        yield chunk
+
+def get_template_name_cache_key(loader, template_name):
+    """
+    Template cache key callback function which uses the template name as the
+    cache key.  This is only suitable for environments whose loader always
+    resolves a template name to the same template - e.g. the per-hierarchy
+    environments created with the ``environment_per_hierarchy`` option.
+
+    Args:
+      * `loader` - the jinja loader object
+      * `template_name` - the jinja template name
+    """
+    return template_name
+
 def environment(**options):
     """
     Base jinja2 environment.
@@ -125,6 +670,46 @@ class Jinja2(DjangoJinja2):
             This defaults to a standard filesystem loader, but can be specified
             as either a dot-notation python path or a fully instantiated loader
             object
+          * ``"bytecode_cache"`` - the bytecode cache to store compiled templates
+            in.  This can be an instantiated jinja ``BytecodeCache`` object, or
+            a dictionary with possible key/value pairs:
+            * ``"enabled"`` - whether to use the bytecode cache.  Defaults to ``False``
+            * ``"backend"`` - python dot-notation string for the bytecode cache
+              class.  Defaults to ``"gn_django.template.bytecode_cache.DjangoCacheBytecodeCache"``
+            * ``"name"`` - the django cache alias to use (for compatibility with
+              django-jinja's ``bytecode_cache`` option)
+            * ``"options"`` - dictionary of kwargs to instantiate the bytecode
+              cache class with
+          * ``"environment_per_hierarchy"`` - when ``True`` and the loader is a
+            ``MultiHierarchyLoader``, a separate jinja environment - with its own
+            template cache - is created for each hierarchy.  Templates are
+            loaded from the environment for the active hierarchy, which is
+            looked up once per ``get_template()`` rather than for each template
+            loaded while rendering.  Defaults to ``False``.
+          * ``"hierarchy_cache_size"`` - the template cache size for each
+            per-hierarchy environment.  Either an int, or a dictionary of
+            hierarchy name to cache size.  Defaults to the ``cache_size`` of
+            the main environment - or if it has a partitioned
+            ``template_cache``, to an empty cache with the same quotas.  When the loader's hierarchies are built lazily
+            (see ``get_multi_hierarchy_loader``), each hierarchy's environment is
+            also created when the hierarchy is first used.
+          * ``"stream_buffer_size"`` - the number of characters of rendered
+            output to buffer before sending a chunk, when templates are
+            streamed with ``template.stream()``.  Defaults to ``4096``.
+          * ``"minify_html"`` - when ``True``, the static HTML in HTML templates
+            (``.html``, ``.htm``, ``.j2``, ``.jinja`` and ``.jinja2`` files) is
+            minified when the template is compiled (see
+            ``gn_django.template.extensions.HTMLMinifyExtension``).  Can also be
+            a list of ``fnmatch`` patterns of the template names to minify -
+            e.g. ``['*.html']``.  Templates named as another type - e.g.
+            ``welcome.txt.j2`` or ``app.js.j2`` - are never minified.  Defaults
+            to ``False``.
+          * ``"minify_html_exclude"`` - list of ``fnmatch`` patterns of the
+            template names not to minify, in place of the default list of
+            other types (see ``HTMLMinifyExtension.default_exclude_patterns``).
+          * ``"enable_async"`` - when ``True``, templates (and the gn-django
+            extensions) are rendered asynchronously, with
+            ``await template.render_async(context, request)``.  Defaults to ``False``.
     """
     def __init__(self, params):
         """
@@ -155,9 +740,128 @@ class Jinja2(DjangoJinja2):
         # Default jinja template extension to be .j2
         options['match_extension'] = options.pop('match_extension', '.j2')
 
+        bytecode_cache = options.pop('bytecode_cache', None)
+        environment_per_hierarchy = options.pop('environment_per_hierarchy', False)
+        hierarchy_cache_size = options.pop('hierarchy_cache_size', None)
+        self.stream_buffer_size = options.pop('stream_buffer_size', 4096)
+        minify_html = options.pop('minify_html', False)
+        minify_html_exclude = options.pop('minify_html_exclude', None)
+        if minify_html:
+            options['extensions'].append(HTMLMinifyExtension)
+
         params['OPTIONS'] = options
         super(Jinja2, self).__init__(params)
 
+        if bytecode_cache:
+            self.env.bytecode_cache = self.get_bytecode_cache(bytecode_cache)
+        if minify_html and minify_html is not True:
+            self.env.minify_html_patterns = tuple(minify_html)
+        if minify_html and minify_html_exclude is not None:
+            self.env.minify_html_exclude_patterns = tuple(minify_html_exclude)
+
+        self.hierarchy_environments = None
+        if environment_per_hierarchy and isinstance(self.env.loader, MultiHierarchyLoader):
+            self.hierarchy_environments = {}
+            self.hierarchy_cache_size = hierarchy_cache_size
+            self.hierarchy_environments_lock = threading.Lock()
+            if not isinstance(self.env.loader.hierarchies, LazyHierarchies):
+                for hierarchy_name, loader in self.env.loader.hierarchies.items():
+                    self.hierarchy_environments[hierarchy_name] = self.get_hierarchy_environment(
+                        hierarchy_name, loader, hierarchy_cache_size
+                    )
+
+    def get_hierarchy_environment(self, hierarchy_name, loader, cache_size=None):
+        """
+        Create the jinja environment for a hierarchy, as an overlay of the
+        main environment with its own loader and template cache.
+
+        Args:
+          * `hierarchy_name` - the name of the hierarchy
+          * `loader` - the ``HierarchyLoader`` for the hierarchy
+          * `cache_size` - int or dictionary of hierarchy name to cache size
+
+        Returns:
+            a jinja environment
+        """
+        if isinstance(cache_size, dict):
+            cache_size = cache_size.get(hierarchy_name)
+        if cache_size is None and isinstance(self.env.cache, PartitionedTemplateCache):
+            # The overlay gets an empty copy of the partitioned cache
+            env = self.env.overlay(loader=loader)
+        else:
+            if cache_size is None:
+                cache_size = self.env.cache.capacity if self.env.cache is not None else 0
+            env = self.env.overlay(loader=loader, cache_size=cache_size)
+        env.template_cache_key_cb = get_template_name_cache_key
+        env.hierarchy_name = hierarchy_name
+        return env
+
+    def get_environment(self, hierarchy_name=None):
+        """
+        Get the jinja environment to load templates from - the environment for
+        the active hierarchy if there is one per hierarchy, otherwise the main
+        environment.
+
+        Args:
+          * `hierarchy_name` - get the environment for this hierarchy, rather
+            than the active hierarchy
+        """
+        if self.hierarchy_environments is None:
+            return self.env
+        if hierarchy_name is None:
+            hierarchy_name = self.env.loader.get_active_hierarchy()
+        try:
+            return self.hierarchy_environments[hierarchy_name]
+        except KeyError:
+            pass
+        # Create the environment for a lazily built hierarchy
+        loader = self.env.loader.hierarchies[hierarchy_name]
+        with self.hierarchy_environments_lock:
+            if hierarchy_name not in self.hierarchy_environments:
+                self.hierarchy_environments[hierarchy_name] = self.get_hierarchy_environment(
+                    hierarchy_name, loader, self.hierarchy_cache_size
+                )
+            return self.hierarchy_environments[hierarchy_name]
+
+    def get_template(self, template_name):
+        if not self.match_template(template_name):
+            raise TemplateDoesNotExist("Template {} does not exists".format(template_name))
+        try:
+            return Template(self.get_environment().get_template(template_name), self)
+        except jinja2.TemplateNotFound as exc:
+            raise TemplateDoesNotExist(exc.name, backend=self) from exc
+        except jinja2.TemplateSyntaxError as exc:
+            new = TemplateSyntaxError(exc.args)
+            new.template_debug = get_exception_info(exc)
+            raise new from exc
+
+    def from_string(self, template_code):
+        return Template(self.env.from_string(template_code), self)
+
+    def get_bytecode_cache(self, bytecode_cache):
+        """
+        Get the bytecode cache to use for the jinja environment from the
+        ``bytecode_cache`` option.
+
+        Args:
+          * `bytecode_cache` - a ``BytecodeCache`` object or a dictionary
+            describing the bytecode cache to instantiate.
+
+        Returns:
+            a ``BytecodeCache`` object, or ``None`` if it is not enabled
+        """
+        if isinstance(bytecode_cache, jinja2.BytecodeCache):
+            return bytecode_cache
+        if not bytecode_cache.get('enabled', False):
+            return None
+        backend = bytecode_cache.get('backend', 'gn_django.template.bytecode_cache.DjangoCacheBytecodeCache')
+        if isinstance(backend, six.string_types):
+            backend = import_string(backend)
+        args = []
+        if 'name' in bytecode_cache:
+            args.append(bytecode_cache['name'])
+        return backend(*args, **bytecode_cache.get('options', {}))
+
     def get_base_filters(self):
         """
         Default filters that should be included for all jinja templates
@@ -209,6 +913,9 @@ class Jinja2(DjangoJinja2):
             iterable of extensions
         """
         base_extensions = dj_jinja_builtins.DEFAULT_EXTENSIONS.copy()
+        # Replaced by the site aware FragmentCacheExtension
+        base_extensions.remove("django_jinja.builtins.extensions.CacheExtension")
+        base_extensions.append(FragmentCacheExtension)
         base_extensions.append(SpacelessExtension)
         base_extensions.append(IncludeWithExtension)
         base_extensions.append(StaticLinkExtension)
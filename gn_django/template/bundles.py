@@ -0,0 +1,143 @@
+"""
+Template bundles - every template in a directory packed in to a single file,
+with an index at the front, which is memory-mapped and read without any
+further filesystem calls.
+
+Templates can also be packed in to zip files, with ``write_template_zip()``.
+
+A bundle is laid out as:
+
+  * the magic bytes ``GNTPLB01``
+  * the length of the index, as an 8 byte big-endian integer
+  * the index - JSON mapping each template name to the offset (from the end of
+    the index) and length of its source
+  * the template sources, one after the other
+"""
+
+import json
+import mmap
+import os
+import struct
+import zipfile
+
+from .utils import write_atomically
+
+BUNDLE_MAGIC = b'GNTPLB01'
+INDEX_LENGTH = struct.Struct('>Q')
+
+def find_templates(directory, followlinks=False):
+    """
+    Get the names of all of the templates in a directory, as ``/`` separated
+    paths relative to the directory.
+    """
+    names = []
+    for dirpath, _, filenames in os.walk(directory, followlinks=followlinks):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            names.append(os.path.relpath(path, directory).replace(os.path.sep, '/'))
+    return sorted(names)
+
+def is_template_bundle(path):
+    """
+    Check whether a file is a template bundle.
+    """
+    with open(path, 'rb') as f:
+        return f.read(len(BUNDLE_MAGIC)) == BUNDLE_MAGIC
+
+def write_template_zip(directory, path, followlinks=False, compress=False):
+    """
+    Pack every template in a directory in to a zip file.  The zip file is
+    written atomically, so processes never see a partly written file.
+
+    Args:
+      * `directory` - the template directory
+      * `path` - the path to write the zip file to
+      * `followlinks` - boolean - follow symbolic links to directories
+      * `compress` - boolean - deflate the templates, rather than storing them
+        as they are.  Defaults to ``False``, so templates are read without
+        decompressing them.
+
+    Returns the names of the templates in the zip file.
+    """
+    names = find_templates(directory, followlinks)
+    compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+
+    def write(f):
+        with zipfile.ZipFile(f, 'w', compression) as archive:
+            for name in names:
+                archive.write(os.path.join(directory, *name.split('/')), name)
+
+    write_atomically(path, write)
+    return names
+
+def write_template_bundle(directory, path, followlinks=False):
+    """
+    Pack every template in a directory in to a bundle file.  The bundle is
+    written atomically, so processes never see a partly written bundle.
+
+    Args:
+      * `directory` - the template directory
+      * `path` - the path to write the bundle to
+      * `followlinks` - boolean - follow symbolic links to directories
+
+    Returns the names of the templates in the bundle.
+    """
+    names = find_templates(directory, followlinks)
+    index = {}
+    sources = []
+    offset = 0
+    for name in names:
+        with open(os.path.join(directory, *name.split('/')), 'rb') as f:
+            source = f.read()
+        index[name] = [offset, len(source)]
+        sources.append(source)
+        offset += len(source)
+    index_bytes = json.dumps(index, sort_keys=True).encode('utf-8')
+
+    def write(f):
+        f.write(BUNDLE_MAGIC)
+        f.write(INDEX_LENGTH.pack(len(index_bytes)))
+        f.write(index_bytes)
+        for source in sources:
+            f.write(source)
+
+    write_atomically(path, write)
+    return names
+
+class TemplateBundle(object):
+    """
+    A memory-mapped template bundle.
+
+    Args:
+      * `path` - the path of the bundle file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header_length = len(BUNDLE_MAGIC) + INDEX_LENGTH.size
+        if self.data[:len(BUNDLE_MAGIC)] != BUNDLE_MAGIC:
+            raise ValueError("%s is not a template bundle" % path)
+        index_length = INDEX_LENGTH.unpack(self.data[len(BUNDLE_MAGIC):header_length])[0]
+        self.index = json.loads(self.data[header_length:header_length + index_length].decode('utf-8'))
+        self.data_start = header_length + index_length
+
+    def names(self):
+        """
+        Get the names of the templates in the bundle.
+        """
+        return list(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def read(self, name):
+        """
+        Get the source of a template in the bundle, as bytes.
+
+        Raises ``KeyError`` if the template isn't in the bundle.
+        """
+        offset, length = self.index[name]
+        start = self.data_start + offset
+        return self.data[start:start + length]
@@ -0,0 +1,192 @@
+"""
+Bytecode caches for the gn-django jinja environment.
+
+A bytecode cache stores the compiled python code for templates, so that a
+freshly started process does not need to parse and compile every template
+again.  Stale entries are detected by a checksum of the template source - the
+template is recompiled (and the cache entry replaced, or for
+``DjangoCacheBytecodeCache`` a new entry added) when the source changes.
+"""
+
+import sys
+import threading
+import time
+from hashlib import sha1
+
+import jinja2
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from jinja2.bccache import BytecodeCache, FileSystemBytecodeCache as JinjaFileSystemBytecodeCache
+
+from .utils import write_atomically
+
+def get_compile_key(environment):
+    """
+    Get a key for everything outside of a template's source which is resolved
+    when the template is compiled, from the environment's extensions which
+    provide a ``get_compile_key()`` method - e.g. the static link settings used
+    by ``StaticLinkExtension``.
+    """
+    keys = []
+    for extension in sorted(environment.extensions.values(), key=lambda extension: extension.identifier):
+        get_key = getattr(extension, 'get_compile_key', None)
+        if get_key is not None:
+            keys.append(get_key())
+    return "|".join(keys)
+
+class HierarchyKeyMixin(object):
+    """
+    Generates bytecode cache keys which are safe to use with the template
+    names understood by ``HierarchyLoader`` - e.g. ``eurogamer_parent:base.html``
+    - whose meaning varies by site and hierarchy.
+
+    Keys are a hash of the template name combined with the file the template
+    resolved to, so the same template name resolving to different files for
+    different hierarchies gets a different key.  Where a loader does not
+    provide a filename, a checksum of the template source is used instead.
+
+    Keys also vary on anything that extensions resolve when templates are
+    compiled (see ``get_compile_key()``).
+    """
+
+    def get_cache_key(self, name, filename=None):
+        """
+        Get the cache key for a template.
+
+        Args:
+          * `name` - the template name
+          * `filename` - the filename the template was loaded from, or ``None``
+        """
+        key = sha1(name.encode("utf-8"))
+        key.update(b"|")
+        if filename is not None:
+            key.update(filename.encode("utf-8"))
+        return key.hexdigest()
+
+    def get_bucket(self, environment, name, filename, source):
+        if filename is None:
+            # Without a filename there's nothing to tell apart different
+            # hierarchies' templates with the same name, apart from the source
+            name = "%s|%s" % (name, self.get_source_checksum(source))
+        compile_key = get_compile_key(environment)
+        if compile_key:
+            name = "%s|%s" % (name, sha1(compile_key.encode("utf-8")).hexdigest())
+        return super(HierarchyKeyMixin, self).get_bucket(environment, name, filename, source)
+
+class FileSystemBytecodeCache(HierarchyKeyMixin, JinjaFileSystemBytecodeCache):
+    """
+    Bytecode cache which stores compiled templates as files in a directory.
+
+    Cache files are written atomically, so that many processes can share the
+    same cache directory without reading partially written files.
+
+    Args:
+      * `directory` - string - the directory to store cache files in.  If not
+        given, a private directory in the system temp directory is used.
+      * `pattern` - string - the filename pattern for cache files, where ``%s``
+        is replaced with the cache key.
+    """
+
+    def dump_bytecode(self, bucket):
+        write_atomically(self._get_cache_filename(bucket), bucket.write_bytecode)
+
+class DjangoCacheBytecodeCache(HierarchyKeyMixin, BytecodeCache):
+    """
+    Bytecode cache which stores compiled templates in a django cache, so that
+    they can be shared between processes and hosts - e.g. memcached, redis or,
+    for the processes on one host, a file based cache.
+
+    Cache keys are versioned by the template source checksum, the jinja
+    version and the python version, so an entry never changes once it is
+    written: entries are written with ``cache.add()``, so the first process to
+    compile a template wins, and processes running different versions of a
+    template or of jinja (e.g. during a deploy) don't overwrite each other's
+    entries.
+
+    Args:
+      * `cache_alias` - string - the django cache to use, from the ``CACHES``
+        setting.  Defaults to ``"default"``.
+      * `key_prefix` - string - prefix for the cache keys
+      * `timeout` - int - the cache timeout for compiled templates.  Defaults
+        to the django cache's default timeout.
+      * `compile_lock_timeout` - number of seconds that a process compiling a
+        template holds a lock for, in the cache.  Other processes which need
+        the template meanwhile wait for the compiled template to appear in
+        the cache (for up to this long) rather than compiling it themselves, so
+        each template is compiled once when many workers start at the same
+        time.  The lock is released if compiling the template fails (see
+        ``release_compile_locks()``).  Defaults to ``None`` - no lock.
+    """
+
+    # How often processes waiting for another process to compile a template
+    # check the cache, in seconds
+    compile_lock_poll_interval = 0.05
+
+    def __init__(self, cache_alias='default', key_prefix='jinja2', timeout=DEFAULT_TIMEOUT, compile_lock_timeout=None):
+        self.cache_alias = cache_alias
+        self.key_prefix = key_prefix
+        self.timeout = timeout
+        self.compile_lock_timeout = compile_lock_timeout
+        # The compile locks held by each thread
+        self.held_locks = threading.local()
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def get_version(self):
+        """
+        Get the version of the compiled code format - the jinja and python
+        versions.
+        """
+        return "%s-%s" % (jinja2.__version__, sys.implementation.cache_tag)
+
+    def get_django_cache_key(self, bucket):
+        return "%s:%s:%s:%s" % (self.key_prefix, bucket.key, bucket.checksum, self.get_version())
+
+    def get_lock_key(self, bucket):
+        return "%s:lock" % self.get_django_cache_key(bucket)
+
+    def load_bytecode(self, bucket):
+        key = self.get_django_cache_key(bucket)
+        bytecode = self.cache.get(key)
+        if bytecode is None and self.compile_lock_timeout:
+            lock_key = self.get_lock_key(bucket)
+            if self.cache.add(lock_key, 1, self.compile_lock_timeout):
+                # This process compiles the template
+                self.get_held_locks().add(lock_key)
+                return
+            deadline = time.monotonic() + self.compile_lock_timeout
+            while bytecode is None and time.monotonic() < deadline:
+                time.sleep(self.compile_lock_poll_interval)
+                bytecode = self.cache.get(key)
+        if bytecode is not None:
+            bucket.bytecode_from_string(bytecode)
+
+    def dump_bytecode(self, bucket):
+        try:
+            self.cache.add(self.get_django_cache_key(bucket), bucket.bytecode_to_string(), self.timeout)
+        finally:
+            # Processes which gave up waiting for another process to compile
+            # the template don't hold its lock, so mustn't release it
+            lock_key = self.get_lock_key(bucket)
+            locks = self.get_held_locks()
+            if lock_key in locks:
+                locks.remove(lock_key)
+                self.cache.delete(lock_key)
+
+    def get_held_locks(self):
+        locks = getattr(self.held_locks, 'locks', None)
+        if locks is None:
+            locks = self.held_locks.locks = set()
+        return locks
+
+    def release_compile_locks(self):
+        """
+        Release the compile locks held by this thread - e.g. when compiling a
+        template fails, so that other processes don't wait for it until the
+        lock times out.
+        """
+        locks = self.get_held_locks()
+        while locks:
+            self.cache.delete(locks.pop())
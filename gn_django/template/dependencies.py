@@ -0,0 +1,281 @@
+"""
+Template dependency graph, built from the parsed templates of each hierarchy.
+
+Every template in each hierarchy is parsed, and the templates it refers to with
+``extends``, ``include``, ``import``, ``from ... import``, ``include_with`` and
+``include_raw`` are recorded - including names with the ``<loader>:`` and
+``<loader>_parent:`` prefixes understood by ``HierarchyLoader``.  As the
+template a name resolves to depends on the hierarchy, the graph is kept per
+hierarchy.
+"""
+
+from collections import OrderedDict
+import os
+import threading
+
+from jinja2 import nodes
+from jinja2.exceptions import TemplateSyntaxError
+from django.utils import six
+
+from .extensions import IncludeWithExtension, IncludeRawExtension
+from .loaders import get_hierarchy_loaders
+
+# Dependency kinds which include another template's output
+INCLUDE_KINDS = ('include', 'include_with', 'import')
+
+def get_template_names(node):
+    """
+    Get the constant template names from a template name node, which may be a
+    constant or a list/tuple of constants (e.g. ``{% include ['a.j2', 'b.j2'] %}``).
+    Dynamic template names can't be known until render time, so are skipped.
+    """
+    if isinstance(node, nodes.Const):
+        values = node.value if isinstance(node.value, (list, tuple)) else [node.value]
+    elif isinstance(node, (nodes.Tuple, nodes.List)):
+        values = [item.value for item in node.items if isinstance(item, nodes.Const)]
+    else:
+        values = []
+    return [value for value in values if isinstance(value, six.string_types)]
+
+def find_template_dependencies(ast):
+    """
+    Find the templates (and raw files) referred to by a parsed template.
+
+    Args:
+      * `ast` - the parsed template, from ``environment.parse()``
+
+    Returns a list of ``(kind, name)`` pairs, where kind is one of ``extends``,
+    ``include``, ``import``, ``include_with`` or ``include_raw``.
+    """
+    dependencies = []
+    kinds = (
+        (nodes.Extends, 'extends'),
+        (nodes.Include, 'include'),
+        (nodes.Import, 'import'),
+        (nodes.FromImport, 'import'),
+    )
+    extension_kinds = {
+        (IncludeWithExtension.identifier, '_render'): 'include_with',
+        (IncludeRawExtension.identifier, '_get_file'): 'include_raw',
+    }
+    for node in ast.find_all((nodes.Extends, nodes.Include, nodes.Import, nodes.FromImport, nodes.CallBlock)):
+        if isinstance(node, nodes.CallBlock):
+            call = node.call
+            if not isinstance(call.node, nodes.ExtensionAttribute) or not call.args:
+                continue
+            kind = extension_kinds.get((call.node.identifier, call.node.name))
+            if kind is None:
+                continue
+            names = get_template_names(call.args[0])
+        else:
+            kind = next(kind for node_class, kind in kinds if isinstance(node, node_class))
+            names = get_template_names(node.template)
+        for name in names:
+            if (kind, name) not in dependencies:
+                dependencies.append((kind, name))
+    return dependencies
+
+class TemplateDependencyGraph(object):
+    """
+    The dependencies between the templates of an environment's hierarchies.
+
+    The graph is built the first time it is used.  ``invalidate()`` marks it to
+    be rebuilt - only templates whose files have changed since they were last
+    parsed are parsed again.
+
+    Args:
+      * `environment` - the jinja environment, whose loader is a
+        ``HierarchyLoader`` or ``MultiHierarchyLoader``
+    """
+
+    def __init__(self, environment):
+        self.environment = environment
+        self.filenames = {}
+        self.dependencies = {}
+        self.dependents = {}
+        self.built = False
+        self.lock = threading.RLock()
+        # Parsed dependencies, keyed by filename, with the file's mtime
+        self._parsed = {}
+
+    def get_hierarchies(self):
+        hierarchies = get_hierarchy_loaders(self.environment.loader, built_only=True)
+        hierarchy_name = getattr(self.environment, 'hierarchy_name', None)
+        if hierarchy_name is not None and list(hierarchies) == [None]:
+            hierarchies = OrderedDict(((hierarchy_name, hierarchies[None]),))
+        return hierarchies
+
+    def build(self):
+        """
+        Parse every template in every hierarchy, and record their dependencies.
+        """
+        with self.lock:
+            filenames = {}
+            dependencies = {}
+            parsed = {}
+            for hierarchy_name, hierarchy in self.get_hierarchies().items():
+                for name, (loader_name, template_name) in hierarchy.resolve_templates().items():
+                    loader = hierarchy.hierarchy[loader_name]
+                    filename, template_dependencies = self.parse_template(loader, template_name, parsed)
+                    filenames[(hierarchy_name, name)] = filename
+                    dependencies[(hierarchy_name, name)] = template_dependencies
+
+            dependents = {}
+            for (hierarchy_name, name), template_dependencies in dependencies.items():
+                for kind, dependency in template_dependencies:
+                    if kind == 'include_raw':
+                        continue
+                    dependents.setdefault((hierarchy_name, dependency), set()).add((hierarchy_name, name))
+
+            self.filenames = filenames
+            self.dependencies = dependencies
+            self.dependents = dependents
+            self.built = True
+
+    def parse_template(self, loader, template_name, parsed):
+        """
+        Get the filename and dependencies of a template from a loader, reusing
+        previously parsed dependencies if the file hasn't changed.
+
+        Args:
+          * `loader` - the loader in the hierarchy which has the template
+          * `template_name` - the template name within the loader
+          * `parsed` - dictionary of templates parsed so far during this build,
+            keyed by loader search path and template name
+        """
+        key = (tuple(getattr(loader, 'searchpath', [id(loader)])), template_name)
+        if key in parsed:
+            return parsed[key]
+        filename = None
+        for searchpath in getattr(loader, 'searchpath', []):
+            path = os.path.join(searchpath, *template_name.split('/'))
+            if os.path.isfile(path):
+                filename = path
+                break
+        mtime = None
+        if filename is not None:
+            mtime = os.path.getmtime(filename)
+            previous = self._parsed.get(filename)
+            if previous is not None and previous[0] == mtime:
+                parsed[key] = (filename, previous[1])
+                return parsed[key]
+
+        source, filename, _ = loader.get_source(self.environment, template_name)
+        try:
+            template_dependencies = find_template_dependencies(
+                self.environment.parse(source, template_name, filename)
+            )
+        except TemplateSyntaxError:
+            template_dependencies = []
+        if filename is not None:
+            self._parsed[filename] = (mtime, template_dependencies)
+        parsed[key] = (filename, template_dependencies)
+        return parsed[key]
+
+    def ensure_built(self):
+        if not self.built:
+            self.build()
+
+    def invalidate(self):
+        """
+        Mark the graph to be rebuilt the next time it is used - e.g. when
+        templates have been changed, added or removed.
+        """
+        self.built = False
+
+    def get_dependencies(self, hierarchy_name, name):
+        """
+        Get the direct dependencies of a template, as a list of ``(kind, name)``
+        pairs.
+        """
+        self.ensure_built()
+        return list(self.dependencies.get((hierarchy_name, name), []))
+
+    def get_dependents(self, hierarchy_name, name):
+        """
+        Get all of the templates which depend on a template, directly or
+        indirectly, as a set of ``(hierarchy_name, name)`` pairs.
+        """
+        self.ensure_built()
+        dependents = set()
+        pending = [(hierarchy_name, name)]
+        while pending:
+            for dependent in self.dependents.get(pending.pop(), ()):
+                if dependent not in dependents:
+                    dependents.add(dependent)
+                    pending.append(dependent)
+        return dependents
+
+    def get_affected_templates(self, filenames):
+        """
+        Get the templates which are affected by changes to the given files -
+        the templates which resolve to the files, and all of the templates
+        which depend on them.
+
+        Args:
+          * `filenames` - iterable of changed template filenames
+
+        Returns a set of ``(hierarchy_name, name)`` pairs.
+        """
+        self.ensure_built()
+        filenames = set(filenames)
+        affected = set(key for key, filename in self.filenames.items() if filename in filenames)
+        for hierarchy_name, name in list(affected):
+            affected.update(self.get_dependents(hierarchy_name, name))
+        return affected
+
+    def get_load_order(self, hierarchy_name, names):
+        """
+        Order templates so that each template comes after the templates it
+        depends on, including those dependencies - e.g. for warming up
+        templates.
+
+        Args:
+          * `hierarchy_name` - the hierarchy to load the templates from
+          * `names` - iterable of template names
+
+        Returns a list of template names.
+        """
+        self.ensure_built()
+        order = []
+        visiting = set()
+
+        def visit(name):
+            if name in order or name in visiting:
+                return
+            visiting.add(name)
+            for kind, dependency in self.dependencies.get((hierarchy_name, name), []):
+                if kind != 'include_raw' and (hierarchy_name, dependency) in self.filenames:
+                    visit(dependency)
+            visiting.discard(name)
+            order.append(name)
+
+        for name in names:
+            visit(name)
+        return order
+
+    def get_most_included(self, limit=None):
+        """
+        Get the template files which are included (with ``include``,
+        ``include_with`` or ``import``) by the most other template files,
+        across all hierarchies.
+
+        Args:
+          * `limit` - the number of templates to return.  Defaults to all of them.
+
+        Returns a list of ``(filename, count)`` pairs, most included first.
+        """
+        self.ensure_built()
+        including = {}
+        for (hierarchy_name, name), template_dependencies in self.dependencies.items():
+            for kind, dependency in template_dependencies:
+                if kind not in INCLUDE_KINDS:
+                    continue
+                filename = self.filenames.get((hierarchy_name, dependency))
+                if filename is not None:
+                    including.setdefault(filename, set()).add(self.filenames[(hierarchy_name, name)])
+        most_included = sorted(
+            ((filename, len(includers)) for filename, includers in including.items()),
+            key=lambda item: (-item[1], item[0]),
+        )
+        return most_included[:limit] if limit is not None else most_included
@@ -1,16 +1,35 @@
-from jinja2 import nodes, exceptions, runtime, environment
+from jinja2 import nodes, exceptions, runtime, environment, lexer
 from jinja2.ext import Extension
+from jinja2.utils import Markup, concat, escape
+from jinja2.exceptions import TemplateSyntaxError
 from django.conf import settings as dj_settings
 from django.core import exceptions
+from django.contrib.staticfiles.storage import staticfiles_storage, HashedFilesMixin
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.core.cache.utils import make_template_fragment_key
+from django.utils import six
+from django.utils.encoding import force_text
+from django.utils.module_loading import import_string
 from django.utils.safestring import mark_safe
 
-import re, time, os
+from gn_django.site import get_current_site
+from .loaders import MultiHierarchyLoader
+from .minify import HTMLMinifier
+from .raw_files import RawFileCache
+from .static_manifest import StaticManifest, get_hashed_name
+
+import asyncio, re
+from fnmatch import fnmatch
+from functools import lru_cache
 
 class SpacelessExtension(Extension):
     """
     Removes whitespace between HTML tags at compile time, including tab and newline characters.
     It does not remove whitespace between jinja2 tags or variables. Neither does it remove whitespace between tags
     and their text content.
+    Blocks with no dynamic output are replaced by their stripped output.  Otherwise the static parts of the block
+    are stripped at compile time, and the rendered block is stripped again, as dynamic output may contain tags.
     Adapted from coffin:
         https://github.com/coffin/coffin/blob/master/coffin/template/defaulttags.py
     Usage:
@@ -19,16 +38,131 @@ class SpacelessExtension(Extension):
 
     tags = set(['spaceless'])
 
+    space_between_tags = re.compile(r'>\s+<')
+    opaque_nodes = (nodes.Block, nodes.Macro, nodes.CallBlock, nodes.AssignBlock)
+
     def parse(self, parser):
         lineno = next(parser.stream).lineno
         body = parser.parse_statements(['name:endspaceless'], drop_needle=True)
+
+        # Blocks with no dynamic output are stripped entirely at compile time
+        if all(isinstance(node, nodes.Output) for node in body):
+            children = [child for node in body for child in node.nodes]
+            if all(isinstance(child, nodes.TemplateData) for child in children):
+                html = self._strip(''.join(child.data for child in children))
+                return nodes.Output([nodes.TemplateData(html)]).set_lineno(lineno)
+
+        # Otherwise, the static parts of the block are stripped at compile
+        # time, and the rendered block is stripped again - variables (e.g.
+        # ``|safe`` HTML, ``super()`` or ``caller()``) and other statements
+        # render output which may contain tags
+        self._strip_template_data(body)
         return nodes.CallBlock(
             self.call_method('_strip_spaces', [], [], None, None),
             [], [], body,
         ).set_lineno(lineno)
 
+    def _strip(self, html):
+        return self.space_between_tags.sub('><', html.strip())
+
+    def _strip_template_data(self, body):
+        """
+        Strip whitespace between tags within the static parts of a block, so
+        that there is less to search when the block is rendered.
+        """
+        for output in self._find_outputs(body):
+            for child in output.nodes:
+                if isinstance(child, nodes.TemplateData):
+                    child.data = self.space_between_tags.sub('><', child.data)
+
+    def _find_outputs(self, body):
+        """
+        Find the output nodes which are rendered straight in to a block.
+        Blocks, macros, call blocks and set blocks are skipped, as where their
+        output ends up isn't known at compile time.
+        """
+        for node in body:
+            if isinstance(node, self.opaque_nodes):
+                continue
+            if isinstance(node, nodes.Output):
+                yield node
+            else:
+                for output in self._find_outputs(node.iter_child_nodes()):
+                    yield output
+
     def _strip_spaces(self, caller=None):
-        return re.sub(r'>\s+<', '><', caller().strip())
+        if self.environment.is_async:
+            return self._strip_spaces_async(caller)
+        return self._strip(caller())
+
+    async def _strip_spaces_async(self, caller):
+        return self._strip(await caller())
+
+class HTMLMinifyExtension(Extension):
+    """
+    Minifies the static HTML in HTML templates at compile time - removing
+    comments, and collapsing whitespace between tags and indentation - while
+    leaving the contents of `<pre>`, `<textarea>`, `<script>` and `<style>`
+    elements alone.  Template variables and tags are not minified, so there is
+    no cost when rendering.
+
+    Only templates whose names match one of the environment's
+    `minify_html_patterns` (`fnmatch` patterns), and none of its
+    `minify_html_exclude_patterns`, are minified - so that e.g. plain text
+    email templates (`welcome.txt.j2`) and scripts (`app.js.j2`) are left
+    alone.  Templates without a name (from `from_string()`) are minified.
+
+    Enabled with the `minify_html` option of the `Jinja2` backend.
+    """
+
+    default_patterns = ('*.html', '*.htm', '*.j2', '*.jinja', '*.jinja2')
+    # Templates of other types, which are named with their type before the
+    # template extension - e.g. ``welcome.txt.j2``
+    default_exclude_patterns = tuple(
+        pattern % ext
+        for ext in ('txt', 'text', 'md', 'js', 'json', 'xml', 'css', 'csv', 'ics')
+        for pattern in ('*.%s', '*.%s.*')
+    )
+
+    def __init__(self, environment):
+        super(HTMLMinifyExtension, self).__init__(environment)
+        environment.extend(
+            minify_html_patterns=self.default_patterns,
+            minify_html_exclude_patterns=self.default_exclude_patterns,
+        )
+
+    def should_minify(self, name):
+        """
+        Check whether a template should be minified.
+
+        Params:
+            - `name` - The template name, or `None`
+        """
+        if name is None:
+            return True
+        if any(fnmatch(name, pattern) for pattern in self.environment.minify_html_exclude_patterns):
+            return False
+        return any(fnmatch(name, pattern) for pattern in self.environment.minify_html_patterns)
+
+    def filter_stream(self, stream):
+        if not self.should_minify(stream.name):
+            return stream
+        return self._minify_stream(stream)
+
+    def _minify_stream(self, stream):
+        minifier = HTMLMinifier()
+        for token in stream:
+            if token.type == 'data':
+                yield lexer.Token(token.lineno, 'data', minifier.minify(token.value))
+            else:
+                minifier.interrupt()
+                yield token
+
+    def get_compile_key(self):
+        return 'minify_html:%r:%r' % (
+            tuple(self.environment.minify_html_patterns),
+            tuple(self.environment.minify_html_exclude_patterns),
+        )
 
 class IncludeWithExtension(Extension):
     """
@@ -49,23 +183,59 @@ class IncludeWithExtension(Extension):
 
         # Grab the context variables
         context = self._get_params(parser)
-        call = self.call_method('_render', [template, context], lineno=first.lineno)
+        args = [template, context]
+        if isinstance(template, nodes.Const) and isinstance(template.value, str):
+            # Constant template names are only resolved once per render, so
+            # the including template's context is needed to keep them in
+            args.append(nodes.ContextReference())
+        call = self.call_method('_render', args, lineno=first.lineno)
 
         return nodes.CallBlock(call, [], [], [], lineno=first.lineno)
 
-    def _render(self, template, context, caller):
+    def _render(self, template, context, render_context=None, caller=None):
         """
         Render the template with context variables
 
         Params:
             - `template` - The name of the template to render
             - `context` - The context to pass to the template
+            - `render_context` - The including template's context, to keep the
+               resolved template in, for constant template names
             - `caller` - Required by Jinja2
 
         Returns:
             - The parsed template
         """
-        return self.environment.get_template(template).render(context)
+        if render_context is None:
+            template = self.environment.get_template(template)
+        else:
+            template = self._get_render_template(template, render_context)
+
+        if self.environment.is_async:
+            return template.render_async(context)
+        if getattr(self.environment, 'instrumentation', None) is not None:
+            # Render through the template so that the render is recorded
+            return template.render(context)
+        # Exceptions are handled by the including template's render
+        return concat(template.root_render_func(template.new_context(context)))
+
+    def _get_render_template(self, name, render_context):
+        """
+        Get a template from the templates already resolved while rendering the
+        including template (e.g. by earlier iterations of a loop), or the
+        environment.
+
+        Params:
+            - `name` - The name of the template
+            - `render_context` - The including template's context
+        """
+        templates = getattr(render_context, '_include_with_templates', None)
+        if templates is None:
+            templates = render_context._include_with_templates = {}
+        template = templates.get(name)
+        if template is None:
+            template = templates[name] = self.environment.get_template(name)
+        return template
 
     def _get_params(self, parser):
         """
@@ -94,6 +264,34 @@ class IncludeWithExtension(Extension):
 
         return kwargs
 
+@lru_cache(maxsize=1024)
+def get_static_url(path):
+    """
+    Get the URL of a static file from the static files storage.  URLs are
+    cached, as building them can be costly (e.g. for a storage with a manifest).
+
+    Params:
+        - `path` - The path of the static file
+    """
+    return staticfiles_storage.url(path)
+
+@lru_cache(maxsize=None)
+def get_static_manifest():
+    """
+    Get the content hash manifest given by the `STATICLINK_MANIFEST` setting,
+    or `None` if it is not set.
+    """
+    path = getattr(dj_settings, 'STATICLINK_MANIFEST', None)
+    if not path:
+        return None
+    return StaticManifest(path)
+
+def clear_static_link_caches(**kwargs):
+    get_static_url.cache_clear()
+    get_static_manifest.cache_clear()
+
+setting_changed.connect(clear_static_link_caches)
+
 class StaticLinkExtension(Extension):
     """
     Extension for linking to static assets within a template, with the ability to
@@ -112,15 +310,53 @@ class StaticLinkExtension(Extension):
     def parse(self, parser):
         first = parser.parse_expression()
         if first.name == 'load_compilers':
-            call = self.call_method('_load_compilers', lineno=first.lineno)
-        else:
-            name = parser.parse_expression()
-            # Method to call follows pattern of tag name preceeded with underscore
-            call = self.call_method('_%s' % first.name, [name], lineno=first.lineno)
-
+            # Settings are known by the time templates are compiled, so the
+            # output is a constant
+            return nodes.Output([nodes.TemplateData(self._get_compilers_html())], lineno=first.lineno)
+
+        name = parser.parse_expression()
+        if isinstance(name, nodes.Const) and isinstance(name.value, str) and self._can_resolve_at_compile_time():
+            # Constant asset names are resolved to constant output, unless the
+            # extension is misconfigured or the asset is missing - in which
+            # case the error is raised when rendering, as it is for dynamic names
+            try:
+                html = self._get_link_html(first.name, name.value)
+            except (exceptions.ImproperlyConfigured, ValueError):
+                pass
+            else:
+                return nodes.Output([nodes.TemplateData(html)], lineno=first.lineno)
+
+        # Method to call follows pattern of tag name preceeded with underscore
+        call = self.call_method('_%s' % first.name, [name], lineno=first.lineno)
         return nodes.CallBlock(call, [], [], [], lineno=first.lineno)
 
-    def _css(self, name, caller):
+    def _can_resolve_at_compile_time(self):
+        """
+        Check whether asset URLs only depend on settings, so can be resolved
+        when templates are compiled.  With a `STATICLINK_MANIFEST` manifest or
+        a storage which hashes file names (e.g. `ManifestStaticFilesStorage`),
+        URLs change when the static files do - e.g. after a `collectstatic` -
+        and compiled templates may outlive that in a bytecode cache, so they
+        are resolved when rendering.
+        """
+        if get_static_manifest() is not None:
+            return False
+        return not isinstance(staticfiles_storage, HashedFilesMixin)
+
+    def get_compile_key(self):
+        """
+        Get a key for the settings which are resolved when templates are
+        compiled, so that bytecode caches don't use templates compiled with
+        different settings.
+        """
+        return repr([
+            getattr(dj_settings, setting, None) for setting in (
+                'DEBUG', 'STATIC_URL', 'STATICFILES_STORAGE', 'STATICLINK_DEBUG', 'STATICLINK_FILE_MAP',
+                'STATICLINK_PREPROCESSORS', 'STATICLINK_CLIENT_COMPILERS', 'STATICLINK_VERSION', 'STATICLINK_MANIFEST',
+            )
+        ])
+
+    def _css(self, name, caller=None):
         """
         Render link tags for stylesheets. If debug mode is enabled this will be
         the uncompiled version of the file.
@@ -129,16 +365,9 @@ class StaticLinkExtension(Extension):
             - `name` - The name of the file
             - `caller` - Required by Jinja
         """
-        ext = 'css'
-        if self._is_debug(ext):
-            ext = self._get_preprocessor(ext)
-        file_dir = self._get_file_dir(ext)
+        return Markup(self._get_link_html('css', name))
 
-        template = '<link href="{{ static("%s/%s.%s") }}?v=%s" rel="stylesheet" type="text/%s" />' % (file_dir, name, ext, self._get_version(), ext)
-
-        return self.environment.from_string(template).render()
-
-    def _js(self, name, caller):
+    def _js(self, name, caller=None):
         """
         Render script tags for JavaScript
 
@@ -146,35 +375,62 @@ class StaticLinkExtension(Extension):
             - `name` - The name of the file
             - `caller` - Required by Jinja
         """
-        ext = 'js'
-        file_dir = self._get_file_dir(ext)
-        script_type = 'application/javascript'
-        template = '<script src="{{ static("%s/%s.%s") }}?v=%s" type="%s"></script>' % (file_dir, name, ext, self._get_version(), script_type)
-
-        return self.environment.from_string(template).render()
+        return Markup(self._get_link_html('js', name))
 
-    def _load_compilers(self, caller):
+    def _load_compilers(self, caller=None):
         """
         If debug mode is enabled, inject front end compilers.
 
         Params:
             - `caller` - Required by Jinja
         """
+        return Markup(self._get_compilers_html())
+
+    def _get_link_html(self, tag, name):
+        """
+        Get the HTML for a `css` or `js` tag.
+
+        Params:
+            - `tag` - The tag name, `css` or `js`
+            - `name` - The name of the file
+        """
+        ext = tag
+        if tag == 'css' and self._is_debug(ext):
+            ext = self._get_preprocessor(ext)
+        path = '%s/%s.%s' % (self._get_file_dir(ext), name, ext)
+        manifest = get_static_manifest()
+        file_hash = manifest.get_hash(path) if manifest is not None else None
+
+        if file_hash is None:
+            url = '%s?v=%s' % (escape(get_static_url(path)), self._get_version())
+        elif getattr(dj_settings, 'STATICLINK_MANIFEST_HASHED_FILENAMES', False):
+            url = escape(get_static_url(get_hashed_name(path, file_hash)))
+        else:
+            url = '%s?v=%s' % (escape(get_static_url(path)), file_hash)
 
+        if tag == 'css':
+            return '<link href="%s" rel="stylesheet" type="text/%s" />' % (url, ext)
+        return '<script src="%s" type="application/javascript"></script>' % url
+
+    def _get_compilers_html(self):
+        """
+        Get the HTML for the `load_compilers` tag - front end compilers if
+        debug mode is enabled.
+        """
         debug = dj_settings.DEBUG
-        template = ''
+        html = ''
 
         if hasattr(dj_settings, 'STATICLINK_CLIENT_COMPILERS'):
             for ext in dj_settings.STATICLINK_CLIENT_COMPILERS:
                 if self._is_debug(ext):
                     debug = True
                     compiler = dj_settings.STATICLINK_CLIENT_COMPILERS[ext]
-                    template = '%s\n<script src="%s"></script>' % (template, compiler)
+                    html = '%s\n<script src="%s"></script>' % (html, compiler)
 
         if debug:
-            template = "%s\n<script>localStorage.clear();</script>" % template
+            html = "%s\n<script>localStorage.clear();</script>" % html
 
-        return self.environment.from_string(template).render()
+        return html
 
     def _is_debug(self, ext):
         """
@@ -218,7 +474,8 @@ class StaticLinkExtension(Extension):
     def _get_version(self):
         """
         Get the version number to append to the static file URLs. This is defined
-        in the `STATICLINK_VERSION` setting, and defaults to "latest".
+        in the `STATICLINK_VERSION` setting, and defaults to "latest".  Files in
+        the `STATICLINK_MANIFEST` manifest use their content hash instead.
         """
         if hasattr(dj_settings, 'STATICLINK_VERSION'):
             return dj_settings.STATICLINK_VERSION
@@ -235,6 +492,9 @@ class IncludeRawExtension(Extension):
     Params:
         - `path/to/file.css` - Relative path to the file within a directory
            defined in the `STATICFILES_DIRS` setting.
+
+    Files can be minified (or otherwise processed) by file type, with the
+    `INCLUDE_RAW_PROCESSORS` setting.
     """
 
     tags = set(['include_raw'])
@@ -247,22 +507,151 @@ class IncludeRawExtension(Extension):
 
     def _get_file(self, path, caller):
         """
-        Check if a file exists an the specified path, and if so then open it and
-        render the contents.
+        Get the contents of the file at the specified path, from the process's
+        raw file cache.  When the environment is async, files which aren't
+        cached are read in a thread so that the event loop isn't blocked.
 
         Params:
             - `path` - The path to the file
             - `caller` - Required by Jinja
         """
-        output = ''
+        cache = get_raw_file_cache()
+        if self.environment.is_async:
+            content = cache.get_cached(path)
+            if content is not None:
+                return self._get_cached_async(content)
+            return asyncio.get_event_loop().run_in_executor(None, cache.get, path)
+        return cache.get(path)
+
+    async def _get_cached_async(self, content):
+        return content
+
+@lru_cache(maxsize=None)
+def get_raw_file_cache():
+    """
+    Get the process's cache of files for `include_raw`, configured by the
+    `INCLUDE_RAW_*` settings.
+    """
+    processors = {}
+    for ext, processor in getattr(dj_settings, 'INCLUDE_RAW_PROCESSORS', {}).items():
+        processors[ext.lstrip('.')] = import_string(processor) if isinstance(processor, six.string_types) else processor
+    return RawFileCache(
+        max_size=getattr(dj_settings, 'INCLUDE_RAW_CACHE_MAX_SIZE', None),
+        check_interval=getattr(dj_settings, 'INCLUDE_RAW_CHECK_INTERVAL', 1),
+        processors=processors,
+        cache_dir=getattr(dj_settings, 'INCLUDE_RAW_CACHE_DIR', None),
+        report=getattr(dj_settings, 'INCLUDE_RAW_REPORT', False),
+    )
+
+def clear_raw_file_cache(setting, **kwargs):
+    if setting == 'STATICFILES_DIRS' or setting.startswith('INCLUDE_RAW_'):
+        get_raw_file_cache.cache_clear()
+
+setting_changed.connect(clear_raw_file_cache)
+
+def get_fragment_cache():
+    """
+    Get the django cache that template fragments are cached in - the cache
+    named by the `TEMPLATE_FRAGMENT_CACHE` setting if it is set, otherwise the
+    `template_fragments` cache if there is one (as with django's own ``cache``
+    tag), otherwise the default cache.
+    """
+    alias = getattr(dj_settings, 'TEMPLATE_FRAGMENT_CACHE', None)
+    if alias is None:
+        alias = 'template_fragments' if 'template_fragments' in dj_settings.CACHES else 'default'
+    return caches[alias]
+
+def get_fragment_cache_key(fragment_name, vary_on=(), site=None, hierarchy=None):
+    """
+    Get the cache key for a fragment cached with the ``cache`` tag - e.g. to
+    delete it from the cache.
+
+    Params:
+        - `fragment_name` - The fragment name given to the tag
+        - `vary_on` - The values the fragment varies on, given to the tag
+        - `site` - The site the fragment was rendered for
+        - `hierarchy` - The template hierarchy the fragment was rendered with
+    """
+    return make_template_fragment_key(fragment_name, [site, hierarchy] + list(vary_on))
+
+class FragmentCacheExtension(Extension):
+    """
+    Caches a rendered template fragment in a django cache.  Cache keys include
+    the current site and the active template hierarchy, so each site caches its
+    own copy of the fragment.
+
+    Usage:
+        ``{% cache "sidebar", 300, user.is_staff %}...{% endcache %}``
+
+    Params:
+        - `"sidebar"` - The fragment name
+        - `300` - The cache timeout, in seconds
+        - `user.is_staff` - Any number of values to vary the cache key on
+
+    django-jinja's syntax, ``{% cache 300 "sidebar" user.is_staff %}``, is also
+    supported.  Fragments are cached in the cache given by `get_fragment_cache()`.
+    """
+
+    tags = set(['cache'])
 
-        if hasattr(dj_settings, 'STATICFILES_DIRS'):
-            for static_dir in dj_settings.STATICFILES_DIRS:
-                fp = os.path.join(static_dir, path)
-                if os.path.isfile(fp):
-                    f = open(fp, 'r')
-                    output = f.read()
-                    f.close()
-                    break
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        first = parser.parse_expression()
+        vary_on = []
+        if parser.stream.skip_if('comma'):
+            fragment_name = first
+            expire_time = parser.parse_expression()
+            while parser.stream.skip_if('comma'):
+                vary_on.append(parser.parse_expression())
+        else:
+            expire_time = first
+            fragment_name = parser.parse_expression()
+            while not parser.stream.current.test('block_end'):
+                vary_on.append(parser.parse_expression())
+
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        call = self.call_method('_cache', [fragment_name, expire_time, nodes.List(vary_on), nodes.Const(lineno)])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
 
-        return output
+    def _cache(self, fragment_name, expire_time, vary_on, lineno, caller):
+        """
+        Get the fragment from the cache, or render and cache it.
+
+        Params:
+            - `fragment_name` - The fragment name
+            - `expire_time` - The cache timeout, in seconds
+            - `vary_on` - The values to vary the cache key on
+            - `lineno` - The line number of the tag, for errors
+            - `caller` - Renders the fragment
+        """
+        try:
+            expire_time = int(expire_time)
+        except (ValueError, TypeError):
+            raise TemplateSyntaxError('"cache" tag got a non-integer timeout value: %r' % (expire_time,), lineno)
+
+        cache = get_fragment_cache()
+        cache_key = get_fragment_cache_key(fragment_name, vary_on, get_current_site(), self._get_hierarchy())
+        value = cache.get(cache_key)
+        if value is not None:
+            return force_text(value)
+        if self.environment.is_async:
+            return self._cache_async(cache, cache_key, expire_time, caller)
+        value = caller()
+        cache.set(cache_key, force_text(value), expire_time)
+        return value
+
+    async def _cache_async(self, cache, cache_key, expire_time, caller):
+        value = await caller()
+        cache.set(cache_key, force_text(value), expire_time)
+        return value
+
+    def _get_hierarchy(self):
+        """
+        Get the name of the template hierarchy that templates are being loaded
+        from, if there is one.
+        """
+        hierarchy_name = getattr(self.environment, 'hierarchy_name', None)
+        loader = self.environment.loader
+        if hierarchy_name is None and isinstance(loader, MultiHierarchyLoader):
+            hierarchy_name = loader.get_active_hierarchy()
+        return hierarchy_name
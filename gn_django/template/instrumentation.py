@@ -0,0 +1,200 @@
+"""
+Instrumentation for template loading and rendering.
+
+When the jinja environment is given an ``instrumentation`` sink, it records the
+time taken for each of these events, per template:
+
+  * ``cache_hit`` - a template was fetched from the environment's template cache
+  * ``load`` - a template's source was loaded by the template loader
+  * ``compile`` - a template was compiled (or fetched from the bytecode cache)
+  * ``render`` - a template was rendered
+
+Each event is tagged with the ``site`` (the active hierarchy name) and the
+hierarchy ``level`` (the name of the loader in the hierarchy that the template
+was loaded from), where they are known.  Without a sink, nothing is recorded.
+"""
+
+import bisect
+import logging
+import socket
+import threading
+
+class BaseSink(object):
+    """
+    Base class for instrumentation sinks, which are given the timings of
+    template events.
+    """
+
+    def record(self, event, template_name, duration, tags):
+        """
+        Record the timing of a template event.
+
+        Args:
+          * `event` - string - the event name, e.g. ``render``
+          * `template_name` - the template name
+          * `duration` - float - the time taken, in seconds
+          * `tags` - dictionary of tag name to value - e.g. ``site`` and ``level``
+        """
+        raise NotImplementedError()
+
+class MultiSink(BaseSink):
+    """
+    Sink which passes timings on to many sinks.
+
+    Args:
+      * `sinks` - the sinks to record timings with
+    """
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def record(self, event, template_name, duration, tags):
+        for sink in self.sinks:
+            sink.record(event, template_name, duration, tags)
+
+class LoggingSink(BaseSink):
+    """
+    Sink which logs each timing.
+
+    Args:
+      * `logger` - string - the name of the logger to log to
+      * `level` - int - the log level to log at.  Defaults to ``logging.DEBUG``
+    """
+
+    def __init__(self, logger='gn_django.template', level=logging.DEBUG):
+        self.logger = logging.getLogger(logger)
+        self.level = level
+
+    def record(self, event, template_name, duration, tags):
+        if not self.logger.isEnabledFor(self.level):
+            return
+        tag_string = " ".join("%s=%s" % (key, value) for key, value in sorted(tags.items()))
+        self.logger.log(self.level, "template %s %s %.2fms %s", event, template_name, duration * 1000, tag_string)
+
+class Histogram(object):
+    """
+    A latency histogram, counting timings in buckets.
+
+    Args:
+      * `buckets` - sorted iterable of bucket upper bounds, in milliseconds.
+        Timings above the largest bound are counted in an overflow bucket.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, duration):
+        """
+        Add a timing to the histogram.
+
+        Args:
+          * `duration` - float - the time taken, in seconds
+        """
+        milliseconds = duration * 1000
+        self.counts[bisect.bisect_left(self.buckets, milliseconds)] += 1
+        self.count += 1
+        self.total += milliseconds
+        if self.min is None or milliseconds < self.min:
+            self.min = milliseconds
+        if self.max is None or milliseconds > self.max:
+            self.max = milliseconds
+
+    @property
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def get_bucket_counts(self):
+        """
+        Get the counts for each bucket, as a list of pairs of bucket upper bound
+        (``None`` for the overflow bucket) and count.
+        """
+        return list(zip(self.buckets + (None,), self.counts))
+
+class InMemorySink(BaseSink):
+    """
+    Sink which keeps a count and latency histogram per event, template and
+    tags in memory - e.g. for a debug view or tests.
+
+    Args:
+      * `buckets` - sorted iterable of histogram bucket upper bounds, in
+        milliseconds
+    """
+
+    DEFAULT_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def get_key(self, event, template_name, tags):
+        return (event, template_name, tuple(sorted(tags.items())))
+
+    def record(self, event, template_name, duration, tags):
+        key = self.get_key(event, template_name, tags)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.add(duration)
+
+    def get_histogram(self, event, template_name, **tags):
+        """
+        Get the histogram for an event, template and tags, or ``None`` if
+        nothing has been recorded for them.
+        """
+        return self.histograms.get(self.get_key(event, template_name, tags))
+
+    def get_count(self, event, template_name=None):
+        """
+        Get the number of times an event has been recorded, for all templates
+        or just the given template.
+        """
+        return sum(
+            histogram.count for (key_event, key_name, _), histogram in list(self.histograms.items())
+            if key_event == event and template_name in (None, key_name)
+        )
+
+    def reset(self):
+        """
+        Forget all of the recorded timings.
+        """
+        with self.lock:
+            self.histograms = {}
+
+class StatsdSink(BaseSink):
+    """
+    Sink which sends timings to a StatsD server over UDP, as timers with
+    DogStatsD style tags - e.g.
+    ``gn_django.template.render:12.50|ms|#template:article.j2,site:eurogamer_net``.
+
+    Sending is fire and forget; timings are dropped if they can't be sent.
+
+    Args:
+      * `host` - string - the StatsD server host
+      * `port` - int - the StatsD server port
+      * `prefix` - string - prefix for the metric names
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='gn_django.template'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def format(self, event, template_name, duration, tags):
+        tags = dict(tags, template=template_name)
+        tag_string = ",".join("%s:%s" % (key, value) for key, value in sorted(tags.items()))
+        return "%s.%s:%.2f|ms|#%s" % (self.prefix, event, duration * 1000, tag_string)
+
+    def record(self, event, template_name, duration, tags):
+        try:
+            self.socket.sendto(self.format(event, template_name, duration, tags).encode('utf-8'), self.address)
+        except (OSError, socket.error):
+            pass
@@ -4,18 +4,45 @@ functionality.
 """
 
 from collections import OrderedDict
+from collections.abc import Mapping
+from contextlib import contextmanager
+import os
+import threading
+import time
+import weakref
+import zipfile
 
+from django.conf import settings
 from django.utils import six
 from django.utils.module_loading import import_string
 from django.core.exceptions import ImproperlyConfigured
-from jinja2.loaders import BaseLoader, TemplateNotFound, iteritems, FileSystemLoader
+from jinja2.loaders import BaseLoader, TemplateNotFound, iteritems, FileSystemLoader, split_template_path
+from jinja2.utils import LRUCache
 import re
 
+from .bundles import TemplateBundle, find_templates, is_template_bundle
+
 """
 Cached store of FileSystemLoader instanced, with template directories as keys
 """
 file_system_loaders = {}
 
+"""
+Cached store of SnapshotLoader instances, with template directories as keys
+"""
+snapshot_loaders = {}
+
+"""
+Cached store of archive loaders (``ZipLoader`` and ``BundleLoader``), with
+archive paths as keys
+"""
+archive_loaders = {}
+
+"""
+Every ``ZipLoader``, so that their zip files can be reopened in forked processes
+"""
+zip_loaders = weakref.WeakSet()
+
 class DjangoTemplateNotFound(TemplateNotFound):
     """
     Adds a `tried` attribute to our `TemplateNotFound` exception - which allows
@@ -27,6 +54,75 @@ class DjangoTemplateNotFound(TemplateNotFound):
         if tried:
             self.tried = tried
 
+class NegativeLookupCache(object):
+    """
+    A bounded cache of template identifiers that could not be found, so that
+    repeated lookups of missing templates (``select_template()`` candidates,
+    optional includes etc.) do not probe every loader in a hierarchy again.
+
+    Entries are keyed by hierarchy and template name, expire after ``ttl``
+    seconds and the least recently used entries are discarded once there are
+    more than ``maxsize`` of them.  A single cache may be shared between the
+    hierarchies of a ``MultiHierarchyLoader``.
+
+    Args:
+      * `maxsize` - int - the maximum number of missing templates to remember
+      * `ttl` - int - the number of seconds to remember a missing template for
+    """
+
+    def __init__(self, maxsize=1000, ttl=60):
+        self.ttl = ttl
+        self._entries = LRUCache(maxsize)
+
+    def contains(self, hierarchy, template):
+        """
+        Check whether a template is known to be missing from a hierarchy.
+
+        Args:
+          * `hierarchy` - the hierarchy loader the template was looked up in
+          * `template` - the template name that was looked up
+        """
+        expires = self._entries.get((hierarchy, template))
+        if expires is None:
+            return False
+        if expires < time.time():
+            self.invalidate(hierarchy, template)
+            return False
+        return True
+
+    def add(self, hierarchy, template):
+        """
+        Remember that a template is missing from a hierarchy.
+
+        Args:
+          * `hierarchy` - the hierarchy loader the template was looked up in
+          * `template` - the template name that was looked up
+        """
+        self._entries[(hierarchy, template)] = time.time() + self.ttl
+
+    def invalidate(self, hierarchy=None, template=None):
+        """
+        Forget missing templates.  With no arguments, the whole cache is
+        cleared.
+
+        Args:
+          * `hierarchy` - only forget templates missing from this hierarchy loader
+          * `template` - only forget this template name
+        """
+        if hierarchy is None and template is None:
+            self._entries.clear()
+            return
+        for key in self._entries.keys():
+            key_hierarchy, key_template = key
+            if hierarchy is not None and key_hierarchy is not hierarchy:
+                continue
+            if template is not None and key_template != template:
+                continue
+            try:
+                del self._entries[key]
+            except KeyError:
+                pass
+
 class JinjaOrigin(object):
     def __init__(self, loader, name):
         self.loader_name = loader.__class__.__name__
@@ -83,9 +179,24 @@ class HierarchyLoader(BaseLoader):
 
     Will find ``bar.html`` by querying the loaders sequentially from ``eurogamer_net``
     to ``core``.
+
+    When ``use_index`` is enabled, the loader builds a resolution index from
+    ``list_templates()`` of every loader in the hierarchy.  The index maps each
+    sequential, namespace and ancestor template identifier to the loader which
+    wins the lookup, so resolving a template is a single dict lookup rather
+    than a probe of each loader in turn.  The index is rebuilt when the
+    template directories change (if the environment has ``auto_reload``
+    enabled, checked at most every ``index_check_interval`` seconds) or when
+    ``invalidate_index()`` is called.
+
+    When a ``NegativeLookupCache`` is given as ``negative_cache``, templates
+    which could not be found are remembered so that repeat lookups fail
+    without probing the loaders.  The negative cache is bypassed when
+    ``DEBUG`` is on so that the full list of tried template locations is
+    always available.
     """
 
-    def __init__(self, hierarchy, delimiter=':'):
+    def __init__(self, hierarchy, delimiter=':', use_index=False, negative_cache=None, index_check_interval=1):
         """
         Args:
           * `hierarchy` - OrderedDict - ordered dict with keys as template
@@ -95,6 +206,14 @@ class HierarchyLoader(BaseLoader):
             contain the ``delimiter``
           * `delimiter` - string - the namespace delimiter string to use when
             separating namespace from template identifier
+          * `use_index` - boolean - resolve templates through a precomputed
+            index of the templates available to each loader
+          * `negative_cache` - NegativeLookupCache - cache to remember missing
+            templates in
+          * `index_check_interval` - number of seconds between checks of the
+            template directories for changes to the index, when the environment
+            has ``auto_reload`` enabled without a template watcher.  ``0``
+            checks on every lookup.
         """
         if not isinstance(hierarchy, OrderedDict):
             raise TypeError("HierarchyLoader must be called with a \
@@ -108,6 +227,13 @@ class HierarchyLoader(BaseLoader):
 
         self.hierarchy = hierarchy
         self.delimiter = delimiter
+        self.use_index = use_index
+        self.negative_cache = negative_cache
+        self._index = None
+        self._index_directories = ()
+        self._index_signature = None
+        self.index_check_interval = index_check_interval
+        self._index_checked = None
 
     def identify_loading_mode(self, template_name):
         """
@@ -219,9 +345,195 @@ class HierarchyLoader(BaseLoader):
                 continue
         return None
 
+    def resolve_templates(self):
+        """
+        Work out which loader every template in the hierarchy resolves to,
+        from the templates listed by each loader.  This maps every sequential
+        (``base.html``), namespace (``core:base.html``) and ancestor
+        (``eurogamer_parent:base.html``) template identifier to a
+        ``(loader_name, template_name)`` pair.
+
+        Raises `ImproperlyConfigured` if a loader in the hierarchy cannot list
+        its templates.
+        """
+        loader_names = list(self.hierarchy)
+        available = OrderedDict()
+        for loader_name, loader in self.hierarchy.items():
+            try:
+                available[loader_name] = set(loader.list_templates())
+            except TypeError:
+                raise ImproperlyConfigured("Template loader `%s` does not support listing templates, so cannot be indexed" % loader_name)
+
+        index = {}
+        for template_name in set().union(*available.values()):
+            containing = [name for name in loader_names if template_name in available[name]]
+            index[template_name] = (containing[0], template_name)
+            for loader_name in containing:
+                index[loader_name + self.delimiter + template_name] = (loader_name, template_name)
+            for position, loader_name in enumerate(loader_names):
+                for ancestor_name in loader_names[position+1:]:
+                    if ancestor_name in containing:
+                        ancestor_key = "%s_parent%s%s" % (loader_name, self.delimiter, template_name)
+                        index[ancestor_key] = (ancestor_name, template_name)
+                        break
+        return index
+
+    def build_index(self):
+        """
+        Build the resolution index for the hierarchy - see ``resolve_templates()``.
+        """
+        self._index_directories = tuple(self.get_index_directories())
+        self._index_signature = self.get_index_signature()
+        self._index_checked = time.monotonic()
+        self._index = self.resolve_templates()
+        return self._index
+
+    def invalidate_index(self):
+        """
+        Discard the resolution index so that it is rebuilt on the next lookup.
+        """
+        self._index = None
+
+    def get_index(self, environment):
+        """
+        Get the resolution index, building it if it does not exist yet or - when
+        the environment has ``auto_reload`` enabled without a template watcher
+        - if the template directories have changed since it was built.  The
+        directories are checked at most every ``index_check_interval`` seconds.
+        """
+        index = self._index
+        if index is None:
+            return self.build_index()
+        if environment.auto_reload and getattr(environment, 'template_watcher', None) is None:
+            now = time.monotonic()
+            if now - self._index_checked >= self.index_check_interval:
+                self._index_checked = now
+                if self.get_index_signature() != self._index_signature:
+                    index = self.build_index()
+        return index
+
+    def get_index_directories(self):
+        """
+        Get all of the directories underneath each loader's search path.  The
+        modification times of these directories change when templates are
+        added or removed, so they are used to detect a stale index.
+        """
+        for loader in self.hierarchy.values():
+            if getattr(loader, 'immutable', False):
+                continue
+            followlinks = getattr(loader, 'followlinks', False)
+            for searchpath in getattr(loader, 'searchpath', []):
+                for dirpath, _, _ in os.walk(searchpath, followlinks=followlinks):
+                    yield dirpath
+
+    def get_index_signature(self):
+        """
+        Get the modification times of the directories the index was built from.
+        """
+        signature = []
+        for directory in self._index_directories:
+            try:
+                signature.append(os.stat(directory).st_mtime)
+            except OSError:
+                signature.append(None)
+        return tuple(signature)
+
+    def get_index_tried(self, template):
+        """
+        Get the list of tried template locations for a template identifier
+        that is missing from the index, without probing the loaders.
+
+        Args:
+          * `template` - the template name that was looked up
+        """
+        loading_mode = self.identify_loading_mode(template)
+        loader_names = []
+        if loading_mode == "sequential":
+            loader_names = list(self.hierarchy)
+        elif loading_mode == "ancestor":
+            prefix = template.split(self.delimiter, 1)[0]
+            try:
+                loader_names = self.get_ancestor_loader_names(prefix.split("_parent", 1)[0])
+            except TemplateNotFound:
+                pass
+        tried = []
+        for loader_name in loader_names:
+            loader = self.hierarchy[loader_name]
+            loader_path = "%s/%s" % (loader.searchpath[0], template)
+            tried.append([JinjaOrigin(loader, loader_path), "Source does not exist"])
+        return tried
+
+    def normalize_template_name(self, template):
+        """
+        Normalize the template name part of a template identifier the way that
+        ``FileSystemLoader`` does - e.g. ``core:./widgets//comments.j2`` to
+        ``core:widgets/comments.j2`` - so that it matches the index.
+
+        Raises `TemplateNotFound` if the name isn't a valid template path.
+        """
+        prefix = ''
+        template_name = template
+        if self.delimiter in template:
+            prefix, template_name = template.split(self.delimiter, 1)
+            prefix += self.delimiter
+        return prefix + '/'.join(split_template_path(template_name))
+
+    def get_indexed_source(self, environment, template):
+        """
+        Get the template source for a given template identifier by resolving
+        the loader to use from the index.
+
+        Args:
+          * `environment` - the jinja environment object
+          * `template` - the template name to look up
+
+        Returns the template source or None if the index is stale for this
+        template.
+        Raises `DjangoTemplateNotFound` if the template is not in the index.
+        """
+        try:
+            loader_name, template_name = self.get_index(environment)[self.normalize_template_name(template)]
+        except (KeyError, TemplateNotFound):
+            raise DjangoTemplateNotFound(template, tried=self.get_index_tried(template))
+        try:
+            return self.hierarchy[loader_name].get_source(environment, template_name)
+        except TemplateNotFound:
+            # The template has gone away since the index was built
+            self.invalidate_index()
+            return None
+
+    def invalidate_negative_cache(self, template=None):
+        """
+        Forget templates that are known to be missing from this hierarchy.
+
+        Args:
+          * `template` - only forget this template name
+        """
+        if self.negative_cache is not None:
+            self.negative_cache.invalidate(self, template)
+
     def get_source(self, environment, template):
         """
-        Get the template source for a given template identifier.  An appropriate
+        Get the template source for a given template identifier, checking the
+        negative cache (if there is one) for templates known to be missing.
+
+        Args:
+          * `environment` - the jinja environment object
+          * `template` - the template name to look up
+        """
+        use_negative_cache = self.negative_cache is not None and not settings.DEBUG
+        if use_negative_cache and self.negative_cache.contains(self, template):
+            raise DjangoTemplateNotFound(template)
+        try:
+            return self.resolve_source(environment, template)
+        except TemplateNotFound:
+            if use_negative_cache:
+                self.negative_cache.add(self, template)
+            raise
+
+    def resolve_source(self, environment, template):
+        """
+        Resolve the template source for a given template identifier.  An appropriate
         loader is used based on whether the template identifier indicates
         sequential, ancestor or namespace lookup modes.
 
@@ -229,6 +541,11 @@ class HierarchyLoader(BaseLoader):
           * `environment` - the jinja environment object
           * `template` - the template name to look up
         """
+        if self.use_index:
+            template_source = self.get_indexed_source(environment, template)
+            if template_source:
+                return template_source
+
         # Identify the loading mode from the template identifier
         loading_mode = self.identify_loading_mode(template)
         loading_method = getattr(self, "get_%s_source" % loading_mode)
@@ -254,7 +571,201 @@ class HierarchyLoader(BaseLoader):
                 result.append(prefix + self.delimiter + template)
         return result
 
-def get_hierarchy_loader(directories):
+    def get_level(self, filename):
+        """
+        Get the name of the loader in the hierarchy that a template file was
+        loaded from - e.g. ``core``.
+
+        Args:
+          * `filename` - the template filename
+
+        Returns the loader name, or ``None`` if the file isn't in any of the
+        loaders' search paths.
+        """
+        if filename is None:
+            return None
+        for loader_name, loader in self.hierarchy.items():
+            for searchpath in getattr(loader, 'searchpath', []):
+                if filename.startswith(os.path.join(searchpath, '')):
+                    return loader_name
+        return None
+
+def always_up_to_date():
+    return True
+
+class SnapshotLoader(BaseLoader):
+    """
+    Loader which reads every template in a directory in to memory when it is
+    created, and then serves them without any filesystem calls.  Templates
+    are never reloaded, so this suits deploys where templates can't change -
+    e.g. read-only container images.
+
+    Args:
+      * `searchpath` - the template directory
+      * `encoding` - the encoding of the templates.  Defaults to ``utf-8``.
+      * `followlinks` - boolean - follow symbolic links to directories
+    """
+
+    # Templates never change once the loader has been created
+    immutable = True
+
+    def __init__(self, searchpath, encoding='utf-8', followlinks=False):
+        self.searchpath = [searchpath]
+        self.encoding = encoding
+        self.followlinks = followlinks
+        # Files are kept undecoded, so that other files in the directory (e.g.
+        # images) don't stop the loader from being created
+        self.templates = {}
+        for name in find_templates(searchpath, followlinks):
+            with open(os.path.join(searchpath, *name.split('/')), 'rb') as f:
+                self.templates[name] = f.read()
+
+    def get_filename(self, template):
+        return os.path.join(self.searchpath[0], *template.split('/'))
+
+    def get_source(self, environment, template):
+        try:
+            source = self.templates[template]
+        except KeyError:
+            raise TemplateNotFound(template)
+        return source.decode(self.encoding), self.get_filename(template), always_up_to_date
+
+    def list_templates(self):
+        return sorted(self.templates)
+
+class BundleLoader(SnapshotLoader):
+    """
+    Loader which serves templates from a memory-mapped template bundle (see
+    ``gn_django.template.bundles``), without any filesystem calls once it has
+    been created.  Templates are decoded when they are loaded, so only the
+    bundle's index is held in memory up front.
+
+    Template filenames are given as paths inside the bundle - e.g.
+    ``/srv/bundles/core.bundle/base.j2``.
+
+    Args:
+      * `path` - the path of the bundle file
+      * `encoding` - the encoding of the templates.  Defaults to ``utf-8``.
+    """
+
+    def __init__(self, path, encoding='utf-8'):
+        self.searchpath = [path]
+        self.encoding = encoding
+        self.bundle = TemplateBundle(path)
+
+    def get_filename(self, template):
+        return "%s/%s" % (self.searchpath[0], template)
+
+    def get_source(self, environment, template):
+        try:
+            source = self.bundle.read(template)
+        except KeyError:
+            raise TemplateNotFound(template)
+        return source.decode(self.encoding), self.get_filename(template), always_up_to_date
+
+    def list_templates(self):
+        return sorted(self.bundle.names())
+
+class ZipLoader(SnapshotLoader):
+    """
+    Loader which serves templates from a zip file.  The zip file's index is
+    read when the loader is created, and the zip file is kept open, so each
+    template is loaded with a single seek and read (and decompressed, if it
+    was compressed) rather than a directory traversal.
+
+    The zip file is opened lazily, and again in each forked process - e.g. by
+    gunicorn's ``preload_app`` - as forked processes would otherwise share the
+    open file's offset, and interleave their reads.
+
+    Template filenames are given as paths inside the zip file - e.g.
+    ``/srv/bundles/core.zip/base.j2``.
+
+    Args:
+      * `path` - the path of the zip file
+      * `encoding` - the encoding of the templates.  Defaults to ``utf-8``.
+    """
+
+    def __init__(self, path, encoding='utf-8'):
+        self.searchpath = [path]
+        self.encoding = encoding
+        with zipfile.ZipFile(path) as archive:
+            self.members = dict(
+                (info.filename, info) for info in archive.infolist() if not info.is_dir()
+            )
+        self.reset()
+        zip_loaders.add(self)
+
+    def reset(self):
+        """
+        Forget the open zip file, so that it is opened again when it is next
+        used - e.g. in a forked process.
+        """
+        archive = getattr(self, 'archive', None)
+        if archive is not None:
+            # Closes this process's copy of the file descriptor only
+            archive.close()
+        self.archive = None
+        self.lock = threading.Lock()
+
+    def get_archive(self):
+        """
+        Get the zip file, opening it if this process hasn't yet.
+        """
+        if self.archive is None:
+            with self.lock:
+                if self.archive is None:
+                    self.archive = zipfile.ZipFile(self.searchpath[0])
+        return self.archive
+
+    def close(self):
+        """
+        Close the zip file, if it is open.
+        """
+        with self.lock:
+            if self.archive is not None:
+                self.archive.close()
+                self.archive = None
+
+    def get_filename(self, template):
+        return "%s/%s" % (self.searchpath[0], template)
+
+    def get_source(self, environment, template):
+        try:
+            info = self.members[template]
+        except KeyError:
+            raise TemplateNotFound(template)
+        source = self.get_archive().read(info)
+        return source.decode(self.encoding), self.get_filename(template), always_up_to_date
+
+    def list_templates(self):
+        return sorted(self.members)
+
+def reset_zip_loaders():
+    """
+    Make each ``ZipLoader`` open its zip file again in a forked process.
+    """
+    for loader in list(zip_loaders):
+        loader.reset()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_zip_loaders)
+
+def get_archive_loader(path, encoding='utf-8'):
+    """
+    Get a loader for a template archive - a ``ZipLoader`` for a zip file, or a
+    ``BundleLoader`` for a template bundle (see ``gn_django.template.bundles``).
+
+    Args:
+      * `path` - the path of the archive
+      * `encoding` - the encoding of the templates.  Defaults to ``utf-8``.
+    """
+    if zipfile.is_zipfile(path):
+        return ZipLoader(path, encoding)
+    if is_template_bundle(path):
+        return BundleLoader(path, encoding)
+    raise ImproperlyConfigured("%s is not a zip file or template bundle" % path)
+
+def get_hierarchy_loader(directories, **kwargs):
     """
     Helper to instantiate a `HierarchyLoader` from a hierarchy of named directories.
 
@@ -271,20 +782,92 @@ def get_hierarchy_loader(directories):
             )
         ```
 
+        Each level can also be the path of a template archive - a zip file or
+        template bundle (see ``gn_django.template.bundles``) - which is served
+        by a ``ZipLoader`` or ``BundleLoader``.
+
+      * `snapshot` - boolean - when ``True``, every template in each directory
+        is read in to memory up front by a ``SnapshotLoader``, and templates
+        are never reloaded.  Defaults to ``False``.
+
+    Any extra kwargs (e.g. ``use_index``) are passed on to the ``HierarchyLoader``.
+
     Returns an instantiated `HierarchyLoader()` object
     """
+    snapshot = kwargs.pop('snapshot', False)
     template_loaders = OrderedDict()
     for app_name, template_dir in directories:
-        # Pull FileSystemLoader from cache if it already exists for this directory,
-        # or instanciate it if not
-        if template_dir not in file_system_loaders:
+        # Pull the loader from cache if it already exists for this directory or
+        # archive, or instanciate it if not
+        if os.path.isfile(template_dir):
+            if template_dir not in archive_loaders:
+                archive_loaders[template_dir] = get_archive_loader(template_dir)
+            loader = archive_loaders[template_dir]
+        elif snapshot:
+            if template_dir not in snapshot_loaders:
+                snapshot_loaders[template_dir] = SnapshotLoader(template_dir)
+            loader = snapshot_loaders[template_dir]
+        elif template_dir not in file_system_loaders:
             loader = FileSystemLoader(template_dir)
             file_system_loaders[template_dir] = loader
         else:
             loader = file_system_loaders[template_dir]
         template_loaders[app_name] = loader
-    return HierarchyLoader(template_loaders)
+    return HierarchyLoader(template_loaders, **kwargs)
+
+
+class LazyHierarchies(Mapping):
+    """
+    A mapping of hierarchy names to ``HierarchyLoader`` objects, which are
+    described declaratively and only built when a hierarchy is first used.
 
+    Building is thread safe - a hierarchy is built at most once, however many
+    threads ask for it at the same time.
+
+    Args:
+      * `hierarchies` - iterable of pairs of hierarchy name and the template
+        hierarchy to create for it - see ``get_multi_hierarchy_loader``
+      * `loader_kwargs` - kwargs to instantiate each ``HierarchyLoader`` with
+    """
+
+    def __init__(self, hierarchies, **loader_kwargs):
+        self.directories = OrderedDict(hierarchies)
+        self.loader_kwargs = loader_kwargs
+        self.loaders = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, hierarchy_name):
+        try:
+            return self.loaders[hierarchy_name]
+        except KeyError:
+            pass
+        directories = self.directories[hierarchy_name]
+        with self.lock:
+            if hierarchy_name not in self.loaders:
+                self.loaders[hierarchy_name] = get_hierarchy_loader(directories, **self.loader_kwargs)
+            return self.loaders[hierarchy_name]
+
+    def __iter__(self):
+        return iter(self.directories)
+
+    def __len__(self):
+        return len(self.directories)
+
+    def is_built(self, hierarchy_name):
+        """
+        Check whether the ``HierarchyLoader`` for a hierarchy has been built.
+        """
+        return hierarchy_name in self.loaders
+
+    def get_built(self):
+        """
+        Get the hierarchies which have been built so far, as a mapping of
+        hierarchy name to ``HierarchyLoader``.
+        """
+        return OrderedDict(
+            (hierarchy_name, self.loaders[hierarchy_name])
+            for hierarchy_name in self.directories if hierarchy_name in self.loaders
+        )
 
 class MultiHierarchyLoader(BaseLoader):
     """
@@ -296,21 +879,68 @@ class MultiHierarchyLoader(BaseLoader):
       * `get_active_hierarchy_cb` - function/import string - import string of the function
         to call to determine the hierarchy loader which is active right now.
       * `hierarchies` - mapping - mapping of hierarchy names to instantiated
-        ``HierarchyLoader`` objects
+        ``HierarchyLoader`` objects, or a ``LazyHierarchies`` mapping
     """
 
     def __init__(self, get_active_hierarchy_cb, hierarchies, delimiter=':'):
         self.get_active_hierarchy_cb = get_active_hierarchy_cb
         self.hierarchies = hierarchies
         self.delimiter = delimiter
+        self._active = threading.local()
 
-    def get_loader(self):
-        # Call the active hierarchy callback to determine the hierarchy loader
-        # which is active right now
+    def get_active_hierarchy(self):
+        """
+        Call the active hierarchy callback to determine the name of the
+        hierarchy which is active right now, unless a hierarchy has been
+        activated with ``activate()``.
+        """
+        hierarchy_name = getattr(self._active, 'hierarchy_name', None)
+        if hierarchy_name is not None:
+            return hierarchy_name
         if isinstance(self.get_active_hierarchy_cb, six.string_types):
             self.get_active_hierarchy_cb = import_string(self.get_active_hierarchy_cb)
-        hierarchy = self.get_active_hierarchy_cb()
-        return self.hierarchies[hierarchy]
+        return self.get_active_hierarchy_cb()
+
+    @contextmanager
+    def activate(self, hierarchy_name):
+        """
+        Context manager which makes a hierarchy the active hierarchy for the
+        current thread, instead of calling the active hierarchy callback.
+
+        Args:
+          * `hierarchy_name` - the name of the hierarchy to activate
+        """
+        previous = getattr(self._active, 'hierarchy_name', None)
+        self._active.hierarchy_name = hierarchy_name
+        try:
+            yield
+        finally:
+            self._active.hierarchy_name = previous
+
+    def get_loader(self):
+        # Determine the hierarchy loader which is active right now
+        return self.hierarchies[self.get_active_hierarchy()]
+
+    def invalidate_negative_cache(self, template=None):
+        """
+        Forget templates that are known to be missing from any of the
+        hierarchies.
+
+        Args:
+          * `template` - only forget this template name
+        """
+        for loader in self.get_built_hierarchies().values():
+            loader.invalidate_negative_cache(template)
+
+    def get_built_hierarchies(self):
+        """
+        Get the hierarchies which have been built, as a mapping of hierarchy
+        name to ``HierarchyLoader``.  This is all of them, unless the hierarchies
+        are built lazily.
+        """
+        if isinstance(self.hierarchies, LazyHierarchies):
+            return self.hierarchies.get_built()
+        return OrderedDict(self.hierarchies.items())
 
     def get_source(self, environment, template):
         # Determine the currently active loader and get the template source from it
@@ -324,7 +954,50 @@ class MultiHierarchyLoader(BaseLoader):
                 result.append(prefix + self.delimiter + template)
         return result
 
-def get_multi_hierarchy_loader(get_active_hierarchy_cb, hierarchies):
+def get_hierarchy_loaders(loader, built_only=False):
+    """
+    Get all of the ``HierarchyLoader`` objects that make up a template loader.
+
+    Args:
+      * `loader` - a ``HierarchyLoader`` or ``MultiHierarchyLoader``
+      * `built_only` - boolean - only get the hierarchies which have already
+        been built, rather than building lazy hierarchies
+
+    Returns a mapping of hierarchy name to ``HierarchyLoader``.  A lone
+    ``HierarchyLoader`` is given the hierarchy name ``None``.
+    """
+    if isinstance(loader, MultiHierarchyLoader):
+        if built_only:
+            return loader.get_built_hierarchies()
+        return OrderedDict(loader.hierarchies.items())
+    if isinstance(loader, HierarchyLoader):
+        return OrderedDict(((None, loader),))
+    return OrderedDict()
+
+def get_template_directories(loader):
+    """
+    Get all of the template directories that a template loader loads from,
+    including the directories of lazy hierarchies which have not been built yet.
+
+    Args:
+      * `loader` - a ``HierarchyLoader`` or ``MultiHierarchyLoader``
+
+    Returns a list of template directories.
+    """
+    directories = []
+    if isinstance(loader, MultiHierarchyLoader) and isinstance(loader.hierarchies, LazyHierarchies):
+        for hierarchy_directories in loader.hierarchies.directories.values():
+            for _, directory in hierarchy_directories:
+                if directory not in directories:
+                    directories.append(directory)
+    for hierarchy in get_hierarchy_loaders(loader, built_only=True).values():
+        for hierarchy_loader in hierarchy.hierarchy.values():
+            for searchpath in getattr(hierarchy_loader, 'searchpath', []):
+                if searchpath not in directories:
+                    directories.append(searchpath)
+    return directories
+
+def get_multi_hierarchy_loader(get_active_hierarchy_cb, hierarchies, lazy=False, **kwargs):
     """
     Helper to instantiate a ``MultiHierarchyLoader`` from many named template
     directory hierarchies.
@@ -362,9 +1035,21 @@ def get_multi_hierarchy_loader(get_active_hierarchy_cb, hierarchies):
             )
         ```
 
+      * `lazy` - boolean - when ``True``, each hierarchy's ``HierarchyLoader``
+        (and ``FileSystemLoader`` objects) are only built the first time the
+        hierarchy is used, rather than straight away.  Defaults to ``False``.
+
+      * `snapshot` - boolean - read every template in to memory up front -
+        see ``get_hierarchy_loader``.  Defaults to ``False``.
+
+    Any extra kwargs (e.g. ``use_index``) are passed on to each ``HierarchyLoader``,
+    so a ``negative_cache`` given here is shared between all of the hierarchies.
+
     Returns an instantiated ``MultiHierarchyLoader()`` object
     """
+    if lazy:
+        return MultiHierarchyLoader(get_active_hierarchy_cb, LazyHierarchies(hierarchies, **kwargs))
     template_loaders = {}
     for hierarchy_name, directories in hierarchies:
-        template_loaders[hierarchy_name] = get_hierarchy_loader(directories)
+        template_loaders[hierarchy_name] = get_hierarchy_loader(directories, **kwargs)
     return MultiHierarchyLoader(get_active_hierarchy_cb, template_loaders)
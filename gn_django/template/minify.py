@@ -0,0 +1,210 @@
+"""
+Whitespace and comment minifiers for the text assets inlined in to pages - e.g.
+by ``include_raw``.
+
+The minifiers are conservative: they only remove what can't change how the
+asset is interpreted, rather than rewriting it.
+"""
+
+import re
+
+CSS_TOKEN = re.compile(r"""
+    ("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')    # string
+    |(/\*!.*?\*/)                           # comment to keep, e.g. a licence
+    |(/\*.*?\*/)                            # comment
+    |(\s+)                                  # whitespace
+    |([^"'/\s]+|/)                          # anything else
+""", re.S | re.X)
+
+# Whitespace after or before these characters is never needed.  Whitespace
+# before ``(`` and ``:`` is significant - e.g. ``and (max-width: 10px)`` and
+# ``div :hover``.
+CSS_NO_SPACE_AFTER = '{};,>(:'
+CSS_NO_SPACE_BEFORE = '{};,>)'
+
+def minify_css(source):
+    """
+    Remove comments (apart from ``/*! ... */`` comments) and unneeded
+    whitespace from CSS.
+    """
+    output = []
+    space = False
+    for match in CSS_TOKEN.finditer(source):
+        string, kept_comment, comment, whitespace, other = match.groups()
+        if comment is not None or whitespace is not None:
+            space = True
+            continue
+        text = string or kept_comment or other.replace(';}', '}')
+        if output:
+            if space and output[-1][-1] not in CSS_NO_SPACE_AFTER and text[0] not in CSS_NO_SPACE_BEFORE:
+                output.append(' ')
+            elif text[0] == '}' and output[-1].endswith(';'):
+                output[-1] = output[-1][:-1]
+                if not output[-1]:
+                    output.pop()
+        space = False
+        output.append(text)
+    return ''.join(output)
+
+SVG_PROLOG = re.compile(r'<\?xml.*?\?>|<!DOCTYPE[^>]*>', re.S | re.I)
+SVG_COMMENT = re.compile(r'<!--.*?-->', re.S)
+SVG_SPACE_BETWEEN_TAGS = re.compile(r'>\s*\n\s*<')
+
+def minify_svg(source):
+    """
+    Remove the XML declaration, doctype, comments and line breaks between tags
+    from SVG, so that it can be inlined in HTML.  Whitespace between tags on
+    the same line is kept, as it can be significant in text.
+    """
+    source = SVG_PROLOG.sub('', source)
+    source = SVG_COMMENT.sub('', source)
+    return SVG_SPACE_BETWEEN_TAGS.sub('><', source).strip()
+
+# Elements whose contents are left exactly as they are
+HTML_RAW_ELEMENTS = ('pre', 'textarea', 'script', 'style')
+
+# Elements which whitespace next to is never rendered, so can be removed
+HTML_BLOCK_ELEMENTS = frozenset((
+    '!doctype', 'address', 'article', 'aside', 'blockquote', 'body', 'br', 'dd', 'details', 'dialog', 'div',
+    'dl', 'dt', 'fieldset', 'figcaption', 'figure', 'footer', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+    'head', 'header', 'hgroup', 'hr', 'html', 'li', 'main', 'nav', 'ol', 'p', 'pre', 'section', 'summary', 'table',
+    'tbody', 'td', 'tfoot', 'th', 'thead', 'tr', 'ul',
+))
+
+HTML_TAG_START = re.compile(r'<(/?)([a-zA-Z][^\s/>]*|!doctype)', re.I)
+HTML_WHITESPACE = re.compile(r'\s+')
+
+class HTMLMinifier(object):
+    """
+    Minifies HTML which is given in chunks - e.g. the static parts of a
+    template, in between its variables and tags - keeping track of whether
+    it is in a tag, comment or raw element from one chunk to the next.
+
+    Comments (apart from conditional comments) are removed, and runs of
+    whitespace in text are collapsed to a single space or line break - or
+    removed entirely next to block level elements, where it is never rendered.
+    Tags and the contents of ``<pre>``, ``<textarea>``, ``<script>`` and
+    ``<style>`` elements are left as they are.
+    """
+
+    def __init__(self):
+        # The name of the raw element the HTML is in
+        self.raw_element = None
+        # Whether the HTML is in a comment which continues past the end of
+        # a chunk
+        self.in_comment = False
+        # Whether the HTML is in a tag, and the quote character of the
+        # attribute value it is in
+        self.in_tag = False
+        self.quote = None
+        self.tag = None
+        # The last tag, if nothing has been output since it
+        self.last_tag = None
+
+    def interrupt(self):
+        """
+        Note that something other than HTML (e.g. a template variable) comes
+        between the chunks before and after.
+        """
+        self.last_tag = None
+
+    def minify(self, html):
+        """
+        Minify the next chunk of HTML.
+        """
+        output = []
+        pos = 0
+        length = len(html)
+        while pos < length:
+            if self.raw_element is not None:
+                end = re.compile(r'</%s\s*>' % self.raw_element, re.I).search(html, pos)
+                if end is None:
+                    output.append(html[pos:])
+                    break
+                output.append(html[pos:end.end()])
+                pos = end.end()
+                self.last_tag = self.raw_element
+                self.raw_element = None
+            elif self.in_comment:
+                end = html.find('-->', pos)
+                if end == -1:
+                    output.append(html[pos:])
+                    break
+                output.append(html[pos:end + 3])
+                pos = end + 3
+                self.in_comment = False
+                self.last_tag = None
+            elif self.in_tag:
+                pos = self.minify_tag(html, pos, output)
+            else:
+                pos = self.minify_text(html, pos, output)
+        return ''.join(output)
+
+    def minify_tag(self, html, pos, output):
+        start = pos
+        while pos < len(html):
+            char = html[pos]
+            pos += 1
+            if self.quote is not None:
+                if char == self.quote:
+                    self.quote = None
+            elif char in '"\'':
+                self.quote = char
+            elif char == '>':
+                self.in_tag = False
+                name = self.tag.lstrip('/').lower()
+                if name in HTML_RAW_ELEMENTS and not self.tag.startswith('/') and not html[start:pos].endswith('/>'):
+                    self.raw_element = name
+                self.last_tag = name
+                break
+        output.append(html[start:pos])
+        return pos
+
+    def minify_text(self, html, pos, output):
+        tag = HTML_TAG_START.search(html, pos)
+        comment = html.find('<!--', pos)
+        end = len(html)
+        if tag is not None:
+            end = tag.start()
+        if comment != -1 and comment < end:
+            end = comment
+            tag = None
+
+        text = html[pos:end]
+        if text:
+            next_tag = tag.group(2).lower() if tag is not None else None
+            if text.isspace() and (self.last_tag in HTML_BLOCK_ELEMENTS or next_tag in HTML_BLOCK_ELEMENTS):
+                text = ''
+            text = HTML_WHITESPACE.sub(lambda match: '\n' if '\n' in match.group() else ' ', text)
+            if text:
+                output.append(text)
+                self.last_tag = None
+
+        if end == comment:
+            close = html.find('-->', comment + 4)
+            if html.startswith('<!--[if', comment) or html.startswith('<![endif]', comment + 4):
+                # Conditional comments are kept
+                if close == -1:
+                    self.in_comment = True
+                    output.append(html[comment:])
+                    return len(html)
+                output.append(html[comment:close + 3])
+            elif close == -1:
+                # The comment may contain template variables, so is kept
+                self.in_comment = True
+                output.append(html[comment:])
+                return len(html)
+            return close + 3
+        if tag is not None:
+            self.in_tag = True
+            self.quote = None
+            self.tag = tag.group(1) + tag.group(2)
+            output.append(tag.group())
+            return tag.end()
+        return end
+
+def minify_html(html):
+    """
+    Minify a complete HTML document or fragment - see ``HTMLMinifier``.
+    """
+    return HTMLMinifier().minify(html)
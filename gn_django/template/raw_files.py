@@ -0,0 +1,224 @@
+"""
+Process-local cache of the static files output by ``include_raw``, so that
+files inlined on every page (e.g. critical CSS) are read (and processed - e.g.
+minified) once and then served from memory.
+"""
+
+from collections import OrderedDict
+from hashlib import sha1
+import gzip
+import logging
+import mmap
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from .utils import write_atomically
+
+logger = logging.getLogger('gn_django.template')
+
+class RawFileCache(object):
+    """
+    Caches the paths that static files resolve to in ``STATICFILES_DIRS``, and
+    the files' contents.
+
+    A cached file is checked for changes (by its modification time and size)
+    at most once every ``check_interval`` seconds, and read again if it has
+    changed.  ``invalidate()`` evicts files straight away - e.g. from a
+    template watcher.
+
+    Files can be processed before they are cached, by a processor for their
+    file type - e.g. ``minify_css`` for ``.css`` files.  Processed output can
+    also be cached on disk, keyed by the file's contents, so that it is shared
+    by processes and survives restarts.
+
+    Args:
+      * `max_size` - int - the maximum number of bytes of file contents to
+        keep, evicting the least recently used files first.  Files larger than
+        this aren't cached.  Defaults to no limit.
+      * `check_interval` - number of seconds between checks for changes to a
+        cached file.  ``0`` checks every time the file is used.
+      * `mmap_threshold` - int - files of at least this many bytes are read
+        with ``mmap`` rather than buffered reads
+      * `processors` - dictionary of file extension (e.g. ``css``) to a
+        function which takes a file's contents and returns them processed
+      * `cache_dir` - directory to cache processed output in.  Defaults to
+        only caching in memory.
+      * `report` - boolean - log the size of each processed file before and
+        after processing, and gzipped
+    """
+
+    def __init__(self, max_size=None, check_interval=1, mmap_threshold=1024 * 1024,
+                 processors=None, cache_dir=None, report=False):
+        self.max_size = max_size
+        self.check_interval = check_interval
+        self.mmap_threshold = mmap_threshold
+        self.processors = processors or {}
+        self.cache_dir = cache_dir
+        self.report = report
+        self.size = 0
+        # Cached files, keyed by path within the static directories, of
+        # filename, (mtime, size) stat key, contents, last check time and
+        # size of the contents in bytes - least recently used first
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_directories(self):
+        return getattr(settings, 'STATICFILES_DIRS', [])
+
+    def resolve(self, path):
+        """
+        Get the filename of a static file from the first directory in the
+        ``STATICFILES_DIRS`` setting which has it, or ``None``.
+        """
+        for static_dir in self.get_directories():
+            # STATICFILES_DIRS entries may be (prefix, path) pairs
+            if isinstance(static_dir, (list, tuple)):
+                static_dir = static_dir[1]
+            filename = os.path.join(static_dir, path)
+            if os.path.isfile(filename):
+                return filename
+        return None
+
+    def get_stat_key(self, filename):
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size)
+
+    def read(self, filename, size):
+        """
+        Read the contents of a file, with ``mmap`` if it is large.  Mapped
+        files are decoded straight from the mapping, without copying them in
+        to a bytes object first.
+        """
+        with open(filename, 'rb') as f:
+            if size and size >= self.mmap_threshold:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    return str(mapped, 'utf-8')
+            return f.read().decode('utf-8')
+
+    def load(self, filename, size):
+        """
+        Read a file, and process it if there is a processor for its type.
+        """
+        content = self.read(filename, size)
+        processor = self.processors.get(os.path.splitext(filename)[1].lstrip('.'))
+        if processor is None:
+            return content
+
+        cache_path = None
+        if self.cache_dir:
+            processor_name = '%s.%s' % (getattr(processor, '__module__', ''), getattr(processor, '__qualname__', repr(processor)))
+            key = sha1(('%s\0%s' % (processor_name, content)).encode('utf-8')).hexdigest()
+            cache_path = os.path.join(self.cache_dir, key[:2], key)
+            try:
+                with open(cache_path, 'rb') as f:
+                    return f.read().decode('utf-8')
+            except OSError:
+                pass
+
+        processed = processor(content)
+        if self.report:
+            logger.info(
+                "include_raw %s: %d bytes, %d bytes processed, %d bytes processed and gzipped",
+                filename, len(content.encode('utf-8')), len(processed.encode('utf-8')),
+                len(gzip.compress(processed.encode('utf-8'))),
+            )
+        if cache_path is not None:
+            self.write_cache_file(cache_path, processed)
+        return processed
+
+    def write_cache_file(self, cache_path, processed):
+        # Write atomically, as other processes may be reading the same file
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            write_atomically(cache_path, lambda f: f.write(processed.encode('utf-8')))
+        except OSError:
+            pass
+
+    def get_cached(self, path):
+        """
+        Get the contents of a static file if it is cached and doesn't need to
+        be checked for changes yet, without touching the filesystem - or
+        ``None``.
+        """
+        with self.lock:
+            cached = self.files.get(path)
+            if cached is None or time.monotonic() - cached[3] >= self.check_interval:
+                return None
+            self.files.move_to_end(path)
+            return cached[2]
+
+    def get(self, path):
+        """
+        Get the contents of a static file, or an empty string if no directory
+        in ``STATICFILES_DIRS`` has it.
+
+        Args:
+          * `path` - the path to the file within the static directories
+        """
+        content = self.get_cached(path)
+        if content is not None:
+            return content
+
+        now = time.monotonic()
+        cached = self.files.get(path)
+        if cached is not None and self.get_stat_key(cached[0]) == cached[1]:
+            with self.lock:
+                if self.files.get(path) is cached:
+                    self.files[path] = cached[:3] + (now,) + cached[4:]
+                    self.files.move_to_end(path)
+            return cached[2]
+
+        filename = self.resolve(path)
+        stat_key = self.get_stat_key(filename) if filename is not None else None
+        if stat_key is None:
+            self.invalidate_paths([path])
+            return ''
+        content = self.load(filename, stat_key[1])
+        self.add(path, filename, stat_key, content, now)
+        return content
+
+    def add(self, path, filename, stat_key, content, now):
+        size = len(content.encode('utf-8'))
+        with self.lock:
+            self._remove(path)
+            if self.max_size is not None and size > self.max_size:
+                return
+            self.files[path] = (filename, stat_key, content, now, size)
+            self.size += size
+            while self.max_size is not None and self.size > self.max_size:
+                self._remove(next(iter(self.files)))
+
+    def _remove(self, path):
+        cached = self.files.pop(path, None)
+        if cached is not None:
+            self.size -= cached[4]
+
+    def invalidate_paths(self, paths):
+        with self.lock:
+            for path in paths:
+                self._remove(path)
+
+    def invalidate(self, filenames=None):
+        """
+        Evict cached files.
+
+        Args:
+          * `filenames` - iterable of the filenames of static files which have
+            changed, been added or removed.  Defaults to evicting every file.
+        """
+        with self.lock:
+            if filenames is None:
+                self.files = OrderedDict()
+                self.size = 0
+                return
+            filenames = set(filenames)
+            for path, cached in list(self.files.items()):
+                # An added file may take precedence over a cached one
+                if cached[0] in filenames or any(filename.endswith(os.path.sep + path.replace('/', os.path.sep)) for filename in filenames):
+                    self._remove(path)
@@ -0,0 +1,149 @@
+"""
+Content hash manifests for static assets, so that static link URLs only change
+when the asset they link to changes, rather than for every deploy.
+
+A manifest is a JSON file mapping the path of each static file to a hash of
+its contents, built with the ``build_static_manifest`` command - e.g.::
+
+    {"files": {"css/site.css": "3f2a1b9c0d4e", "scripts/app.js": "9b8c7d6e5f40"}}
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+from .utils import write_atomically
+
+logger = logging.getLogger('gn_django.template')
+
+HASH_LENGTH = 12
+
+def get_file_hash(path, chunk_size=65536):
+    """
+    Get a hash of the contents of a file.
+
+    Args:
+      * `path` - the path of the file
+      * `chunk_size` - int - the number of bytes to read at a time
+    """
+    file_hash = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()[:HASH_LENGTH]
+
+def get_hashed_name(name, file_hash):
+    """
+    Get the name of the hashed copy of a static file - e.g.
+    ``css/site.3f2a1b9c0d4e.css`` for ``css/site.css``.
+    """
+    root, ext = os.path.splitext(name)
+    return "%s.%s%s" % (root, file_hash, ext)
+
+def read_manifest(path):
+    """
+    Read the file hashes from a manifest, keyed by static file path.
+    """
+    with open(path) as f:
+        return json.load(f).get('files', {})
+
+def build_manifest(root, manifest_path, extensions=None, hashed_filenames=False):
+    """
+    Hash the contents of every static file in a directory, and write the hashes
+    to a manifest.
+
+    Args:
+      * `root` - the static files directory - e.g. ``STATIC_ROOT``
+      * `manifest_path` - the path to write the manifest to
+      * `extensions` - iterable of file extensions to hash, e.g. ``['css', 'js']``.
+        Defaults to every file.
+      * `hashed_filenames` - boolean - also write a copy of each file with its
+        hash in its name, for ``STATICLINK_MANIFEST_HASHED_FILENAMES``
+
+    Returns a dictionary of file hashes, keyed by static file path.
+    """
+    # Hashed copies written by a previous build aren't assets in their own right
+    previous_copies = set()
+    if os.path.isfile(manifest_path):
+        previous_copies = set(get_hashed_name(name, file_hash) for name, file_hash in read_manifest(manifest_path).items())
+    extensions = set(extension.lstrip('.') for extension in extensions) if extensions else None
+
+    files = {}
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(path, root).replace(os.sep, '/')
+            if name in previous_copies or os.path.abspath(path) == os.path.abspath(manifest_path):
+                continue
+            if extensions is not None and os.path.splitext(filename)[1].lstrip('.') not in extensions:
+                continue
+            files[name] = get_file_hash(path)
+
+    if hashed_filenames:
+        for name, file_hash in files.items():
+            shutil.copyfile(os.path.join(root, *name.split('/')), os.path.join(root, *get_hashed_name(name, file_hash).split('/')))
+
+    # Write the manifest atomically, so that processes reloading it never see
+    # a partly written file
+    write_atomically(manifest_path, lambda f: json.dump({'files': files}, f, indent=2, sort_keys=True), mode='w')
+    return files
+
+class StaticManifest(object):
+    """
+    An in-memory index of a manifest's file hashes.
+
+    The manifest is read the first time a hash is looked up, and read again
+    only when the manifest file changes - which is checked for at most once
+    every ``check_interval`` seconds.
+
+    Args:
+      * `path` - the path of the manifest file
+      * `check_interval` - number of seconds between checks for changes to the
+        manifest file
+    """
+
+    def __init__(self, path, check_interval=1):
+        self.path = path
+        self.check_interval = check_interval
+        self.files = None
+        self.mtime = None
+        self.checked = None
+        self.lock = threading.Lock()
+
+    def get_files(self):
+        """
+        Get the file hashes, keyed by static file path.
+        """
+        now = time.monotonic()
+        if self.files is not None and now - self.checked < self.check_interval:
+            return self.files
+        with self.lock:
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                mtime = None
+            if self.files is None or mtime != self.mtime:
+                self.load(mtime)
+            self.checked = now
+        return self.files
+
+    def load(self, mtime):
+        if mtime is None:
+            logger.warning("Static manifest %s does not exist", self.path)
+            self.files = {}
+        else:
+            self.files = read_manifest(self.path)
+        self.mtime = mtime
+
+    def get_hash(self, name):
+        """
+        Get the hash of a static file, or ``None`` if it isn't in the manifest.
+
+        Args:
+          * `name` - the path of the file within the static files directory
+        """
+        return self.get_files().get(name)
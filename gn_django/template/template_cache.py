@@ -0,0 +1,211 @@
+"""
+Template caches for the gn-django jinja environment.
+
+Jinja keeps compiled templates in a single LRU cache.  When templates are
+cached per site (e.g. with ``get_template_cache_key_with_site``), one busy site
+can push every other site's templates out of a small cache, while a cache big
+enough for every site makes every worker big.  ``PartitionedTemplateCache``
+gives each site its own quota instead.
+"""
+
+from collections import OrderedDict
+import sys
+import threading
+import types
+
+from gn_django.site import get_current_site
+
+DEFAULT_PARTITION = 'default'
+
+def estimate_template_size(template):
+    """
+    Estimate the memory used by a compiled template, in bytes - the size of
+    the code objects for its render function, blocks and macros.
+
+    Args:
+      * `template` - a compiled jinja ``Template``
+    """
+    pending = [template.root_render_func.__code__]
+    pending.extend(block.__code__ for block in template.blocks.values())
+    seen = set()
+    size = sys.getsizeof(template)
+    while pending:
+        code = pending.pop()
+        if id(code) in seen:
+            continue
+        seen.add(id(code))
+        size += sys.getsizeof(code) + sys.getsizeof(code.co_code)
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                pending.append(const)
+            else:
+                size += sys.getsizeof(const)
+    return size
+
+class TemplateCachePartition(object):
+    """
+    The templates cached for one site, least recently used first, with
+    counters for the partition.
+    """
+
+    def __init__(self, capacity, max_memory):
+        self.capacity = capacity
+        self.max_memory = max_memory
+        self.templates = OrderedDict()
+        self.sizes = {}
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def is_full(self):
+        if len(self.templates) > self.capacity:
+            return True
+        return self.max_memory is not None and self.memory > self.max_memory
+
+    def get_stats(self):
+        return {
+            'size': len(self.templates),
+            'capacity': self.capacity,
+            'memory': self.memory,
+            'max_memory': self.max_memory,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+class PartitionedTemplateCache(object):
+    """
+    A template cache with a partition, and quota, per site.  Each partition
+    evicts its least recently used templates when it is over its quota.
+
+    Templates are put in the partition for the current site (see
+    ``gn_django.site``) when they are cached, or the ``default`` partition
+    if no site is set.
+
+    Args:
+      * `capacity` - int - the number of templates each partition can hold,
+        unless it is given in `partition_capacity`
+      * `partition_capacity` - dictionary of site to the number of templates
+        that site's partition can hold
+      * `max_memory` - int - the estimated memory, in bytes, that each
+        partition's templates can use.  Defaults to no limit.
+      * `partition_max_memory` - dictionary of site to the estimated memory
+        that site's partition can use
+      * `estimate_memory` - boolean - estimate the memory used by each template
+        (see ``estimate_template_size()``).  This is always done if there are
+        memory limits.  Defaults to ``False``.
+    """
+
+    def __init__(self, capacity=400, partition_capacity=None, max_memory=None,
+                 partition_max_memory=None, estimate_memory=False):
+        self.capacity = capacity
+        self.partition_capacity = partition_capacity or {}
+        self.max_memory = max_memory
+        self.partition_max_memory = partition_max_memory or {}
+        self.estimate_memory = estimate_memory or max_memory is not None or bool(self.partition_max_memory)
+        self.partitions = {}
+        # The partition each cached template is in, by cache key
+        self.key_partitions = {}
+        self.lock = threading.RLock()
+
+    def copy(self):
+        """
+        Get an empty cache with the same quotas - e.g. for an overlay environment.
+        """
+        return self.__class__(
+            self.capacity, self.partition_capacity, self.max_memory,
+            self.partition_max_memory, self.estimate_memory,
+        )
+
+    def get_partition_name(self):
+        """
+        Get the name of the partition to cache a template in.
+        """
+        site = get_current_site()
+        return site if site is not None else DEFAULT_PARTITION
+
+    def get_partition(self, name):
+        partition = self.partitions.get(name)
+        if partition is None:
+            partition = self.partitions[name] = TemplateCachePartition(
+                self.partition_capacity.get(name, self.capacity),
+                self.partition_max_memory.get(name, self.max_memory),
+            )
+        return partition
+
+    def get(self, key, default=None):
+        with self.lock:
+            partition_name = self.key_partitions.get(key)
+            if partition_name is None:
+                self.get_partition(self.get_partition_name()).misses += 1
+                return default
+            partition = self.partitions[partition_name]
+            partition.hits += 1
+            partition.templates.move_to_end(key)
+            return partition.templates[key]
+
+    def __getitem__(self, key):
+        with self.lock:
+            partition_name = self.key_partitions[key]
+            return self.partitions[partition_name].templates[key]
+
+    def __contains__(self, key):
+        return key in self.key_partitions
+
+    def __len__(self):
+        return len(self.key_partitions)
+
+    def __setitem__(self, key, template):
+        size = estimate_template_size(template) if self.estimate_memory else 0
+        with self.lock:
+            if key in self.key_partitions:
+                self._remove(key)
+            partition_name = self.get_partition_name()
+            partition = self.get_partition(partition_name)
+            partition.templates[key] = template
+            partition.sizes[key] = size
+            partition.memory += size
+            self.key_partitions[key] = partition_name
+            while partition.is_full() and partition.templates:
+                self._remove(next(iter(partition.templates)))
+                partition.evictions += 1
+
+    def __delitem__(self, key):
+        with self.lock:
+            if key not in self.key_partitions:
+                raise KeyError(key)
+            self._remove(key)
+
+    def _remove(self, key):
+        partition = self.partitions[self.key_partitions.pop(key)]
+        del partition.templates[key]
+        partition.memory -= partition.sizes.pop(key)
+
+    def items(self):
+        with self.lock:
+            return [
+                (key, template)
+                for partition in self.partitions.values()
+                for key, template in partition.templates.items()
+            ]
+
+    def keys(self):
+        return [key for key, _ in self.items()]
+
+    def values(self):
+        return [template for _, template in self.items()]
+
+    def clear(self):
+        with self.lock:
+            self.partitions = {}
+            self.key_partitions = {}
+
+    def get_stats(self):
+        """
+        Get the counters for each partition - the number of templates cached
+        (``size``), their estimated ``memory`` use, and the number of ``hits``,
+        ``misses`` and ``evictions`` - keyed by partition name.
+        """
+        with self.lock:
+            return dict((name, partition.get_stats()) for name, partition in self.partitions.items())
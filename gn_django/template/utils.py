@@ -1,8 +1,15 @@
 import os
+import tempfile
 
+from django.http import StreamingHttpResponse
 from django.template import loader
 from jinja2.environment import Environment
 
+# The process umask, used to give atomically written files the permissions a
+# normally created file would have
+_umask = os.umask(0)
+os.umask(_umask)
+
 def render_to_string(template, context, request=None, using=None):
     """
     Shortcut for rendering templates using the current django project's collection
@@ -20,6 +27,34 @@ def render_to_string(template, context, request=None, using=None):
     """
     return loader.render_to_string(template, context=context, request=request, using=using)
 
+def stream_template_response(request, template, context=None, using=None, content_type=None, status=None, buffer_size=None):
+    """
+    Shortcut for streaming a rendered template to the client, so that the start
+    of the page (e.g. ``<head>`` and critical CSS) is sent while the rest of it
+    is still rendering.
+
+    Args:
+      * `request` - HttpRequest - the current request
+      * `template` - string - the template to render
+    Kwargs:
+      * `context` - mapping - the template context
+      * `using` - the name of the template engine to use
+      * `content_type` - the response content type
+      * `status` - the response status code
+      * `buffer_size` - int - the number of characters to buffer before sending
+        a chunk.  Defaults to the jinja backend's ``stream_buffer_size`` option.
+
+    Returns:
+      A ``StreamingHttpResponse``.
+    """
+    template = loader.get_template(template, using=using)
+    if hasattr(template, 'stream'):
+        content = template.stream(context, request, buffer_size=buffer_size)
+    else:
+        # Templates from other backends can't be streamed
+        content = [template.render(context, request)]
+    return StreamingHttpResponse(content, content_type=content_type, status=status)
+
 def render_from_string(template_string, context):
     """
     Shortcut for using simple strings as templates, e.g. '<p>{{ foo }}</p>'
@@ -46,4 +81,30 @@ def get_template_dir_for_app(app_name):
     app_module = __import__(app_name, fromlist=[''])
     app_path = os.path.dirname(app_module.__file__)
     template_path = os.path.join(app_path, 'templates')
-    return template_path
\ No newline at end of file
+    return template_path
+
+def write_atomically(path, write, mode='wb'):
+    """
+    Write a file by calling ``write`` with a temporary file object, and then
+    moving the temporary file in to place, so processes never see a partly
+    written file.
+
+    Args:
+      * `path` - string - the path of the file to write
+      * `write` - callable - called with the open temporary file
+    Kwargs:
+      * `mode` - string - the mode to open the temporary file with
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            # mkstemp() creates files that only their owner can read
+            os.chmod(temp_path, 0o666 & ~_umask)
+            write(f)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,174 @@
+"""
+Template warm-up, which loads templates in to the jinja environment's template
+cache before the first request needs them - e.g. in each worker process after
+a deploy, so that the first requests aren't slowed down by compiling
+``base.j2`` and friends for every site.
+"""
+
+from contextlib import contextmanager
+from fnmatch import fnmatchcase
+import logging
+import time
+
+from django.conf import settings
+from django.template import engines
+from django_jinja.backend import Jinja2
+from jinja2 import TemplateNotFound, TemplateSyntaxError
+
+from gn_django.site import get_current_site, set_current_site, clear_current_site
+from .dependencies import TemplateDependencyGraph
+from .loaders import get_hierarchy_loaders, MultiHierarchyLoader
+
+logger = logging.getLogger('gn_django.template')
+
+class WarmUpReport(object):
+    """
+    The outcome of warming up templates.
+
+    Attributes:
+      * `templates` - list of pairs of hierarchy name and template name which
+        were loaded
+      * `errors` - list of triples of hierarchy name, template name and error
+        message for templates which could not be loaded
+      * `elapsed` - float - the time warm-up took, in seconds
+    """
+
+    def __init__(self):
+        self.templates = []
+        self.errors = []
+        self.elapsed = 0.0
+
+def is_pattern(name):
+    return any(char in name for char in '*?[')
+
+def get_template_names(hierarchy, patterns):
+    """
+    Get the template names in a hierarchy which match the given template names
+    or glob patterns - e.g. ``"widgets/*.j2"``.  Patterns only match the
+    sequential template names, unless the pattern includes the hierarchy
+    delimiter - e.g. ``"core:*.j2"``.
+
+    Args:
+      * `hierarchy` - the ``HierarchyLoader`` to find templates in
+      * `patterns` - iterable of template names or glob patterns
+    """
+    names = []
+    available = None
+    for pattern in patterns:
+        if not is_pattern(pattern):
+            if pattern not in names:
+                names.append(pattern)
+            continue
+        if available is None:
+            available = sorted(hierarchy.resolve_templates())
+        for name in available:
+            if hierarchy.delimiter in name and hierarchy.delimiter not in pattern:
+                continue
+            if fnmatchcase(name, pattern) and name not in names:
+                names.append(name)
+    return names
+
+@contextmanager
+def activate_hierarchy(loader, hierarchy_name):
+    """
+    Context manager which makes a hierarchy active while templates are warmed up
+    for it.  Template cache keys may vary on the current site (e.g. with
+    ``get_template_cache_key_with_site``), so the current site is set to the
+    hierarchy name too.
+    """
+    if not isinstance(loader, MultiHierarchyLoader):
+        yield
+        return
+    previous_site = get_current_site()
+    set_current_site(hierarchy_name)
+    try:
+        with loader.activate(hierarchy_name):
+            yield
+    finally:
+        if previous_site is None:
+            clear_current_site()
+        else:
+            set_current_site(previous_site)
+
+def warm_up_templates(templates, using=None, include_dependencies=False):
+    """
+    Load templates in to the template cache of a jinja template engine.
+
+    Args:
+      * `templates` - either a mapping of hierarchy name to an iterable of
+        template names or glob patterns to load for that hierarchy, or an
+        iterable of template names or glob patterns to load for every hierarchy.
+        e.g.
+        ```
+            {
+                'eurogamer_net': ['base.j2', 'article.j2', 'widgets/*.j2'],
+                'vg247_com': ['base.j2'],
+            }
+        ```
+      * `using` - the name of the template engine.  Defaults to the only jinja
+        template engine.
+      * `include_dependencies` - boolean - also warm up the templates that the
+        templates extend, include or import, loading each template after its
+        dependencies.  Defaults to ``False``.
+
+    Returns a ``WarmUpReport``.
+    """
+    backend = engines[using] if using else Jinja2.get_default()
+    loader = backend.env.loader
+    hierarchies = get_hierarchy_loaders(loader)
+    if isinstance(templates, dict):
+        patterns = templates
+    else:
+        patterns = dict((hierarchy_name, templates) for hierarchy_name in hierarchies)
+
+    graph = None
+    if include_dependencies:
+        graph = getattr(backend.env, 'dependency_graph', None) or TemplateDependencyGraph(backend.env)
+
+    report = WarmUpReport()
+    start = time.perf_counter()
+    for hierarchy_name, hierarchy_patterns in patterns.items():
+        hierarchy = hierarchies[hierarchy_name]
+        get_environment = getattr(backend, 'get_environment', None)
+        with activate_hierarchy(loader, hierarchy_name):
+            environment = get_environment(hierarchy_name) if get_environment else backend.env
+            names = get_template_names(hierarchy, hierarchy_patterns)
+            if graph is not None:
+                names = graph.get_load_order(hierarchy_name, names)
+            for name in names:
+                try:
+                    environment.get_template(name)
+                except (TemplateNotFound, TemplateSyntaxError) as e:
+                    report.errors.append((hierarchy_name, name, str(e)))
+                else:
+                    report.templates.append((hierarchy_name, name))
+    report.elapsed = time.perf_counter() - start
+
+    for hierarchy_name, name, error in report.errors:
+        logger.warning("Failed to warm up template %s for %s: %s", name, hierarchy_name, error)
+    logger.info("Warmed up %d templates in %.2fs", len(report.templates), report.elapsed)
+    return report
+
+def warm_up_templates_from_settings():
+    """
+    Warm up the templates given by the ``TEMPLATE_WARM_UP`` setting, with the
+    engine given by the ``TEMPLATE_WARM_UP_ENGINE`` setting, if it is set.
+
+    Returns a ``WarmUpReport``, or ``None`` if there is no ``TEMPLATE_WARM_UP``
+    setting.
+    """
+    templates = getattr(settings, 'TEMPLATE_WARM_UP', None)
+    if not templates:
+        return None
+    return warm_up_templates(templates, using=getattr(settings, 'TEMPLATE_WARM_UP_ENGINE', None))
+
+def post_fork(server, worker):
+    """
+    gunicorn ``post_fork`` server hook which warms up templates in each worker.
+    To use it, add this to the gunicorn config file:
+
+    ```
+        from gn_django.template.warmup import post_fork
+    ```
+    """
+    warm_up_templates_from_settings()
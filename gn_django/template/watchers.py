@@ -0,0 +1,212 @@
+"""
+Template watchers, which watch template directories for changes and evict
+changed templates from a jinja environment's template cache.
+
+This lets an environment with ``auto_reload`` pick up template changes without
+checking whether each template is up to date every time it is fetched from the
+cache.
+"""
+
+import os
+import threading
+import weakref
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+from .loaders import file_system_loaders, get_template_directories
+
+class PollingTemplateWatcher(object):
+    """
+    Watches template directories for changes by polling the modification
+    times of the templates in them from a background thread.
+
+    Args:
+      * `directories` - iterable of template directories to watch.  Defaults to
+        all of the directories registered through ``get_hierarchy_loader`` and
+        the search paths of the environment's hierarchy loaders.
+      * `interval` - number of seconds between checks for changes
+    """
+
+    def __init__(self, directories=None, interval=1):
+        self.directories = directories
+        self.interval = interval
+        self.environments = weakref.WeakSet()
+        self._thread = None
+        self._stop_event = threading.Event()
+        # Held while starting the watcher thread, so it's only started once
+        self._lock = threading.Lock()
+        # Threads don't survive a fork, so watch again in forked processes
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+
+    def get_directories(self):
+        """
+        Get the template directories to watch.
+        """
+        if self.directories is not None:
+            return list(self.directories)
+        directories = list(file_system_loaders)
+        for environment in list(self.environments):
+            for directory in get_template_directories(environment.loader):
+                if directory not in directories:
+                    directories.append(directory)
+        return directories
+
+    def watch(self, environment):
+        """
+        Start watching for template changes for the environment, if the
+        watcher isn't already running in this process.  A watcher can be
+        shared by many environments (e.g. overlays).
+
+        Args:
+          * `environment` - the jinja environment to evict changed templates from
+        """
+        if self._thread is not None and environment in self.environments:
+            return
+        with self._lock:
+            self.environments.add(environment)
+            if self._thread is not None:
+                return
+            self.prepare()
+            self._thread = threading.Thread(target=self.run, name='template-watcher', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stop watching for template changes.
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._reset()
+
+    def prepare(self):
+        """
+        Take a snapshot of the watched templates to compare changes against.
+        """
+        self._snapshot = self.get_snapshot()
+
+    def get_snapshot(self):
+        """
+        Get the modification times of all of the templates in the watched
+        directories, keyed by filename.
+        """
+        snapshot = {}
+        for directory in self.get_directories():
+            for dirpath, _, filenames in os.walk(directory):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        snapshot[path] = os.stat(path).st_mtime
+                    except OSError:
+                        continue
+        return snapshot
+
+    def poll(self):
+        """
+        Check for template changes since the last check.
+
+        Returns a set of the filenames which were changed, added or removed.
+        """
+        snapshot = self.get_snapshot()
+        previous = self._snapshot
+        self._snapshot = snapshot
+        changed = set(snapshot) ^ set(previous)
+        for path, mtime in snapshot.items():
+            if path in previous and previous[path] != mtime:
+                changed.add(path)
+        return changed
+
+    def invalidate_templates(self, changed):
+        """
+        Evict changed templates from all of the watched environments.
+
+        Args:
+          * `changed` - set of template filenames which have changed
+        """
+        for environment in list(self.environments):
+            environment.invalidate_templates(changed)
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            changed = self.poll()
+            if changed:
+                self.invalidate_templates(changed)
+
+class InotifyTemplateWatcher(PollingTemplateWatcher):
+    """
+    Watches template directories for changes with inotify, so that changes
+    are picked up without polling the filesystem.
+
+    Requires the ``inotify_simple`` package.
+
+    Args:
+      * `directories` - iterable of template directories to watch.  Defaults to
+        all of the directories registered through ``get_hierarchy_loader`` and
+        the search paths of the environment's hierarchy loaders.
+      * `interval` - number of seconds to wait for inotify events before
+        checking whether the watcher has been stopped
+    """
+
+    def __init__(self, directories=None, interval=1):
+        if inotify_simple is None:
+            raise ImportError("InotifyTemplateWatcher requires the `inotify_simple` package")
+        super(InotifyTemplateWatcher, self).__init__(directories, interval)
+
+    def prepare(self):
+        flags = inotify_simple.flags
+        self._mask = (flags.CREATE | flags.DELETE | flags.CLOSE_WRITE | flags.MOVED_FROM |
+                      flags.MOVED_TO | flags.DELETE_SELF | flags.ATTRIB)
+        self._inotify = inotify_simple.INotify()
+        self._watches = {}
+        for directory in self.get_directories():
+            for dirpath, _, _ in os.walk(directory):
+                self.add_watch(dirpath)
+
+    def add_watch(self, path):
+        try:
+            self._watches[self._inotify.add_watch(path, self._mask)] = path
+        except OSError:
+            pass
+
+    def poll(self):
+        changed = set()
+        for event in self._inotify.read(timeout=self.interval * 1000):
+            directory = self._watches.get(event.wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, event.name)
+            if event.mask & inotify_simple.flags.ISDIR:
+                if event.mask & (inotify_simple.flags.CREATE | inotify_simple.flags.MOVED_TO):
+                    for dirpath, _, filenames in os.walk(path):
+                        self.add_watch(dirpath)
+                        changed.update(os.path.join(dirpath, filename) for filename in filenames)
+                continue
+            changed.add(path)
+        return changed
+
+    def run(self):
+        try:
+            while not self._stop_event.is_set():
+                changed = self.poll()
+                if changed:
+                    self.invalidate_templates(changed)
+        finally:
+            self._inotify.close()
+
+def get_template_watcher():
+    """
+    Get the best template watcher available - an ``InotifyTemplateWatcher`` if
+    ``inotify_simple`` is installed, otherwise a ``PollingTemplateWatcher``.
+    """
+    if inotify_simple is not None:
+        return InotifyTemplateWatcher()
+    return PollingTemplateWatcher()
@@ -32,6 +32,9 @@ setup(
             'django-autocomplete-light>=3.3,<4.0.0',
             'django-select2>=7.4.2,<8.0',
         ],
+        'inotify': [
+            'inotify_simple>=1.3,<3',
+        ],
     },
     include_package_data=True,
     author='Gamer Network',
@@ -1,18 +1,43 @@
-import tempfile, os
+import asyncio, mmap, shutil, tempfile, threading, os, time
 from collections import OrderedDict
+from io import StringIO
 from unittest import mock
 
 from jinja2.ext import Extension
 from jinja2 import nodes
-from jinja2.loaders import FileSystemLoader
+import jinja2
+from jinja2.bccache import Bucket
+from jinja2.loaders import FileSystemLoader, ModuleLoader
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.template import engines
 from django.test import TestCase
 from django.template.exceptions import TemplateDoesNotExist
 
-from gn_django.template.backend import Jinja2
+from gn_django.template.backend import Jinja2, Environment
 from gn_django.template import utils
+from gn_django.template.extensions import get_fragment_cache, get_fragment_cache_key, get_raw_file_cache
+from gn_django.template.extensions import SpacelessExtension, IncludeWithExtension
+from gn_django.management.commands.precompile_templates import Command as PrecompileTemplatesCommand
+from gn_django.management.commands.template_dependencies import Command as TemplateDependenciesCommand
+from gn_django.management.commands.build_static_manifest import Command as BuildStaticManifestCommand
+from gn_django.management.commands.build_template_bundle import Command as BuildTemplateBundleCommand
+from gn_django.template.static_manifest import build_manifest, get_file_hash
+from gn_django.template.raw_files import RawFileCache
+from gn_django.template.template_cache import PartitionedTemplateCache
+from gn_django.template.minify import minify_css, minify_svg, minify_html
+from gn_django.template.dependencies import TemplateDependencyGraph, find_template_dependencies
+from gn_django.template.watchers import PollingTemplateWatcher
+from gn_django.template.instrumentation import InMemorySink, LoggingSink, StatsdSink
+from gn_django.template.warmup import warm_up_templates, warm_up_templates_from_settings
+from gn_django.site import set_current_site, clear_current_site, get_current_site
+from gn_django.template.bytecode_cache import FileSystemBytecodeCache, DjangoCacheBytecodeCache
 from gn_django.template.loaders import HierarchyLoader, get_hierarchy_loader
-from gn_django.template.loaders import MultiHierarchyLoader, get_multi_hierarchy_loader
-from gn_django.template.loaders import file_system_loaders
+from gn_django.template.loaders import MultiHierarchyLoader, get_multi_hierarchy_loader, LazyHierarchies
+from gn_django.template.loaders import file_system_loaders, DjangoTemplateNotFound, NegativeLookupCache
+from gn_django.template.loaders import SnapshotLoader, BundleLoader, ZipLoader, snapshot_loaders, archive_loaders
+from gn_django.template.loaders import reset_zip_loaders
+from gn_django.template.bundles import write_template_bundle, write_template_zip
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -142,6 +167,99 @@ class TestJinja2(TestCase):
             rendered = template.render(request=True)
             self.assertEqual(rendered, expected_result)
 
+    def test_spaceless_extension(self):
+        jinja = Jinja2(self.get_jinja_config())
+        test_cases = [
+            # Static blocks are stripped at compile time
+            [' <div>a b c </div>    <div>\n<p>d</p></div> ', '<div>a b c </div><div><p>d</p></div>', False],
+            # Otherwise, the rendered block is stripped
+            [' <div>\n  <p>{{ a }}.</p>\n</div>\n', '<div><p>1.</p></div>', True],
+            ['<ul>\n{% for i in b %}<li>{{ i }}</li>\n{% endfor %}</ul>', '<ul><li>x</li><li>y</li></ul>', True],
+            ['<b>{{ a }}</b> {{ c|safe }}', '<b>1</b><i>c</i>', True],
+            # Including variables which contain markup
+            ['{{ d|safe }}', '<p>a</p><p>b</p>', True],
+            ['<div>{{ d|safe }}</div>', '<div><p>a</p><p>b</p></div>', True],
+        ]
+        context = {'a': 1, 'b': ['x', 'y'], 'c': '<i>c</i>', 'd': '<p>a</p>\n   <p>b</p>'}
+        for source, expected, stripped_when_rendered in test_cases:
+            source = '{% spaceless %}' + source + '{% endspaceless %}'
+            compiled = jinja.env.compile(source, raw=True)
+            self.assertEquals("._strip_spaces," in compiled, stripped_when_rendered, source)
+            self.assertEquals(jinja.from_string(source).render(context), expected)
+
+        # Includes and blocks are rendered in to the block, so are stripped too
+        env = jinja2.Environment(
+            extensions=[SpacelessExtension, IncludeWithExtension],
+            loader=jinja2.DictLoader({
+                'inc': '<div>\n   <p>{{ x }}</p>\n</div>',
+                'base': '{% spaceless %}<div>{% block b %}{% endblock %}</div>{% endspaceless %}',
+                'child': "{% extends 'base' %}{% block b %}<p>\n  x</p>\n <p>{{ x }}</p>{% endblock %}",
+                'super_base': '<div>{% block b %}<p>a</p>\n  <p>b</p>{% endblock %}</div>',
+                'super_child': "{% extends 'super_base' %}{% block b %}{% spaceless %}{{ super() }}{% endspaceless %}{% endblock %}",
+            }),
+        )
+        test_cases = [
+            ["<ul>{% include 'inc' %}</ul>", '<ul><div><p>1</p></div></ul>'],
+            ["<ul>{% include_with 'inc' x=1 %}</ul>", '<ul><div><p>1</p></div></ul>'],
+        ]
+        for source, expected in test_cases:
+            source = '{% spaceless %}' + source + '{% endspaceless %}'
+            self.assertIn('._strip_spaces,', env.compile(source, raw=True), source)
+            self.assertEquals(env.from_string(source).render({'x': 1}), expected)
+        self.assertEquals(env.get_template('child').render({'x': 1}), '<div><p>\n  x</p><p>1</p></div>')
+        self.assertEquals(env.get_template('super_child').render(), '<div><p>a</p><p>b</p></div>')
+        source = (
+            "{% macro wrap() %}<div>{{ caller() }}</div>\n  <hr>{% endmacro %}"
+            "{% spaceless %}{% call wrap() %}<p>a</p>\n  <p>b</p>{% endcall %}{% endspaceless %}"
+        )
+        self.assertEquals(env.from_string(source).render(), '<div><p>a</p><p>b</p></div><hr>')
+        source = (
+            "{% macro item(x) %}<li>{{ x }}</li>\n  {% endmacro %}"
+            "{% spaceless %}<ul>{{ item(1) }}{{ item(2) }}</ul>{% endspaceless %}"
+        )
+        self.assertEquals(env.from_string(source).render(), '<ul><li>1</li><li>2</li></ul>')
+
+    def test_minify_html(self):
+        jinja_config = self.get_jinja_config()
+        jinja_config['OPTIONS']['minify_html'] = True
+        jinja = Jinja2(jinja_config)
+        template = jinja.from_string(
+            "<!DOCTYPE html>\n<html>\n  <head>\n    <!-- comment -->\n    <!--[if IE]><p>ie</p><![endif]-->\n"
+            "    <script>\n      var a  =  {{ a }};\n    </script>\n  </head>\n  <body>\n"
+            "    <p class=\"{{ a }}   b\">Some   <b>{{ a }}</b>   <i>text</i></p>\n"
+            "    {% if a %}\n      <pre>\n  keep   {{ a }}   this\n</pre>\n    {% endif %}\n"
+            "    <textarea>  x  </textarea>\n  </body>\n</html>\n"
+        )
+        self.assertEquals(
+            template.render({'a': 1}),
+            '<!DOCTYPE html><html><head><!--[if IE]><p>ie</p><![endif]-->'
+            '<script>\n      var a  =  1;\n    </script></head><body>'
+            '<p class="1   b">Some <b>1</b> <i>text</i></p>'
+            '<pre>\n  keep   1   this\n</pre>\n<textarea>  x  </textarea></body></html>',
+        )
+        self.assertEquals(minify_html('<span>a</span>\n  <span>b</span> <!-- c -->'), '<span>a</span>\n<span>b</span> ')
+
+        # Only HTML templates are minified
+        source = "<p>\n  Hello   {{ a }}\n</p>\n\n<!-- keep -->"
+        templates = {'page.j2': source, 'email.txt': source, 'emails/welcome.txt.j2': source, 'a.js.j2': 'if (a<b) {\n  x();\n}'}
+        env = jinja.env.overlay(loader=jinja2.DictLoader(templates))
+        self.assertEquals(env.get_template('page.j2').render({'a': 1}), '<p>\nHello 1</p>')
+        for name in ('email.txt', 'emails/welcome.txt.j2', 'a.js.j2'):
+            self.assertEquals(env.get_template(name).render({'a': 1}), templates[name].replace('{{ a }}', '1'), name)
+
+        jinja_config['OPTIONS']['minify_html'] = ['*.html']
+        jinja = Jinja2(jinja_config)
+        env = jinja.env.overlay(loader=jinja2.DictLoader({'page.html': source, 'page.j2': source}))
+        self.assertEquals(env.get_template('page.html').render({'a': 1}), '<p>\nHello 1</p>')
+        self.assertEquals(env.get_template('page.j2').render({'a': 1}), source.replace('{{ a }}', '1'))
+
+        jinja_config['OPTIONS']['minify_html'] = True
+        jinja_config['OPTIONS']['minify_html_exclude'] = ['emails/*']
+        jinja = Jinja2(jinja_config)
+        env = jinja.env.overlay(loader=jinja2.DictLoader({'page.txt.j2': source, 'emails/page.j2': source}))
+        self.assertEquals(env.get_template('page.txt.j2').render({'a': 1}), '<p>\nHello 1</p>')
+        self.assertEquals(env.get_template('emails/page.j2').render({'a': 1}), source.replace('{{ a }}', '1'))
+
     def test_include_with_extension(self):
         class ExampleModel:
 
@@ -166,6 +284,28 @@ class TestJinja2(TestCase):
 
         self.assertEquals(result, expected)
 
+    def test_include_with_constant_name(self):
+        template_dir = os.path.join(BASE_DIR, "test_files", "include_with_templates")
+        jinja_config = self.get_jinja_config()
+        jinja_config['DIRS'].append(template_dir)
+        jinja = Jinja2(jinja_config)
+        template = jinja.from_string(
+            "{% for i in range(3) %}{% include_with 'i1.j2' foo=obj, hard='constant', var=i %}{% endfor %}"
+            "{% include_with name foo=obj, hard='dynamic', var=3 %}"
+        )
+        obj = {'name': 'Name', 'display_text': 'Text'}
+        expected = "".join(
+            jinja.get_template('i1.j2').render({'foo': obj, 'hard': hard, 'var': var})
+            for hard, var in [('constant', 0), ('constant', 1), ('constant', 2), ('dynamic', 3)]
+        )
+
+        # Constant names are resolved once per render, dynamic names every time
+        with mock.patch.object(jinja.env, 'get_template', wraps=jinja.env.get_template) as get_template:
+            self.assertEquals(template.render({'name': 'i1.j2', 'obj': obj}), expected)
+            self.assertEquals(get_template.call_count, 2)
+            template.render({'name': 'i1.j2', 'obj': obj})
+            self.assertEquals(get_template.call_count, 4)
+
     def test_include_raw_extension(self):
         template_dir = os.path.join(BASE_DIR, "test_files", "include_raw_templates")
 
@@ -183,6 +323,418 @@ class TestJinja2(TestCase):
 
             self.assertEquals(result, expected)
 
+    def test_include_raw_cache(self):
+        with tempfile.TemporaryDirectory() as first_dir, tempfile.TemporaryDirectory() as second_dir:
+            def write(directory, name, content):
+                with open(os.path.join(directory, name), 'w') as f:
+                    f.write(content)
+            write(second_dir, 'critical.css', 'body { color: red; }')
+            write(second_dir, 'large.css', 'a' * 64)
+
+            with self.settings(STATICFILES_DIRS=[first_dir, second_dir]):
+                cache = RawFileCache(max_size=80, check_interval=0, mmap_threshold=64)
+                with mock.patch.object(cache, 'read', wraps=cache.read) as read:
+                    self.assertEquals(cache.get('critical.css'), 'body { color: red; }')
+                    self.assertEquals(cache.get('critical.css'), 'body { color: red; }')
+                    self.assertEquals(read.call_count, 1)
+                    self.assertEquals(cache.get('missing.css'), '')
+
+                    # Large files are memory mapped, and the least recently used
+                    # files are evicted to stay within the maximum size
+                    with mock.patch('gn_django.template.raw_files.mmap.mmap', wraps=mmap.mmap) as mapped:
+                        self.assertEquals(cache.get('large.css'), 'a' * 64)
+                    self.assertEquals(mapped.call_count, 1)
+                    self.assertEquals(list(cache.files), ['large.css'])
+                    self.assertEquals(cache.size, 64)
+
+                    # Changed files are read again
+                    write(second_dir, 'large.css', 'b' * 10)
+                    os.utime(os.path.join(second_dir, 'large.css'), (time.time() + 10, time.time() + 10))
+                    self.assertEquals(cache.get('large.css'), 'b' * 10)
+
+                    # Added files take precedence once invalidated
+                    write(first_dir, 'large.css', 'c')
+                    cache.invalidate([os.path.join(first_dir, 'large.css')])
+                    self.assertEquals(cache.get('large.css'), 'c')
+
+                cache = RawFileCache(check_interval=60)
+                cache.get('critical.css')
+                write(second_dir, 'critical.css', 'body { color: blue; }')
+                self.assertEquals(cache.get_cached('critical.css'), 'body { color: red; }')
+                cache.invalidate()
+                self.assertEquals(cache.get('critical.css'), 'body { color: blue; }')
+
+    def test_include_raw_processors(self):
+        self.assertEquals(
+            minify_css("/*! licence */\n/* comment */\n@media screen and (max-width: 10px) {\n"
+                       "  div :hover, a > b { color: red; content: \"a  ;}\"; }\n}\n"),
+            '/*! licence */ @media screen and (max-width:10px){div :hover,a>b{color:red;content:"a  ;}"}}',
+        )
+        self.assertEquals(
+            minify_svg('<?xml version="1.0"?>\n<!-- icon -->\n<svg>\n  <text><tspan>a</tspan> <tspan>b</tspan></text>\n</svg>\n'),
+            '<svg><text><tspan>a</tspan> <tspan>b</tspan></text></svg>',
+        )
+
+        with tempfile.TemporaryDirectory() as static_dir, tempfile.TemporaryDirectory() as cache_dir:
+            with open(os.path.join(static_dir, 'critical.css'), 'w') as f:
+                f.write('body {\n  color: red;\n}\n')
+            settings = {
+                'STATICFILES_DIRS': [static_dir],
+                'INCLUDE_RAW_PROCESSORS': {'css': 'gn_django.template.minify.minify_css'},
+                'INCLUDE_RAW_CACHE_DIR': cache_dir,
+                'INCLUDE_RAW_REPORT': True,
+            }
+            with self.settings(**settings):
+                jinja = Jinja2(self.get_jinja_config())
+                with self.assertLogs('gn_django.template', 'INFO') as logs:
+                    self.assertEquals(jinja.from_string("<style>{% include_raw 'critical.css' %}</style>").render(), '<style>body{color:red}</style>')
+                self.assertIn('23 bytes, 15 bytes processed', logs.output[0])
+
+            # Processed output is shared through the disk cache
+            cache_files = [os.path.join(dirpath, name) for dirpath, _, names in os.walk(cache_dir) for name in names]
+            self.assertEquals(len(cache_files), 1)
+            with open(cache_files[0], 'w') as f:
+                f.write('body{color:blue}')
+            with self.settings(**settings):
+                self.assertEquals(get_raw_file_cache().get('critical.css'), 'body{color:blue}')
+
+    def test_async_rendering(self):
+        include_with_dir = os.path.join(BASE_DIR, "test_files", "include_with_templates")
+        include_raw_dir = os.path.join(BASE_DIR, "test_files", "include_raw_templates")
+
+        with self.settings(STATICFILES_DIRS=[include_raw_dir], STATICLINK_VERSION='1'):
+            jinja_config = self.get_jinja_config()
+            jinja_config['DIRS'].append(include_with_dir)
+            jinja_config['OPTIONS']['enable_async'] = True
+            jinja = Jinja2(jinja_config)
+            self.assertTrue(jinja.env.is_async)
+
+            async def render():
+                params = {
+                    'string': 'This is a message',
+                    'obj': {'name': 'Hello World!', 'display_text': 'Some text'},
+                    'parent_context': 'Parent context',
+                }
+                return (
+                    await jinja.get_template('include.j2').render_async(params),
+                    await jinja.from_string(
+                        "{% spaceless %} <div>{% js 'app' %}</div>  <p>{{ settings.TIME_ZONE }}</p> {% endspaceless %}"
+                    ).render_async(request=True),
+                    await jinja.from_string("{% include_raw 'styles.css' %}").render_async(),
+                )
+            loop = asyncio.new_event_loop()
+            try:
+                include_with_result, spaceless_result, include_raw_result = loop.run_until_complete(render())
+            finally:
+                loop.close()
+
+            self.assertIn("<p>Hard coded string: this is a hard coded message</p>", include_with_result)
+            self.assertIn("<p>A variable: I&#39;m a barbie girl, in a barbie world</p>", include_with_result)
+            self.assertIn("papayawhip", include_raw_result)
+            self.assertEquals(
+                spaceless_result,
+                '<div><script src="/static/js/app.js?v=1" type="application/javascript"></script></div><p>UTC</p>',
+            )
+
+            # Synchronous rendering still works outside of an event loop
+            self.assertIn("<p>UTC</p>", jinja.from_string("<p>{{ settings.TIME_ZONE }}</p>").render(request=True))
+
+    def test_stream(self):
+        jinja = Jinja2(self.get_jinja_config())
+        template = jinja.from_string("{% for i in range(5) %}<p>{{ i }}</p>{% endfor %}")
+        self.assertEquals(list(template.stream(buffer_size=0)), ["<p>", "0", "</p>"] + [
+            part for i in range(1, 5) for part in ("<p>", str(i), "</p>")
+        ])
+        self.assertEquals(list(template.stream(buffer_size=16)), ["<p>0</p><p>1</p>", "<p>2</p><p>3</p>", "<p>4</p>"])
+        self.assertEquals("".join(template.stream()), template.render())
+
+        jinja_config = self.get_jinja_config()
+        jinja_config['OPTIONS']['stream_buffer_size'] = 24
+        jinja = Jinja2(jinja_config)
+        template = jinja.from_string("{% for i in range(5) %}<p>{{ i }}</p>{% endfor %}")
+        self.assertEquals(len(list(template.stream())), 2)
+
+    def test_fragment_cache_extension(self):
+        caches_setting = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'fragments'}}
+        with self.settings(CACHES=caches_setting):
+            get_fragment_cache().clear()
+            jinja = Jinja2(self.get_jinja_config())
+            counter = mock.Mock(side_effect=range(100))
+            template = jinja.from_string('{% cache "sidebar", 60, colour %}<p>{{ counter() }}</p>{% endcache %}')
+            render = lambda site, colour: self.render_for_site(template, site, {'counter': counter, 'colour': colour})
+
+            self.assertEquals(render('eurogamer_net', 'red'), '<p>0</p>')
+            self.assertEquals(render('eurogamer_net', 'red'), '<p>0</p>')
+            # Fragments are cached per site, and vary on the given values
+            self.assertEquals(render('vg247_com', 'red'), '<p>1</p>')
+            self.assertEquals(render('eurogamer_net', 'blue'), '<p>2</p>')
+
+            get_fragment_cache().delete(get_fragment_cache_key('sidebar', ['red'], site='eurogamer_net'))
+            self.assertEquals(render('eurogamer_net', 'red'), '<p>3</p>')
+
+            # django-jinja's syntax is still supported
+            template = jinja.from_string('{% cache 60 "footer" %}<p>{{ counter() }}</p>{% endcache %}')
+            self.assertEquals(render('eurogamer_net', None), '<p>4</p>')
+            self.assertEquals(render('eurogamer_net', None), '<p>4</p>')
+
+            template = jinja.from_string('{% cache "footer", "never" %}{% endcache %}')
+            self.assertRaises(jinja2.TemplateSyntaxError, template.render)
+
+    def test_static_link_extension(self):
+        with self.settings(STATICLINK_VERSION='2', STATICLINK_FILE_MAP={'js': 'scripts'}):
+            jinja = Jinja2(self.get_jinja_config())
+            source = "{% css 'pages/article' %}{% js 'app' %}{% js name %}{% load_compilers %}"
+
+            # Constant names and load_compilers are resolved when the template is compiled
+            compiled = jinja.env.compile(source, raw=True)
+            self.assertIn('<link href="/static/css/pages/article.css?v=2" rel="stylesheet" type="text/css" />', compiled)
+            self.assertNotIn("._css", compiled)
+            self.assertNotIn("._load_compilers", compiled)
+            self.assertIn("._js", compiled)
+
+            template = jinja.from_string(source)
+            with mock.patch('gn_django.template.extensions.staticfiles_storage.url', return_value='/cdn/vendor.js') as url:
+                for _ in range(2):
+                    self.assertEquals(
+                        template.render({'name': 'vendor'}),
+                        '<link href="/static/css/pages/article.css?v=2" rel="stylesheet" type="text/css" />'
+                        '<script src="/static/scripts/app.js?v=2" type="application/javascript"></script>'
+                        '<script src="/cdn/vendor.js?v=2" type="application/javascript"></script>',
+                    )
+            # Dynamic URLs are built once
+            url.assert_called_once_with('scripts/vendor.js')
+
+            # Bytecode cache keys vary on the settings resolved at compile time
+            bucket = FileSystemBytecodeCache().get_bucket(jinja.env, 'article.j2', None, source)
+        jinja = Jinja2(self.get_jinja_config())
+        self.assertNotEquals(FileSystemBytecodeCache().get_bucket(jinja.env, 'article.j2', None, source).key, bucket.key)
+
+        # URLs from storages which hash file names change with the files, so
+        # are resolved when rendering - and missing files only fail then
+        static_root = tempfile.mkdtemp()
+        with open(os.path.join(static_root, 'staticfiles.json'), 'w') as f:
+            f.write('{"version": "1.0", "paths": {}}')
+        storage = 'django.contrib.staticfiles.storage.ManifestStaticFilesStorage'
+        with self.settings(STATICFILES_STORAGE=storage, STATIC_ROOT=static_root):
+            jinja = Jinja2(self.get_jinja_config())
+            compiled = jinja.env.compile("{% css 'site' %}", raw=True)
+            self.assertIn("._css", compiled)
+            template = jinja.from_string("{% css 'site' %}")
+            self.assertRaises(ValueError, template.render)
+            with mock.patch('gn_django.template.extensions.staticfiles_storage.url', return_value='/static/css/site.abc.css'):
+                self.assertEquals(
+                    template.render(),
+                    '<link href="/static/css/site.abc.css?v=latest" rel="stylesheet" type="text/css" />',
+                )
+        shutil.rmtree(static_root)
+
+        debug_settings = {
+            'STATICLINK_DEBUG': {'css': True},
+            'STATICLINK_PREPROCESSORS': {'css': 'less'},
+            'STATICLINK_CLIENT_COMPILERS': {'css': '//cdn/less.min.js'},
+        }
+        with self.settings(**debug_settings):
+            jinja = Jinja2(self.get_jinja_config())
+            rendered = jinja.from_string("{% css 'site' %}{% load_compilers %}").render()
+            self.assertEquals(
+                rendered,
+                '<link href="/static/less/site.less?v=latest" rel="stylesheet" type="text/less" />'
+                '\n<script src="//cdn/less.min.js"></script>\n<script>localStorage.clear();</script>',
+            )
+
+    def test_static_link_manifest(self):
+        with tempfile.TemporaryDirectory() as static_root:
+            os.makedirs(os.path.join(static_root, 'css'))
+            os.makedirs(os.path.join(static_root, 'js'))
+            with open(os.path.join(static_root, 'css', 'site.css'), 'w') as f:
+                f.write('body {}')
+            with open(os.path.join(static_root, 'js', 'app.js'), 'w') as f:
+                f.write('app();')
+            manifest = os.path.join(static_root, 'manifest.json')
+            out = StringIO()
+            call_command(BuildStaticManifestCommand(), root=static_root, manifest=manifest, stdout=out)
+            self.assertIn("2 static files", out.getvalue())
+            # The manifest is readable by other users, as the web server may
+            # run as a different user to the build
+            self.assertEquals(os.stat(manifest).st_mode & 0o777, 0o666 & ~utils._umask)
+            css_hash = get_file_hash(os.path.join(static_root, 'css', 'site.css'))
+
+            with self.settings(STATICLINK_MANIFEST=manifest, STATICLINK_VERSION='2'):
+                jinja = Jinja2(self.get_jinja_config())
+                template = jinja.from_string("{% css 'site' %}{% js 'app' %}{% js 'missing' %}")
+                js_hash = get_file_hash(os.path.join(static_root, 'js', 'app.js'))
+                self.assertEquals(
+                    template.render(),
+                    '<link href="/static/css/site.css?v=%s" rel="stylesheet" type="text/css" />'
+                    '<script src="/static/js/app.js?v=%s" type="application/javascript"></script>'
+                    '<script src="/static/js/missing.js?v=2" type="application/javascript"></script>' % (css_hash, js_hash),
+                )
+
+                # Only assets which have changed get new URLs, once the
+                # manifest has been rebuilt
+                with open(os.path.join(static_root, 'js', 'app.js'), 'w') as f:
+                    f.write('app(2);')
+                build_manifest(static_root, manifest)
+                os.utime(manifest, (time.time() + 10, time.time() + 10))
+                new_js_hash = get_file_hash(os.path.join(static_root, 'js', 'app.js'))
+                with mock.patch('gn_django.template.static_manifest.time.monotonic', return_value=time.monotonic() + 10):
+                    rendered = template.render()
+                self.assertIn('site.css?v=%s' % css_hash, rendered)
+                self.assertIn('app.js?v=%s' % new_js_hash, rendered)
+
+            with self.settings(STATICLINK_MANIFEST=manifest, STATICLINK_MANIFEST_HASHED_FILENAMES=True):
+                build_manifest(static_root, manifest, extensions=['css'], hashed_filenames=True)
+                self.assertTrue(os.path.isfile(os.path.join(static_root, 'css', 'site.%s.css' % css_hash)))
+                # Hashed copies aren't hashed again by later builds
+                self.assertEquals(build_manifest(static_root, manifest, extensions=['css']), {'css/site.css': css_hash})
+                jinja = Jinja2(self.get_jinja_config())
+                self.assertEquals(
+                    jinja.from_string("{% css 'site' %}").render(),
+                    '<link href="/static/css/site.%s.css" rel="stylesheet" type="text/css" />' % css_hash,
+                )
+
+    def render_for_site(self, template, site, context):
+        set_current_site(site)
+        try:
+            return template.render(context)
+        finally:
+            clear_current_site()
+
+class TestBytecodeCache(TestCase):
+    """
+    Tests for the bytecode cache classes.
+    """
+
+    def get_jinja_config(self, template_dir, bytecode_cache):
+        return {
+            "APP_DIRS": False,
+            "OPTIONS": {
+                'match_extension': None,
+                'bytecode_cache': bytecode_cache,
+            },
+            "NAME": "djangojinja",
+            "DIRS": [template_dir],
+        }
+
+    def test_cache_keys_vary_on_filename(self):
+        bcc = DjangoCacheBytecodeCache()
+        self.assertNotEqual(
+            bcc.get_cache_key("eurogamer_parent:base.j2", "/templates/core/base.j2"),
+            bcc.get_cache_key("eurogamer_parent:base.j2", "/templates/eurogamer/base.j2"),
+        )
+        environment = Environment()
+        bucket_a = bcc.get_bucket(environment, "base.j2", None, "foo")
+        bucket_b = bcc.get_bucket(environment, "base.j2", None, "bar")
+        self.assertNotEqual(bucket_a.key, bucket_b.key)
+
+    def test_file_system_bytecode_cache(self):
+        with tempfile.TemporaryDirectory() as template_dir, tempfile.TemporaryDirectory() as cache_dir:
+            with open(os.path.join(template_dir, "hello.j2"), "w") as f:
+                f.write("Hello {{ name }}")
+            bytecode_cache = {
+                'enabled': True,
+                'backend': 'gn_django.template.bytecode_cache.FileSystemBytecodeCache',
+                'options': {'directory': cache_dir},
+            }
+
+            jinja = Jinja2(self.get_jinja_config(template_dir, bytecode_cache))
+            self.assertIsInstance(jinja.env.bytecode_cache, FileSystemBytecodeCache)
+            self.assertEquals(jinja.get_template("hello.j2").render({'name': 'world'}), "Hello world")
+            self.assertEquals(len(os.listdir(cache_dir)), 1)
+
+            # A new environment loads the compiled template from the cache
+            jinja = Jinja2(self.get_jinja_config(template_dir, bytecode_cache))
+            with mock.patch.object(jinja.env, 'compile') as compile:
+                self.assertEquals(jinja.get_template("hello.j2").render({'name': 'world'}), "Hello world")
+            compile.assert_not_called()
+
+            # Changing the source invalidates the cached bytecode
+            with open(os.path.join(template_dir, "hello.j2"), "w") as f:
+                f.write("Goodbye {{ name }}")
+            jinja = Jinja2(self.get_jinja_config(template_dir, bytecode_cache))
+            self.assertEquals(jinja.get_template("hello.j2").render({'name': 'world'}), "Goodbye world")
+
+    def test_django_cache_bytecode_cache(self):
+        template_dir = os.path.join(BASE_DIR, "test_files", "include_with_templates")
+        bytecode_cache = DjangoCacheBytecodeCache(key_prefix='test_jinja2')
+        jinja = Jinja2(self.get_jinja_config(template_dir, bytecode_cache))
+        jinja.get_template("i1.j2")
+
+        jinja = Jinja2(self.get_jinja_config(template_dir, bytecode_cache))
+        with mock.patch.object(jinja.env, 'compile') as compile:
+            jinja.get_template("i1.j2")
+        compile.assert_not_called()
+
+    def test_django_cache_bytecode_cache_versioned_keys(self):
+        bcc = DjangoCacheBytecodeCache(key_prefix='test_versioned')
+        environment = Environment()
+        bucket = bcc.get_bucket(environment, "base.j2", "/templates/base.j2", "foo")
+        key = bcc.get_django_cache_key(bucket)
+        self.assertIn(bucket.checksum, key)
+        self.assertIn(jinja2.__version__, key)
+        self.assertNotEqual(key, bcc.get_django_cache_key(bcc.get_bucket(environment, "base.j2", "/templates/base.j2", "bar")))
+
+        # Entries aren't overwritten once they are written
+        bucket.code = environment.compile("foo")
+        bcc.set_bucket(bucket)
+        other = bcc.get_bucket(environment, "base.j2", "/templates/base.j2", "foo")
+        other.code = environment.compile("bar")
+        bcc.set_bucket(other)
+        self.assertEquals(
+            environment.template_class.from_code(environment, bcc.get_bucket(environment, "base.j2", "/templates/base.j2", "foo").code, {}, None).render(),
+            "foo",
+        )
+
+    def test_django_cache_bytecode_cache_compile_lock(self):
+        bcc = DjangoCacheBytecodeCache(key_prefix='test_lock', compile_lock_timeout=0.5)
+        environment = Environment()
+        # The first process to miss compiles the template
+        bucket = bcc.get_bucket(environment, "lock.j2", "/templates/lock.j2", "foo")
+        self.assertIsNone(bucket.code)
+
+        # Others wait for it to appear in the cache
+        compiled = Bucket(environment, bucket.key, bucket.checksum)
+        compiled.code = environment.compile("foo")
+        with mock.patch.object(bcc.cache, 'get', side_effect=[None, None, compiled.bytecode_to_string()]):
+            with mock.patch('gn_django.template.bytecode_cache.time.sleep') as sleep:
+                self.assertIsNotNone(bcc.get_bucket(environment, "lock.j2", "/templates/lock.j2", "foo").code)
+        self.assertEquals(sleep.call_count, 2)
+
+        # Writing the compiled template releases the lock
+        bucket.code = compiled.code
+        bcc.set_bucket(bucket)
+        self.assertIsNone(bcc.cache.get(bcc.get_lock_key(bucket)))
+
+        # Processes which give up waiting compile the template themselves,
+        # but don't release the lock held by another process
+        bucket = Bucket(environment, bcc.get_cache_key("waited.j2", "/templates/waited.j2"), bcc.get_source_checksum("foo"))
+        bcc.cache.add(bcc.get_lock_key(bucket), 1)
+        with mock.patch('gn_django.template.bytecode_cache.time.sleep'):
+            with mock.patch('gn_django.template.bytecode_cache.time.monotonic', side_effect=[0, 0, 1]):
+                bucket = bcc.get_bucket(environment, "waited.j2", "/templates/waited.j2", "foo")
+        self.assertIsNone(bucket.code)
+        bucket.code = compiled.code
+        bcc.set_bucket(bucket)
+        self.assertIsNotNone(bcc.cache.get(bcc.get_lock_key(bucket)))
+
+        # Failing to compile a template releases its lock too
+        environment = Environment(bytecode_cache=bcc, loader=jinja2.DictLoader({'broken.j2': '{% if %}'}))
+        lock_keys = []
+        def get_lock_key(bucket):
+            lock_keys.append(DjangoCacheBytecodeCache.get_lock_key(bcc, bucket))
+            return lock_keys[-1]
+        with mock.patch.object(bcc, 'get_lock_key', side_effect=get_lock_key):
+            with self.assertRaises(jinja2.TemplateSyntaxError):
+                environment.get_template('broken.j2')
+        self.assertTrue(lock_keys)
+        self.assertIsNone(bcc.cache.get(lock_keys[0]))
+        self.assertEquals(bcc.get_held_locks(), set())
+
+    def test_bytecode_cache_disabled(self):
+        template_dir = os.path.join(BASE_DIR, "test_files", "include_with_templates")
+        jinja = Jinja2(self.get_jinja_config(template_dir, {'enabled': False}))
+        self.assertIsNone(jinja.env.bytecode_cache)
+
 class TestHierarchyLoader(TestCase):
     """
     Tests for the HierarchyLoader class.
@@ -192,13 +744,13 @@ class TestHierarchyLoader(TestCase):
         template_base = os.path.join(BASE_DIR, "test_files", "sparse_templates")
         return os.path.join(template_base, dirname)
 
-    def get_jinja_config(self):
+    def get_jinja_config(self, **loader_kwargs):
         hierarchy = OrderedDict((
             ("eurogamer_net", FileSystemLoader(self.get_template_dir("eurogamer_net"))),
             ("eurogamer", FileSystemLoader(self.get_template_dir("eurogamer"))),
             ("core", FileSystemLoader(self.get_template_dir("core"))),
         ))
-        loader = HierarchyLoader(hierarchy)
+        loader = HierarchyLoader(hierarchy, **loader_kwargs)
         params = {
             "APP_DIRS": True,
             "OPTIONS": {
@@ -271,6 +823,118 @@ class TestHierarchyLoader(TestCase):
         self.assertRaises(TemplateDoesNotExist, jinja.get_template, ("core:wibble.j2"))
         self.assertRaises(TemplateDoesNotExist, jinja.get_template, ("eurogamer_parent:wibble.j2"))
 
+    def test_get_template_indexed(self):
+        jinja_config = self.get_jinja_config(use_index=True)
+        jinja = Jinja2(jinja_config)
+
+        test_cases = (
+            ("base.j2", "core/base.j2"),
+            ("article.j2", "eurogamer/article.j2"),
+            ("widgets/comments.j2", "eurogamer_net/widgets/comments.j2"),
+            ("eurogamer_net_parent:article.j2", "eurogamer/article.j2"),
+            ("eurogamer_net_parent:base.j2", "core/base.j2"),
+            ("eurogamer_net_parent:widgets/comments.j2", "core/widgets/comments.j2"),
+            ("core:article.j2", "core/article.j2"),
+            ("eurogamer_net:widgets/comments.j2", "eurogamer_net/widgets/comments.j2"),
+            # Names are normalized as they are by FileSystemLoader
+            ("./widgets//comments.j2", "eurogamer_net/widgets/comments.j2"),
+            ("eurogamer_net_parent:./base.j2", "core/base.j2"),
+        )
+        for template_name, expected_template_location in test_cases:
+            t = jinja.get_template(template_name)
+            self.assertEquals(t.template.filename, self.get_template_dir(expected_template_location))
+        self.assertRaises(TemplateDoesNotExist, jinja.get_template, "../core/base.j2")
+
+    def test_get_template_indexed_only_probes_winning_loader(self):
+        jinja_config = self.get_jinja_config(use_index=True)
+        jinja = Jinja2(jinja_config)
+        jinja.env.loader.build_index()
+
+        with mock.patch.object(FileSystemLoader, 'get_source', autospec=True, side_effect=FileSystemLoader.get_source) as get_source:
+            jinja.get_template("base.j2")
+        self.assertEquals(get_source.call_count, 1)
+
+    def test_get_template_indexed_missing(self):
+        jinja_config = self.get_jinja_config(use_index=True)
+        jinja = Jinja2(jinja_config)
+        jinja.env.loader.build_index()
+
+        with mock.patch.object(FileSystemLoader, 'get_source') as get_source:
+            self.assertRaises(TemplateDoesNotExist, jinja.get_template, ("wibble.j2"))
+            self.assertRaises(TemplateDoesNotExist, jinja.get_template, ("core:wibble.j2"))
+            self.assertRaises(TemplateDoesNotExist, jinja.get_template, ("eurogamer_parent:wibble.j2"))
+        get_source.assert_not_called()
+
+        with self.assertRaises(DjangoTemplateNotFound) as cm:
+            jinja.env.loader.get_source(jinja.env, "wibble.j2")
+        self.assertEquals(len(cm.exception.tried), 3)
+
+    def test_index_rebuilt_when_directories_change(self):
+        with tempfile.TemporaryDirectory() as site_dir, tempfile.TemporaryDirectory() as core_dir:
+            loader = HierarchyLoader(OrderedDict((
+                ("site", FileSystemLoader(site_dir)),
+                ("core", FileSystemLoader(core_dir)),
+            )), use_index=True, index_check_interval=0)
+            environment = Environment(loader=loader, auto_reload=True)
+            with open(os.path.join(core_dir, "base.j2"), "w") as f:
+                f.write("core")
+            self.assertEquals(environment.get_template("base.j2").render(), "core")
+
+            os.mkdir(os.path.join(site_dir, "widgets"))
+            with open(os.path.join(site_dir, "widgets", "base.j2"), "w") as f:
+                f.write("site")
+            self.assertEquals(environment.get_template("widgets/base.j2").render(), "site")
+
+            # The directories are only checked once per interval
+            loader.index_check_interval = 60
+            with mock.patch.object(loader, 'get_index_signature') as get_index_signature:
+                for _ in range(3):
+                    loader.get_index(environment)
+            get_index_signature.assert_not_called()
+            with mock.patch('gn_django.template.loaders.time.monotonic', return_value=time.monotonic() + 61):
+                with mock.patch.object(loader, 'get_index_signature', return_value=loader._index_signature) as get_index_signature:
+                    loader.get_index(environment)
+            get_index_signature.assert_called_once_with()
+
+    def test_negative_cache(self):
+        negative_cache = NegativeLookupCache(maxsize=10, ttl=60)
+        jinja_config = self.get_jinja_config(negative_cache=negative_cache)
+        jinja = Jinja2(jinja_config)
+
+        self.assertRaises(TemplateDoesNotExist, jinja.get_template, ("wibble.j2"))
+        self.assertTrue(negative_cache.contains(jinja.env.loader, "wibble.j2"))
+        with mock.patch.object(FileSystemLoader, 'get_source') as get_source:
+            self.assertRaises(TemplateDoesNotExist, jinja.get_template, ("wibble.j2"))
+        get_source.assert_not_called()
+
+        # Explicit invalidation means the hierarchy is probed again
+        jinja.env.loader.invalidate_negative_cache("wibble.j2")
+        self.assertFalse(negative_cache.contains(jinja.env.loader, "wibble.j2"))
+
+    def test_negative_cache_expires(self):
+        negative_cache = NegativeLookupCache(maxsize=10, ttl=60)
+        negative_cache.add("hierarchy", "wibble.j2")
+        self.assertTrue(negative_cache.contains("hierarchy", "wibble.j2"))
+        with mock.patch("gn_django.template.loaders.time.time", return_value=time.time() + 61):
+            self.assertFalse(negative_cache.contains("hierarchy", "wibble.j2"))
+
+    def test_negative_cache_is_bounded(self):
+        negative_cache = NegativeLookupCache(maxsize=2, ttl=60)
+        for template in ("a.j2", "b.j2", "c.j2"):
+            negative_cache.add("hierarchy", template)
+        self.assertFalse(negative_cache.contains("hierarchy", "a.j2"))
+        self.assertTrue(negative_cache.contains("hierarchy", "c.j2"))
+
+    def test_negative_cache_bypassed_in_debug(self):
+        negative_cache = NegativeLookupCache()
+        jinja_config = self.get_jinja_config(negative_cache=negative_cache)
+        jinja = Jinja2(jinja_config)
+        with self.settings(DEBUG=True):
+            with self.assertRaises(DjangoTemplateNotFound) as cm:
+                jinja.env.loader.get_source(jinja.env, "wibble.j2")
+        self.assertEquals(len(cm.exception.tried), 3)
+        self.assertFalse(negative_cache.contains(jinja.env.loader, "wibble.j2"))
+
     def test_init_name_has_parent_at_end(self):
         hierarchy = OrderedDict((
             ("eurogamer_net", FileSystemLoader(self.get_template_dir("eurogamer_net"))),
@@ -319,35 +983,39 @@ class TestMultiHierarchyLoader(TestCase):
         template_base = os.path.join(BASE_DIR, "test_files", "multi_hierarchy_sparse_templates")
         return os.path.join(template_base, dirname)
 
-    def get_jinja_config(self, active_hierarchy_cb):
+    def get_jinja_config(self, active_hierarchy_cb, **loader_kwargs):
         multi_hierarchy = {
             'eurogamer_net': HierarchyLoader(
                 OrderedDict((
                     ("eurogamer_net", FileSystemLoader(self.get_template_dir("eurogamer_net"))),
                     ("eurogamer", FileSystemLoader(self.get_template_dir("eurogamer"))),
                     ("core", FileSystemLoader(self.get_template_dir("core"))),
-                ))
+                )),
+                **loader_kwargs
             ),
             'eurogamer_de': HierarchyLoader(
                 OrderedDict((
                     ("eurogamer_de", FileSystemLoader(self.get_template_dir("eurogamer_de"))),
                     ("eurogamer", FileSystemLoader(self.get_template_dir("eurogamer"))),
                     ("core", FileSystemLoader(self.get_template_dir("core"))),
-                ))
+                )),
+                **loader_kwargs
             ),
             'vg247_com': HierarchyLoader(
                 OrderedDict((
                     ("vg247_com", FileSystemLoader(self.get_template_dir("vg247_com"))),
                     ("vg247", FileSystemLoader(self.get_template_dir("vg247"))),
                     ("core", FileSystemLoader(self.get_template_dir("core"))),
-                ))
+                )),
+                **loader_kwargs
             ),
             'vg247_pl': HierarchyLoader(
                 OrderedDict((
                     ("vg247_pl", FileSystemLoader(self.get_template_dir("vg247_pl"))),
                     ("vg247", FileSystemLoader(self.get_template_dir("vg247"))),
                     ("core", FileSystemLoader(self.get_template_dir("core"))),
-                ))
+                )),
+                **loader_kwargs
             ),
         }
         loader = MultiHierarchyLoader(active_hierarchy_cb, multi_hierarchy)
@@ -404,6 +1072,504 @@ class TestMultiHierarchyLoader(TestCase):
         )
         self.run_test_cases(test_cases)
 
+    def test_shared_negative_cache(self):
+        negative_cache = NegativeLookupCache()
+        get_current_hierarchy_cb = mock.Mock(return_value='eurogamer_net')
+        jinja_config = self.get_jinja_config(get_current_hierarchy_cb, negative_cache=negative_cache)
+        jinja = Jinja2(jinja_config)
+        loader = jinja.env.loader
+
+        self.assertRaises(TemplateDoesNotExist, jinja.get_template, ("wibble.j2"))
+        self.assertTrue(negative_cache.contains(loader.hierarchies['eurogamer_net'], "wibble.j2"))
+        self.assertFalse(negative_cache.contains(loader.hierarchies['eurogamer_de'], "wibble.j2"))
+
+        loader.invalidate_negative_cache()
+        self.assertFalse(negative_cache.contains(loader.hierarchies['eurogamer_net'], "wibble.j2"))
+
+    def test_environment_per_hierarchy(self):
+        get_current_hierarchy_cb = mock.Mock(return_value='eurogamer_net')
+        jinja_config = self.get_jinja_config(get_current_hierarchy_cb)
+        jinja_config['OPTIONS']['environment_per_hierarchy'] = True
+        jinja_config['OPTIONS']['hierarchy_cache_size'] = {'vg247_com': 10}
+        jinja = Jinja2(jinja_config)
+
+        self.assertEquals(set(jinja.hierarchy_environments), {'eurogamer_net', 'eurogamer_de', 'vg247_com', 'vg247_pl'})
+        self.assertEquals(jinja.hierarchy_environments['vg247_com'].cache.capacity, 10)
+        self.assertEquals(jinja.hierarchy_environments['vg247_pl'].cache.capacity, jinja.env.cache.capacity)
+
+        # The active hierarchy is only looked up once, even though the template
+        # extends others
+        t = jinja.get_template('article.j2')
+        self.assertIn("Welcome to the Eurogamer family article page", t.render())
+        self.assertEquals(get_current_hierarchy_cb.call_count, 1)
+        self.assertEquals(t.template.filename, self.get_template_dir('eurogamer/article.j2'))
+        self.assertIs(t.template.environment, jinja.hierarchy_environments['eurogamer_net'])
+        self.assertIn('article.j2', jinja.hierarchy_environments['eurogamer_net'].cache)
+        self.assertEquals(len(jinja.hierarchy_environments['eurogamer_de'].cache), 0)
+
+        get_current_hierarchy_cb.return_value = 'vg247_com'
+        t = jinja.get_template('article.j2')
+        self.assertEquals(t.template.filename, self.get_template_dir('vg247/article.j2'))
+        self.assertRaises(TemplateDoesNotExist, jinja.get_template, 'wibble.j2')
+
+    def test_environment_per_hierarchy_partitioned_cache(self):
+        get_current_hierarchy_cb = mock.Mock(return_value='eurogamer_net')
+        jinja_config = self.get_jinja_config(get_current_hierarchy_cb)
+        jinja_config['OPTIONS']['environment_per_hierarchy'] = True
+        jinja_config['OPTIONS']['hierarchy_cache_size'] = {'vg247_com': 10}
+        jinja_config['OPTIONS']['template_cache'] = {'capacity': 5, 'partition_capacity': {'eurogamer_net': 20}}
+        jinja = Jinja2(jinja_config)
+
+        # Each hierarchy's environment has its own partitioned cache, with the
+        # main environment's quotas, unless it's given a cache size
+        cache = jinja.hierarchy_environments['eurogamer_net'].cache
+        self.assertIsInstance(cache, PartitionedTemplateCache)
+        self.assertIsNot(cache, jinja.env.cache)
+        self.assertIsNot(cache, jinja.hierarchy_environments['eurogamer_de'].cache)
+        self.assertEquals((cache.capacity, cache.partition_capacity), (5, {'eurogamer_net': 20}))
+        self.assertEquals(jinja.hierarchy_environments['vg247_com'].cache.capacity, 10)
+
+        set_current_site('eurogamer_net')
+        try:
+            self.assertIn("Welcome to the Eurogamer family article page", jinja.get_template('article.j2').render())
+        finally:
+            clear_current_site()
+        self.assertIn('article.j2', cache)
+        self.assertEquals(cache.get_stats()['eurogamer_net']['capacity'], 20)
+        self.assertEquals(len(jinja.env.cache), 0)
+
+    def test_stream_keeps_active_hierarchy(self):
+        get_current_hierarchy_cb = mock.Mock(return_value='eurogamer_net')
+        jinja = Jinja2(self.get_jinja_config(get_current_hierarchy_cb))
+        set_current_site('eurogamer_net')
+        try:
+            chunks = jinja.get_template('article.j2').stream(buffer_size=0)
+        finally:
+            clear_current_site()
+
+        # The view has returned, and the site has been cleared, before the
+        # response is streamed
+        get_current_hierarchy_cb.return_value = 'vg247_com'
+        call_count = get_current_hierarchy_cb.call_count
+        content = "".join(chunks)
+        self.assertIn("Welcome to EG.net's comments!", content)
+        self.assertEquals(get_current_hierarchy_cb.call_count, call_count)
+        self.assertIsNone(get_current_site())
+
+    @mock.patch.dict(file_system_loaders, clear=True)
+    def test_lazy_environment_per_hierarchy(self):
+        get_current_hierarchy_cb = mock.Mock(return_value='eurogamer_de')
+        loader = get_multi_hierarchy_loader(get_current_hierarchy_cb, (
+            (hierarchy_name, tuple((name, self.get_template_dir(name)) for name in names))
+            for hierarchy_name, names in (
+                ('eurogamer_net', ('eurogamer_net', 'eurogamer', 'core')),
+                ('eurogamer_de', ('eurogamer_de', 'eurogamer', 'core')),
+                ('vg247_com', ('vg247_com', 'vg247', 'core')),
+            )
+        ), lazy=True)
+        jinja_config = self.get_jinja_config(get_current_hierarchy_cb)
+        jinja_config['OPTIONS']['loader'] = loader
+        jinja_config['OPTIONS']['environment_per_hierarchy'] = True
+        jinja = Jinja2(jinja_config)
+
+        # Nothing is built until a hierarchy is used
+        self.assertEquals(jinja.hierarchy_environments, {})
+        self.assertEquals(len(file_system_loaders), 0)
+
+        t = jinja.get_template('article.j2')
+        self.assertEquals(t.template.filename, self.get_template_dir('eurogamer/article.j2'))
+        self.assertEquals(set(jinja.hierarchy_environments), {'eurogamer_de'})
+        self.assertEquals(list(loader.get_built_hierarchies()), ['eurogamer_de'])
+        self.assertEquals(len(file_system_loaders), 3)
+
+        # Invalidating only touches the built hierarchies
+        jinja.hierarchy_environments['eurogamer_de'].invalidate_templates([self.get_template_dir('core/base.j2')])
+        self.assertFalse(loader.hierarchies.is_built('eurogamer_net'))
+
+        get_current_hierarchy_cb.return_value = 'unknown'
+        self.assertRaises(KeyError, jinja.get_template, 'article.j2')
+
+    def test_share_compiled_templates(self):
+        active = {'hierarchy': 'eurogamer_net'}
+        get_current_hierarchy_cb = lambda: active['hierarchy']
+        jinja_config = self.get_jinja_config(get_current_hierarchy_cb)
+        jinja_config['OPTIONS']['share_compiled_templates'] = True
+        jinja_config['OPTIONS']['template_cache_key_cb'] = lambda loader, name: (get_current_hierarchy_cb(), name)
+        jinja = Jinja2(jinja_config)
+
+        templates = {}
+        with mock.patch.object(jinja.env, 'compile', wraps=jinja.env.compile) as compile:
+            for hierarchy_name in ('eurogamer_net', 'eurogamer_de', 'vg247_com'):
+                active['hierarchy'] = hierarchy_name
+                templates[hierarchy_name] = {
+                    'base': jinja.get_template('base.j2').template,
+                    'article': jinja.get_template('article.j2').template,
+                }
+
+        # core/base.j2, eurogamer/article.j2 and vg247/article.j2
+        self.assertEquals(compile.call_count, 3)
+        self.assertIs(templates['eurogamer_net']['base'], templates['vg247_com']['base'])
+        self.assertIs(templates['eurogamer_net']['article'], templates['eurogamer_de']['article'])
+        self.assertIsNot(templates['eurogamer_net']['article'], templates['vg247_com']['article'])
+
+        # Shared templates keep the name they were first compiled with, so
+        # dependents are evicted by filename
+        active['hierarchy'] = 'vg247_com'
+        template = jinja.get_template('vg247_parent:article.j2').template
+        active['hierarchy'] = 'eurogamer_net'
+        self.assertIs(jinja.get_template('eurogamer_parent:article.j2').template, template)
+        key = ('eurogamer_net', 'eurogamer_parent:article.j2')
+        jinja.env.dependency_graph = mock.Mock(filenames={key: self.get_template_dir('core/article.j2')})
+        jinja.env.dependency_graph.get_affected_templates.return_value = [key]
+        jinja.env.invalidate_templates([self.get_template_dir('core/base.j2')])
+        self.assertNotIn(('vg247_com', 'vg247_parent:article.j2'), jinja.env.cache)
+        self.assertNotIn(('eurogamer_net', 'eurogamer_parent:article.j2'), jinja.env.cache)
+
+    def test_share_compiled_templates_per_hierarchy(self):
+        active = {'hierarchy': 'eurogamer_net'}
+        jinja_config = self.get_jinja_config(lambda: active['hierarchy'])
+        jinja_config['OPTIONS']['share_compiled_templates'] = True
+        jinja_config['OPTIONS']['environment_per_hierarchy'] = True
+        jinja = Jinja2(jinja_config)
+
+        templates = {}
+        with mock.patch.object(Environment, 'compile', autospec=True, side_effect=Environment.compile) as compile:
+            for hierarchy_name in ('eurogamer_net', 'eurogamer_de', 'vg247_com'):
+                active['hierarchy'] = hierarchy_name
+                templates[hierarchy_name] = jinja.get_template('home.j2').template
+                templates[hierarchy_name].render()
+
+        # core/home.j2 and core/base.j2 are compiled once, for every hierarchy
+        self.assertEquals(compile.call_count, 2)
+        # But each hierarchy's environment has its own template objects, so
+        # that they load the templates they extend from their own hierarchy
+        for hierarchy_name, template in templates.items():
+            self.assertIs(template.environment, jinja.hierarchy_environments[hierarchy_name])
+        self.assertIsNot(templates['eurogamer_net'], templates['vg247_com'])
+
+class TestPrecompileTemplates(TestCase):
+    """
+    Tests for the precompile_templates management command.
+    """
+
+    def get_template_dir(self, dirname):
+        template_base = os.path.join(BASE_DIR, "test_files", "multi_hierarchy_sparse_templates")
+        return os.path.join(template_base, dirname)
+
+    def get_templates_setting(self, **options):
+        loader = MultiHierarchyLoader(mock.Mock(), {
+            'eurogamer_net': HierarchyLoader(OrderedDict((
+                ("eurogamer_net", FileSystemLoader(self.get_template_dir("eurogamer_net"))),
+                ("eurogamer", FileSystemLoader(self.get_template_dir("eurogamer"))),
+                ("core", FileSystemLoader(self.get_template_dir("core"))),
+            ))),
+            'vg247_com': HierarchyLoader(OrderedDict((
+                ("vg247_com", FileSystemLoader(self.get_template_dir("vg247_com"))),
+                ("vg247", FileSystemLoader(self.get_template_dir("vg247"))),
+                ("core", FileSystemLoader(self.get_template_dir("core"))),
+            ))),
+        })
+        options.update({
+            'match_extension': None,
+            'loader': loader,
+        })
+        return [{
+            "BACKEND": "gn_django.template.backend.Jinja2",
+            "NAME": "djangojinja",
+            "APP_DIRS": False,
+            "OPTIONS": options,
+        }]
+
+    def test_precompile_to_bytecode_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            bytecode_cache = FileSystemBytecodeCache(cache_dir)
+            with self.settings(TEMPLATES=self.get_templates_setting(bytecode_cache=bytecode_cache)):
+                out = StringIO()
+                call_command(PrecompileTemplatesCommand(), processes=2, stdout=out)
+                self.assertIn(" base.j2 (eurogamer_net, vg247_com)", out.getvalue())
+                self.assertIn(" core:base.j2 (eurogamer_net, vg247_com)", out.getvalue())
+                self.assertIn(" article.j2 (eurogamer_net)", out.getvalue())
+
+                environment = engines['djangojinja'].env
+                environment.loader.get_active_hierarchy_cb.return_value = 'vg247_com'
+                with mock.patch.object(environment, 'compile') as compile:
+                    environment.get_template('article.j2')
+                    environment.get_template('vg247_com_parent:widgets/comments.j2')
+                compile.assert_not_called()
+
+    def test_precompile_to_modules(self):
+        with tempfile.TemporaryDirectory() as target:
+            with self.settings(TEMPLATES=self.get_templates_setting()):
+                call_command(PrecompileTemplatesCommand(), processes=1, target=target, stdout=StringIO())
+            environment = Environment(loader=ModuleLoader(os.path.join(target, 'eurogamer_net')))
+            template = environment.get_template('article.j2')
+            self.assertEquals(template.name, 'article.j2')
+            self.assertIn('title', template.blocks)
+
+    def test_precompile_requires_bytecode_cache(self):
+        with self.settings(TEMPLATES=self.get_templates_setting()):
+            with self.assertRaises(CommandError):
+                call_command(PrecompileTemplatesCommand(), stdout=StringIO())
+
+class TestTemplateCache(TestCase):
+
+    def get_environment(self, **template_cache):
+        return Environment(
+            loader=jinja2.DictLoader(dict(('t%d.j2' % i, '<p>{{ %d }}</p>' % i) for i in range(5))),
+            template_cache_key_cb='gn_django.site.template.get_template_cache_key_with_site',
+            template_cache=template_cache,
+        )
+
+    def get_templates(self, environment, site, names):
+        set_current_site(site)
+        try:
+            for name in names:
+                environment.get_template(name)
+        finally:
+            clear_current_site()
+
+    def test_partitioned_template_cache(self):
+        environment = self.get_environment(capacity=2, partition_capacity={'vg247_com': 1})
+        self.assertIsInstance(environment.cache, PartitionedTemplateCache)
+        self.get_templates(environment, 'eurogamer_net', ['t0.j2', 't1.j2', 't0.j2', 't2.j2'])
+        self.get_templates(environment, 'vg247_com', ['t0.j2', 't1.j2'])
+        self.get_templates(environment, None, ['t3.j2'])
+
+        # A busy site doesn't evict other sites' templates
+        self.assertEquals(environment.cache.get_stats(), {
+            'eurogamer_net': {
+                'size': 2, 'capacity': 2, 'memory': 0, 'max_memory': None, 'hits': 1, 'misses': 3, 'evictions': 1,
+            },
+            'vg247_com': {
+                'size': 1, 'capacity': 1, 'memory': 0, 'max_memory': None, 'hits': 0, 'misses': 2, 'evictions': 1,
+            },
+            'default': {
+                'size': 1, 'capacity': 2, 'memory': 0, 'max_memory': None, 'hits': 0, 'misses': 1, 'evictions': 0,
+            },
+        })
+        self.assertEquals(
+            sorted((site or '', name) for _, site, name in environment.cache.keys()),
+            [('', 't3.j2'), ('eurogamer_net', 't0.j2'), ('eurogamer_net', 't2.j2'), ('vg247_com', 't1.j2')],
+        )
+        environment.evict_templates(lambda template: template.name == 't0.j2')
+        self.assertEquals(environment.cache.get_stats()['eurogamer_net']['size'], 1)
+
+        overlay = environment.overlay()
+        self.assertIsInstance(overlay.cache, PartitionedTemplateCache)
+        self.assertEquals(len(overlay.cache), 0)
+        self.assertEquals(overlay.cache.partition_capacity, {'vg247_com': 1})
+
+    def test_partitioned_template_cache_memory(self):
+        environment = self.get_environment(estimate_memory=True)
+        self.get_templates(environment, 'eurogamer_net', ['t0.j2'])
+        memory = environment.cache.get_stats()['eurogamer_net']['memory']
+        self.assertGreater(memory, 0)
+
+        # Partitions evict templates to stay within their memory quota
+        environment = self.get_environment(max_memory=memory * 2)
+        self.get_templates(environment, 'eurogamer_net', ['t0.j2', 't1.j2', 't2.j2'])
+        stats = environment.cache.get_stats()['eurogamer_net']
+        self.assertEquals((stats['size'], stats['evictions']), (2, 1))
+        self.assertLessEqual(stats['memory'], memory * 2)
+
+class TestTemplateWarmUp(TestCase):
+    """
+    Tests for warming up templates.
+    """
+
+    def get_template_dir(self, dirname):
+        template_base = os.path.join(BASE_DIR, "test_files", "multi_hierarchy_sparse_templates")
+        return os.path.join(template_base, dirname)
+
+    def get_templates_setting(self, **options):
+        loader = MultiHierarchyLoader(get_current_site, {
+            'eurogamer_net': HierarchyLoader(OrderedDict((
+                ("eurogamer_net", FileSystemLoader(self.get_template_dir("eurogamer_net"))),
+                ("eurogamer", FileSystemLoader(self.get_template_dir("eurogamer"))),
+                ("core", FileSystemLoader(self.get_template_dir("core"))),
+            ))),
+            'vg247_com': HierarchyLoader(OrderedDict((
+                ("vg247_com", FileSystemLoader(self.get_template_dir("vg247_com"))),
+                ("vg247", FileSystemLoader(self.get_template_dir("vg247"))),
+                ("core", FileSystemLoader(self.get_template_dir("core"))),
+            ))),
+        })
+        options.update({
+            'match_extension': None,
+            'loader': loader,
+        })
+        return [{
+            "BACKEND": "gn_django.template.backend.Jinja2",
+            "NAME": "djangojinja",
+            "APP_DIRS": False,
+            "OPTIONS": options,
+        }]
+
+    def test_warm_up_templates(self):
+        templates_setting = self.get_templates_setting(
+            template_cache_key_cb='gn_django.site.template.get_template_cache_key_with_site',
+        )
+        with self.settings(TEMPLATES=templates_setting):
+            with self.assertLogs('gn_django.template', level='INFO') as logs:
+                report = warm_up_templates({
+                    'eurogamer_net': ['article.j2', 'widgets/*.j2'],
+                    'vg247_com': ['base.j2', 'wibble.j2'],
+                })
+            self.assertTrue(any("Warmed up 3 templates" in line for line in logs.output))
+            self.assertEquals(report.templates, [
+                ('eurogamer_net', 'article.j2'),
+                ('eurogamer_net', 'widgets/comments.j2'),
+                ('vg247_com', 'base.j2'),
+            ])
+            self.assertEquals([error[:2] for error in report.errors], [('vg247_com', 'wibble.j2')])
+            self.assertGreater(report.elapsed, 0)
+            self.assertIsNone(get_current_site())
+
+            # Warmed up templates are used from the cache for the site
+            environment = engines['djangojinja'].env
+            with mock.patch.object(environment, 'compile') as compile:
+                set_current_site('eurogamer_net')
+                try:
+                    engines['djangojinja'].get_template('article.j2')
+                    engines['djangojinja'].get_template('widgets/comments.j2')
+                finally:
+                    clear_current_site()
+            compile.assert_not_called()
+
+    def test_warm_up_templates_per_hierarchy(self):
+        templates_setting = self.get_templates_setting(environment_per_hierarchy=True)
+        with self.settings(TEMPLATES=templates_setting):
+            report = warm_up_templates(['base.j2', 'core:*.j2'])
+            self.assertEquals(len(report.templates), 10)
+            backend = engines['djangojinja']
+            self.assertIn('core:widgets/comments.j2', backend.hierarchy_environments['vg247_com'].cache)
+            self.assertIn('base.j2', backend.hierarchy_environments['eurogamer_net'].cache)
+
+    def test_warm_up_templates_with_dependencies(self):
+        with self.settings(TEMPLATES=self.get_templates_setting()):
+            report = warm_up_templates({'vg247_com': ['article.j2']}, include_dependencies=True)
+            self.assertEquals([name for _, name in report.templates], [
+                'base.j2',
+                'vg247_com_parent:widgets/comments.j2',
+                'widgets/comments.j2',
+                'vg247_parent:article.j2',
+                'article.j2',
+            ])
+
+    def test_warm_up_templates_from_settings(self):
+        with self.settings(TEMPLATES=self.get_templates_setting()):
+            self.assertIsNone(warm_up_templates_from_settings())
+            with self.settings(TEMPLATE_WARM_UP={'vg247_com': ['article.j2']}):
+                report = warm_up_templates_from_settings()
+            self.assertEquals(report.templates, [('vg247_com', 'article.j2')])
+
+class TestTemplateDependencies(TestCase):
+    """
+    Tests for the template dependency graph.
+    """
+
+    def get_template_dir(self, dirname):
+        template_base = os.path.join(BASE_DIR, "test_files", "multi_hierarchy_sparse_templates")
+        return os.path.join(template_base, dirname)
+
+    def get_jinja(self, active_hierarchy_cb, **options):
+        loader = MultiHierarchyLoader(active_hierarchy_cb, {
+            'eurogamer_net': HierarchyLoader(OrderedDict((
+                ("eurogamer_net", FileSystemLoader(self.get_template_dir("eurogamer_net"))),
+                ("eurogamer", FileSystemLoader(self.get_template_dir("eurogamer"))),
+                ("core", FileSystemLoader(self.get_template_dir("core"))),
+            ))),
+            'vg247_com': HierarchyLoader(OrderedDict((
+                ("vg247_com", FileSystemLoader(self.get_template_dir("vg247_com"))),
+                ("vg247", FileSystemLoader(self.get_template_dir("vg247"))),
+                ("core", FileSystemLoader(self.get_template_dir("core"))),
+            ))),
+        })
+        options.update({
+            'match_extension': None,
+            'loader': loader,
+        })
+        return Jinja2({
+            "NAME": "djangojinja",
+            "APP_DIRS": False,
+            "DIRS": [],
+            "OPTIONS": options,
+        })
+
+    def test_find_template_dependencies(self):
+        jinja = self.get_jinja(mock.Mock())
+        ast = jinja.env.parse(
+            "{% extends 'core:base.j2' %}"
+            "{% import 'macros.j2' as macros %}{% from 'forms.j2' import field %}"
+            "{% include ['a.j2', 'b.j2'] %}{% include dynamic %}"
+            "{% include_with 'widgets/comments.j2' count=1 %}{% include_raw 'css/site.css' %}"
+        )
+        self.assertEquals(find_template_dependencies(ast), [
+            ('extends', 'core:base.j2'),
+            ('import', 'macros.j2'),
+            ('import', 'forms.j2'),
+            ('include', 'a.j2'),
+            ('include', 'b.j2'),
+            ('include_with', 'widgets/comments.j2'),
+            ('include_raw', 'css/site.css'),
+        ])
+
+    def test_dependency_graph(self):
+        jinja = self.get_jinja(mock.Mock())
+        graph = TemplateDependencyGraph(jinja.env)
+
+        self.assertEquals(graph.get_dependencies('eurogamer_net', 'article.j2'), [('extends', 'eurogamer_parent:article.j2')])
+        self.assertEquals(graph.get_load_order('eurogamer_net', ['article.j2']), [
+            'base.j2',
+            'eurogamer_net_parent:widgets/comments.j2',
+            'widgets/comments.j2',
+            'eurogamer_parent:article.j2',
+            'article.j2',
+        ])
+
+        affected = graph.get_affected_templates([self.get_template_dir('core/widgets/comments.j2')])
+        self.assertIn(('vg247_com', 'vg247_com_parent:widgets/comments.j2'), affected)
+        self.assertIn(('vg247_com', 'widgets/comments.j2'), affected)
+        self.assertIn(('vg247_com', 'vg247_parent:article.j2'), affected)
+        self.assertIn(('eurogamer_net', 'article.j2'), affected)
+        self.assertNotIn(('eurogamer_net', 'base.j2'), affected)
+        self.assertNotIn(('eurogamer_net', 'home.j2'), affected)
+
+        most_included = graph.get_most_included()
+        self.assertEquals(set(filename for filename, _ in most_included), {
+            self.get_template_dir('eurogamer_net/widgets/comments.j2'),
+            self.get_template_dir('vg247_com/widgets/comments.j2'),
+        })
+        self.assertEquals(graph.get_most_included(1), most_included[:1])
+
+        # Unchanged templates aren't parsed again when the graph is rebuilt
+        graph.invalidate()
+        with mock.patch.object(jinja.env, 'parse') as parse:
+            graph.get_dependencies('eurogamer_net', 'article.j2')
+        parse.assert_not_called()
+
+    def test_invalidate_dependent_templates(self):
+        jinja = self.get_jinja(mock.Mock(return_value='eurogamer_net'), dependency_graph=True)
+        for name in ('article.j2', 'home.j2'):
+            jinja.get_template(name).render({})
+        cached = lambda: set(template.name for template in jinja.env.cache.values())
+        self.assertIn('article.j2', cached())
+
+        jinja.env.invalidate_templates([self.get_template_dir('core/widgets/comments.j2')])
+        self.assertNotIn('article.j2', cached())
+        self.assertNotIn('eurogamer_parent:article.j2', cached())
+        self.assertIn('home.j2', cached())
+        self.assertIn('base.j2', cached())
+        self.assertFalse(jinja.env.dependency_graph.built)
+
+    def test_template_dependencies_command(self):
+        jinja = self.get_jinja(mock.Mock())
+        with mock.patch('django_jinja.backend.Jinja2.get_default', return_value=jinja):
+            out = StringIO()
+            call_command(TemplateDependenciesCommand(), limit=1, stdout=out)
+        self.assertEquals(len(out.getvalue().splitlines()), 1)
+        self.assertIn("widgets/comments.j2", out.getvalue())
+
 class TestLoaderBuilders(TestCase):
     """
     Tests for the loader builder functions.
@@ -510,6 +1676,286 @@ class TestLoaderBuilders(TestCase):
 
         self.assertEquals(len(file_system_loaders), 7)
 
+    @mock.patch.dict(file_system_loaders, clear=True)
+    def test_get_multi_hierarchy_loader_lazy(self):
+        loader = get_multi_hierarchy_loader(
+            mock.Mock(return_value='vg247_com'),
+            (
+                ('eurogamer_net', (
+                    ('eurogamer_net', self.get_template_dir('eurogamer_net')),
+                    ('eurogamer', self.get_template_dir('eurogamer')),
+                    ('core', self.get_template_dir('core')),
+                )),
+                ('vg247_com', (
+                    ('vg247_com', self.get_template_dir('vg247_com')),
+                    ('vg247', self.get_template_dir('vg247')),
+                    ('core', self.get_template_dir('core')),
+                )),
+            ),
+            lazy=True
+        )
+        self.assertIsInstance(loader.hierarchies, LazyHierarchies)
+        self.assertEquals(list(loader.hierarchies), ['eurogamer_net', 'vg247_com'])
+        self.assertEquals(len(file_system_loaders), 0)
+
+        hierarchy = loader.get_loader()
+        self.assertIs(hierarchy, loader.hierarchies['vg247_com'])
+        self.assertEquals(list(hierarchy.hierarchy), ['vg247_com', 'vg247', 'core'])
+        self.assertTrue(loader.hierarchies.is_built('vg247_com'))
+        self.assertFalse(loader.hierarchies.is_built('eurogamer_net'))
+        self.assertEquals(len(file_system_loaders), 3)
+
+    @mock.patch.dict(snapshot_loaders, clear=True)
+    def test_get_hierarchy_loader_snapshot(self):
+        loader = get_hierarchy_loader((
+            ('vg247', self.get_template_dir('vg247')),
+            ('core', self.get_template_dir('core')),
+        ), snapshot=True)
+        for child in loader.hierarchy.values():
+            self.assertIsInstance(child, SnapshotLoader)
+        self.assertEquals(len(snapshot_loaders), 2)
+        expected = get_hierarchy_loader((
+            ('vg247', self.get_template_dir('vg247')),
+            ('core', self.get_template_dir('core')),
+        ))
+        self.assertEquals(loader.list_templates(), expected.list_templates())
+
+    def test_snapshot_loader(self):
+        with tempfile.TemporaryDirectory() as template_dir:
+            os.makedirs(os.path.join(template_dir, 'sub'))
+            with open(os.path.join(template_dir, 'sub', 'page.j2'), 'w') as f:
+                f.write('Hello {{ name }}')
+            # Files which aren't templates don't stop the loader being created
+            with open(os.path.join(template_dir, 'image.png'), 'wb') as f:
+                f.write(b'\x89PNG\r\n\x1a\n\xff\xfe\x00')
+            loader = SnapshotLoader(template_dir)
+            # Templates are served from memory once the loader is created
+            os.remove(os.path.join(template_dir, 'sub', 'page.j2'))
+            source, filename, uptodate = loader.get_source(mock.Mock(), 'sub/page.j2')
+        self.assertEquals(source, 'Hello {{ name }}')
+        self.assertEquals(filename, os.path.join(template_dir, 'sub', 'page.j2'))
+        self.assertTrue(uptodate())
+        self.assertEquals(loader.list_templates(), ['image.png', 'sub/page.j2'])
+        with self.assertRaises(UnicodeDecodeError):
+            loader.get_source(mock.Mock(), 'image.png')
+        with self.assertRaises(jinja2.TemplateNotFound):
+            loader.get_source(mock.Mock(), 'missing.j2')
+
+    def test_bundle_loader(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            template_dir = os.path.join(temp_dir, 'templates')
+            os.makedirs(os.path.join(template_dir, 'sub'))
+            for name, source in (('base.j2', 'Base'), ('sub/page.j2', 'P\u00e4ge {{ name }}')):
+                with open(os.path.join(template_dir, *name.split('/')), 'w', encoding='utf-8') as f:
+                    f.write(source)
+            bundle_path = os.path.join(temp_dir, 'templates.bundle')
+            self.assertEquals(write_template_bundle(template_dir, bundle_path), ['base.j2', 'sub/page.j2'])
+
+            loader = BundleLoader(bundle_path)
+            source, filename, uptodate = loader.get_source(mock.Mock(), 'sub/page.j2')
+            self.assertEquals(source, 'P\u00e4ge {{ name }}')
+            self.assertEquals(filename, bundle_path + '/sub/page.j2')
+            self.assertTrue(uptodate())
+            self.assertEquals(loader.list_templates(), ['base.j2', 'sub/page.j2'])
+            with self.assertRaises(jinja2.TemplateNotFound):
+                loader.get_source(mock.Mock(), 'missing.j2')
+
+            env = jinja2.Environment(loader=HierarchyLoader(OrderedDict((('core', loader),))))
+            self.assertEquals(env.get_template('sub/page.j2').render(name='x'), 'P\u00e4ge x')
+            loader.bundle.data.close()
+
+    @mock.patch.dict(archive_loaders, clear=True)
+    def test_get_hierarchy_loader_archives(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            core_zip = os.path.join(temp_dir, 'core.zip')
+            vg247_bundle = os.path.join(temp_dir, 'vg247.bundle')
+            write_template_zip(self.get_template_dir('core'), core_zip, compress=True)
+            write_template_bundle(self.get_template_dir('vg247'), vg247_bundle)
+
+            loader = get_hierarchy_loader((
+                ('vg247_com', self.get_template_dir('vg247_com')),
+                ('vg247', vg247_bundle),
+                ('core', core_zip),
+            ))
+            self.assertIsInstance(loader.hierarchy['vg247'], BundleLoader)
+            self.assertIsInstance(loader.hierarchy['core'], ZipLoader)
+            self.assertEquals(len(archive_loaders), 2)
+
+            expected = get_hierarchy_loader((
+                ('vg247_com', self.get_template_dir('vg247_com')),
+                ('vg247', self.get_template_dir('vg247')),
+                ('core', self.get_template_dir('core')),
+            ))
+            self.assertEquals(loader.list_templates(), expected.list_templates())
+            env = jinja2.Environment(loader=loader)
+            expected_env = jinja2.Environment(loader=expected)
+            for name in expected.list_templates():
+                self.assertEquals(env.loader.get_source(env, name)[0], expected_env.loader.get_source(expected_env, name)[0])
+            _, filename, uptodate = loader.hierarchy['core'].get_source(env, 'base.j2')
+            self.assertEquals(filename, core_zip + '/base.j2')
+            self.assertTrue(uptodate())
+
+            loader.hierarchy['core'].close()
+            loader.hierarchy['vg247'].bundle.data.close()
+
+    def test_build_template_bundle_command(self):
+        out = StringIO()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'core.zip')
+            call_command(BuildTemplateBundleCommand(), self.get_template_dir('core'), path, zip=True, stdout=out)
+            self.assertEquals(os.stat(path).st_mode & 0o777, 0o666 & ~utils._umask)
+            loader = ZipLoader(path)
+            self.assertEquals(loader.list_templates(), FileSystemLoader(self.get_template_dir('core')).list_templates())
+            # Forked processes open the zip file again, rather than sharing
+            # the open file's offset
+            archive = loader.get_archive()
+            self.assertIs(loader.get_archive(), archive)
+            reset_zip_loaders()
+            self.assertIsNone(archive.fp)
+            self.assertIsNot(loader.get_archive(), archive)
+            self.assertEquals(
+                loader.get_source(mock.Mock(), 'base.j2')[0],
+                FileSystemLoader(self.get_template_dir('core')).get_source(mock.Mock(), 'base.j2')[0],
+            )
+            loader.close()
+            with self.assertRaises(CommandError):
+                call_command(BuildTemplateBundleCommand(), self.get_template_dir('core'), path, compress=True)
+        self.assertIn('Wrote %d templates to %s' % (len(loader.list_templates()), path), out.getvalue())
+
+class TestTemplateWatchers(TestCase):
+    """
+    Tests for the template watchers.
+    """
+
+    def write_template(self, path, content, mtime_offset=0):
+        with open(path, "w") as f:
+            f.write(content)
+        mtime = time.time() + mtime_offset
+        os.utime(path, (mtime, mtime))
+
+    def test_polling_watcher_detects_changes(self):
+        with tempfile.TemporaryDirectory() as template_dir:
+            self.write_template(os.path.join(template_dir, "base.j2"), "base")
+            self.write_template(os.path.join(template_dir, "article.j2"), "article")
+            watcher = PollingTemplateWatcher([template_dir])
+            watcher.prepare()
+            self.assertEquals(watcher.poll(), set())
+
+            self.write_template(os.path.join(template_dir, "base.j2"), "changed", mtime_offset=10)
+            self.write_template(os.path.join(template_dir, "home.j2"), "home")
+            os.remove(os.path.join(template_dir, "article.j2"))
+            self.assertEquals(watcher.poll(), {
+                os.path.join(template_dir, "base.j2"),
+                os.path.join(template_dir, "home.j2"),
+                os.path.join(template_dir, "article.j2"),
+            })
+
+    def test_watcher_started_once(self):
+        watcher = PollingTemplateWatcher([], interval=3600)
+        environment = Environment()
+        with mock.patch.object(watcher, 'prepare', side_effect=lambda: time.sleep(0.05)) as prepare:
+            with mock.patch.object(watcher, 'run'):
+                threads = [threading.Thread(target=watcher.watch, args=(environment,)) for _ in range(5)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                watcher.stop()
+        self.assertEquals(prepare.call_count, 1)
+
+    def test_watched_environment_evicts_changed_templates(self):
+        with tempfile.TemporaryDirectory() as site_dir, tempfile.TemporaryDirectory() as core_dir:
+            self.write_template(os.path.join(core_dir, "base.j2"), "core")
+            loader = HierarchyLoader(OrderedDict((
+                ("site", FileSystemLoader(site_dir)),
+                ("core", FileSystemLoader(core_dir)),
+            )), use_index=True)
+            watcher = PollingTemplateWatcher(interval=3600)
+            environment = Environment(loader=loader, auto_reload=True, template_watcher=watcher)
+            try:
+                self.assertEquals(environment.get_template("base.j2").render(), "core")
+                self.assertEquals(set(watcher.get_directories()) & {site_dir, core_dir}, {site_dir, core_dir})
+
+                # Cached templates aren't checked for changes on each fetch
+                self.write_template(os.path.join(core_dir, "base.j2"), "changed core", mtime_offset=10)
+                with mock.patch("os.stat") as stat:
+                    self.assertEquals(environment.get_template("base.j2").render(), "core")
+                stat.assert_not_called()
+
+                environment.invalidate_templates(watcher.poll())
+                self.assertEquals(environment.get_template("base.j2").render(), "changed core")
+
+                # A template added higher up the hierarchy takes precedence
+                self.write_template(os.path.join(site_dir, "base.j2"), "site")
+                environment.invalidate_templates(watcher.poll())
+                self.assertEquals(environment.get_template("base.j2").render(), "site")
+            finally:
+                watcher.stop()
+
+class TestTemplateInstrumentation(TestCase):
+    """
+    Tests for template instrumentation.
+    """
+
+    def get_template_dir(self, dirname):
+        template_base = os.path.join(BASE_DIR, "test_files", "sparse_templates")
+        return os.path.join(template_base, dirname)
+
+    def get_environment(self, **kwargs):
+        loader = HierarchyLoader(OrderedDict((
+            ("eurogamer_net", FileSystemLoader(self.get_template_dir("eurogamer_net"))),
+            ("eurogamer", FileSystemLoader(self.get_template_dir("eurogamer"))),
+            ("core", FileSystemLoader(self.get_template_dir("core"))),
+        )))
+        return Environment(loader=loader, **kwargs)
+
+    def test_records_template_events(self):
+        sink = InMemorySink()
+        environment = self.get_environment(instrumentation=sink)
+        environment.hierarchy_name = 'eurogamer_net'
+
+        environment.get_template("article.j2").render()
+        environment.get_template("article.j2").render()
+
+        self.assertEquals(sink.get_count("load", "article.j2"), 1)
+        self.assertEquals(sink.get_count("compile", "article.j2"), 1)
+        self.assertEquals(sink.get_count("cache_hit", "article.j2"), 1)
+        self.assertEquals(sink.get_count("render"), 2)
+        # The parent template is only rendered as part of article.j2
+        self.assertEquals(sink.get_count("render", "eurogamer_parent:article.j2"), 0)
+        self.assertEquals(sink.get_count("load", "eurogamer_parent:article.j2"), 1)
+
+        histogram = sink.get_histogram("render", "article.j2", site="eurogamer_net", level="eurogamer")
+        self.assertEquals(histogram.count, 2)
+        self.assertEquals(sum(count for _, count in histogram.get_bucket_counts()), 2)
+        self.assertIsNotNone(sink.get_histogram("compile", "eurogamer_parent:article.j2", site="eurogamer_net", level="core"))
+
+        sink.reset()
+        self.assertEquals(sink.get_count("render"), 0)
+
+    def test_no_instrumentation(self):
+        environment = self.get_environment()
+        self.assertIsNone(environment.instrumentation)
+        self.assertIs(environment.template_class, jinja2.Template)
+        with mock.patch.object(Environment, 'record_template_event') as record_template_event:
+            environment.get_template("article.j2").render()
+        record_template_event.assert_not_called()
+
+    def test_logging_sink(self):
+        environment = self.get_environment(instrumentation=LoggingSink())
+        with self.assertLogs('gn_django.template', level='DEBUG') as logs:
+            environment.get_template("base.j2").render()
+        self.assertTrue(any("template render base.j2" in line and "level=core" in line for line in logs.output))
+
+    def test_statsd_sink(self):
+        sink = StatsdSink(host='statsd.local', port=9125, prefix='templates')
+        with mock.patch.object(sink, 'socket') as sock:
+            sink.record("render", "home.j2", 0.0125, {"site": "eurogamer_net", "level": "core"})
+        sock.sendto.assert_called_once_with(
+            b"templates.render:12.50|ms|#level:core,site:eurogamer_net,template:home.j2",
+            ('statsd.local', 9125),
+        )
+
 class TestTemplateUtils(TestCase):
     """
     Tests for the Jinja2 class.
@@ -525,3 +1971,20 @@ class TestTemplateUtils(TestCase):
             'bar': 'Eggman'
         })
         self.assertEquals(rendered, '<p>Dr Eggman</p>')
+
+    def test_stream_template_response(self):
+        response = utils.stream_template_response(None, "site.j2", {'site': 'eurogamer', 'namespace': 'core'}, status=201)
+        self.assertEquals(response.status_code, 201)
+        self.assertEquals(b''.join(response.streaming_content), b"Site: eurogamer\nNamespace: core")
+
+    def test_write_atomically(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'file.txt')
+            utils.write_atomically(path, lambda f: f.write('contents'), mode='w')
+            with open(path) as f:
+                self.assertEquals(f.read(), 'contents')
+            # Files get the permissions set by the umask, not mkstemp()'s 0600
+            self.assertEquals(os.stat(path).st_mode & 0o777, 0o666 & ~utils._umask)
+            with self.assertRaises(ValueError):
+                utils.write_atomically(path, mock.Mock(side_effect=ValueError))
+            self.assertEquals(os.listdir(temp_dir), ['file.txt'])